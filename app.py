@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
 from google.oauth2.service_account import Credentials
 import json
@@ -9,8 +10,31 @@ from datetime import datetime
 import openai
 import requests
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_pdf import PdfPages
 from rapidfuzz import process, fuzz
+from PIL import Image
+import plotly.graph_objects as go
 import base64
+import bisect
+import zlib
+import html
+import io
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+import textwrap
+import functools
+import logging
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+
+log = logging.getLogger("area199")
 
 # ==============================================================================
 # CONFIGURAZIONE & STILE
@@ -24,17 +48,24 @@ st.markdown("""
     h1, h2, h3, h4 { color: #E20613 !important; text-transform: uppercase; font-weight: 800; }
     .stButton>button { border: 2px solid #E20613; color: #E20613; font-weight: bold; text-transform: uppercase; width: 100%; }
     .stButton>button:hover { background: #E20613; color: white; }
+    .stDownloadButton>button { background-color: #E20613; color: white; font-weight: bold; border: none; }
     
     .metric-box { background: #161616; padding: 10px; border-radius: 5px; margin-bottom: 5px; border-left: 3px solid #E20613; }
     .session-header { color: #E20613; font-size: 1.5em; font-weight: bold; margin-top: 30px; border-bottom: 1px solid #333; padding-bottom: 5px; }
     .exercise-name { font-size: 1.2em; font-weight: bold; color: white; }
     .exercise-details { color: #ccc; font-size: 1em; }
     .exercise-note { color: #888; font-style: italic; font-size: 0.9em; border-left: 2px solid #E20613; padding-left: 10px; margin-top: 5px; }
+    .ex-block { border-bottom: 1px solid #333; padding: 12px 0; }
+    .ex-row { display: flex; flex-wrap: wrap; gap: 16px; }
+    .ex-imgs { flex: 2 1 220px; display: flex; gap: 6px; }
+    .ex-imgs img { width: 49%; height: auto; border-radius: 4px; }
+    .ex-text { flex: 3 1 260px; }
     
     /* Stili Nutrizione */
     .meal-header { background-color: #222; padding: 8px; border-radius: 4px; border-left: 4px solid #4ade80; margin-top: 15px; font-weight: bold; color: #4ade80; }
     .supp-item { border-bottom: 1px solid #333; padding: 10px 0; }
     .food-item { padding: 4px 0; border-bottom: 1px solid #333; color: #eee; font-size: 0.95em; }
+    .meal-notes { color: #999; font-size: 0.85em; padding: 4px 0; }
     .note-box { background-color: #1a1a1a; border: 1px solid #555; padding: 15px; border-radius: 8px; margin-top: 20px; }
     
     .debug-img { font-size: 0.7em; color: #ffcc00; font-family: monospace; background: #222; padding: 2px 5px; margin-bottom: 5px; display: inline-block; }
@@ -42,16 +73,354 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Cartella per snapshot, cache e replica locali
+CACHE_DIR = os.environ.get("AREA199_CACHE_DIR", ".area199_cache")
+
 # ==============================================================================
 # 1. MOTORE DATI
 # ==============================================================================
 
+# --- TRACING (SPAN E CONTATORI IN MEMORIA) ---
+# Ogni span (nome, inizio, durata, thread, rerun, attributi, errore) finisce in un buffer circolare
+# condiviso tra sessioni. Il pannello coach mostra p50/p95 per nome; l'export è JSON grezzo o
+# formato Chrome trace (chrome://tracing, ui.perfetto.dev).
+TRACE_MAX_SPANS = 20000
+
+@st.cache_resource
+def _tracer():
+    return {'lock': threading.Lock(), 'spans': deque(maxlen=TRACE_MAX_SPANS), 'counters': {}, 'reruns': 0, 'local': threading.local()}
+
+@contextmanager
+def span(name, **attrs):
+    """with span('sheets.get_all_records', foglio=...) as attrs: ... (attrs si può arricchire dentro il blocco)."""
+    tr = _tracer()
+    start, t0, error = time.time(), time.perf_counter(), None
+    try: yield attrs
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        rec = {'name': name, 'start': start, 'ms': (time.perf_counter() - t0) * 1000, 'tid': threading.get_ident(),
+               'thread': threading.current_thread().name, 'rerun': getattr(tr['local'], 'rerun', None), 'error': error, 'attrs': attrs}
+        with tr['lock']: tr['spans'].append(rec)
+
+def traced(name):
+    """Decoratore: tutta la funzione dentro uno span."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name): return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def trace_count(name, n=1):
+    tr = _tracer()
+    with tr['lock']: tr['counters'][name] = tr['counters'].get(name, 0) + n
+
+def start_rerun():
+    """Numera il rerun corrente: gli span del thread dello script lo portano con sé."""
+    tr = _tracer()
+    with tr['lock']:
+        tr['reruns'] += 1
+        tr['local'].rerun = tr['reruns']
+
+def _trace_snapshot():
+    tr = _tracer()
+    with tr['lock']: return list(tr['spans']), dict(tr['counters'])
+
+def trace_report():
+    """Per nome di span: numero, errori, p50/p95/max e tempo totale in ms (il più costoso in alto)."""
+    spans, _ = _trace_snapshot()
+    if not spans: return pd.DataFrame()
+    df = pd.DataFrame({'name': [x['name'] for x in spans], 'ms': [x['ms'] for x in spans], 'error': [x['error'] is not None for x in spans]})
+    g = df.groupby('name')
+    return pd.DataFrame({'n': g.size(), 'errori': g['error'].sum(), 'p50_ms': g['ms'].median(), 'p95_ms': g['ms'].quantile(0.95),
+                         'max_ms': g['ms'].max(), 'totale_ms': g['ms'].sum()}).round(1).sort_values('totale_ms', ascending=False)
+
+def export_trace_json():
+    spans, counters = _trace_snapshot()
+    return json.dumps({'spans': spans, 'counters': counters}, default=str, ensure_ascii=False).encode('utf-8')
+
+def export_chrome_trace():
+    """Eventi 'X' (inizio + durata in µs) per thread, nomi dei thread e contatori finali."""
+    spans, counters = _trace_snapshot()
+    pid = os.getpid()
+    events = [{'name': x['name'], 'cat': x['name'].split('.')[0], 'ph': 'X', 'ts': int(x['start'] * 1e6), 'dur': int(x['ms'] * 1000),
+               'pid': pid, 'tid': x['tid'], 'args': dict(x['attrs'], rerun=x['rerun'], error=x['error'])} for x in spans]
+    events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+               for tid, name in {x['tid']: x['thread'] for x in spans}.items()]
+    if counters: events.append({'name': 'contatori', 'ph': 'C', 'ts': int(time.time() * 1e6), 'pid': pid, 'args': counters})
+    return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str).encode('utf-8')
+
+def reset_traces():
+    tr = _tracer()
+    with tr['lock']:
+        tr['spans'].clear()
+        tr['counters'].clear()
+
+# --- GOVERNOR QUOTE API SHEETS ---
+# Tutte le chiamate gspread passano da due token bucket (letture/scritture) dimensionati sulle
+# quote al minuto di Google. Le priorità più basse si fermano prima di consumare la riserva,
+# così il login atleta trova sempre token; su 429 il bucket si blocca con backoff crescente.
+SHEETS_READS_PER_MIN = 60
+SHEETS_WRITES_PER_MIN = 60
+SHEETS_BURST = 20                 # token accumulabili per bucket
+SHEETS_BACKOFF = 2                # secondi, primo blocco dopo un 429 (poi raddoppia)
+SHEETS_BACKOFF_MAX = 64
+SHEETS_MAX_RETRIES = 3            # nuovi tentativi automatici su 429
+# priorità -> (quota del bucket lasciata libera, attesa massima in secondi)
+SHEETS_PRIORITIES = {'athlete': (0.0, 20), 'coach': (0.25, 30), 'background': (0.5, 120)}
+# metodo gspread -> tipo di quota. Quelli in SHEETS_HANDLES restituiscono file/fogli da governare a loro volta
+SHEETS_CALLS = {
+    'open': 'read', 'open_by_key': 'read', 'worksheet': 'read', 'worksheets': 'read', 'sheet1': 'read',
+    'get_all_records': 'read', 'get_all_values': 'read', 'get': 'read', 'batch_get': 'read',
+    'row_values': 'read', 'col_values': 'read', 'values_batch_get': 'read', 'values_get': 'read',
+    'append_row': 'write', 'append_rows': 'write', 'update': 'write', 'batch_update': 'write',
+    'values_append': 'write', 'values_update': 'write', 'add_worksheet': 'write',
+}
+SHEETS_HANDLES = {'open', 'open_by_key', 'worksheet', 'sheet1', 'add_worksheet'}
+
+class SheetsBusyError(Exception):
+    """Quota Sheets esaurita oltre l'attesa massima consentita alla priorità corrente."""
+
+def api_status(err):
+    return getattr(getattr(err, 'response', None), 'status_code', None)
+
+@st.cache_resource
+def _sheets_governor():
+    now = time.time()
+    bucket = lambda per_min: {'tokens': float(SHEETS_BURST), 'rate': per_min / 60.0, 'at': now, 'blocked_until': 0.0,
+                              'backoff': 0.0, 'waits': 0, 'busy': 0, 'throttled': 0}
+    return {'lock': threading.Lock(), 'local': threading.local(), 'calls': {},
+            'buckets': {'read': bucket(SHEETS_READS_PER_MIN), 'write': bucket(SHEETS_WRITES_PER_MIN)}}
+
+@contextmanager
+def sheets_priority(priority):
+    """with sheets_priority('athlete'): ... -> priorità delle chiamate Sheets del thread corrente."""
+    local = _sheets_governor()['local']
+    prev = getattr(local, 'priority', None)
+    local.priority = priority
+    try: yield
+    finally: local.priority = prev
+
+def _take_sheets_token(gov, kind, priority):
+    reserve_frac, max_wait = SHEETS_PRIORITIES[priority]
+    b, deadline, waited = gov['buckets'][kind], time.time() + max_wait, False
+    while True:
+        with gov['lock']:
+            now = time.time()
+            b['tokens'] = min(SHEETS_BURST, b['tokens'] + (now - b['at']) * b['rate'])
+            b['at'] = now
+            wait = b['blocked_until'] - now
+            if wait <= 0:
+                reserve = SHEETS_BURST * reserve_frac
+                if b['tokens'] - 1 >= reserve:
+                    b['tokens'] -= 1
+                    return
+                wait = (reserve + 1 - b['tokens']) / b['rate']
+            if not waited: b['waits'] += 1; waited = True
+            if now + wait > deadline:
+                b['busy'] += 1
+                raise SheetsBusyError("⏳ Troppe richieste a Google Sheets in questo momento, riprova tra qualche secondo.")
+        time.sleep(min(wait, 1.0))
+
+def _record_sheets_call(gov, name, elapsed, error=None):
+    with gov['lock']:
+        c = gov['calls'].setdefault(name, {'calls': 0, 'errors': 0, 'rate_limited': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        c['calls'] += 1
+        c['total_ms'] += elapsed * 1000
+        c['max_ms'] = max(c['max_ms'], elapsed * 1000)
+        if error is not None:
+            c['errors'] += 1
+            if api_status(error) == 429: c['rate_limited'] += 1
+
+def governed_sheets_call(gov, name, fn):
+    kind = SHEETS_CALLS[name]
+    priority = getattr(gov['local'], 'priority', None) or 'coach'
+    b = gov['buckets'][kind]
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        _take_sheets_token(gov, kind, priority)
+        t0 = time.perf_counter()
+        try:
+            with span(f"sheets.{name}", priority=priority, attempt=attempt): res = fn()
+        except Exception as e:
+            _record_sheets_call(gov, name, time.perf_counter() - t0, e)
+            if api_status(e) != 429 or attempt == SHEETS_MAX_RETRIES: raise
+            with gov['lock']:
+                # 429: stop per tutti, con attesa che raddoppia finché Google continua a rifiutare
+                b['backoff'] = min(max(b['backoff'] * 2, SHEETS_BACKOFF), SHEETS_BACKOFF_MAX)
+                b['blocked_until'] = time.time() + b['backoff'] * random.uniform(0.5, 1.0)
+                b['tokens'] = 0.0
+                b['throttled'] += 1
+            continue
+        _record_sheets_call(gov, name, time.perf_counter() - t0)
+        if b['backoff']:
+            with gov['lock']: b['backoff'] /= 2
+        return res
+
+class GovernedSheets:
+    """Proxy su client / file / foglio gspread: le chiamate note passano dal governor."""
+    def __init__(self, target, gov):
+        self._target, self._gov = target, gov
+
+    def _wrap(self, name, res):
+        return GovernedSheets(res, self._gov) if name in SHEETS_HANDLES and res is not None else res
+
+    def __getattr__(self, name):
+        if name not in SHEETS_CALLS: return getattr(self._target, name)
+        if name == 'sheet1':  # proprietà che fa una chiamata API
+            return self._wrap(name, governed_sheets_call(self._gov, name, lambda: self._target.sheet1))
+        method = getattr(self._target, name)
+        def call(*args, **kwargs):
+            return self._wrap(name, governed_sheets_call(self._gov, name, lambda: method(*args, **kwargs)))
+        return call
+
+def sheets_api_stats():
+    gov = _sheets_governor()
+    with gov['lock']:
+        buckets = {k: {f: round(v, 2) if isinstance(v, float) else v for f, v in b.items() if f not in ('at', 'rate')} for k, b in gov['buckets'].items()}
+        calls = {n: dict(c, total_ms=round(c['total_ms'], 1), max_ms=round(c['max_ms'], 1), avg_ms=round(c['total_ms'] / c['calls'], 1)) for n, c in gov['calls'].items()}
+    return {'buckets': buckets, 'calls': calls}
+
 @st.cache_resource
 def get_client():
     scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
     creds_dict = dict(st.secrets["gcp_service_account"])
     creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    return gspread.authorize(creds)
+    return GovernedSheets(gspread.authorize(creds), _sheets_governor())
+
+# --- CACHE SNAPSHOT FOGLI (CONDIVISA TRA SESSIONI, SINGLE-FLIGHT) ---
+# Una sola get_all_records() per foglio ogni SHEET_CACHE_TTL secondi, qualunque sia il numero di
+# sessioni: chi arriva mentre un'altra sessione sta già leggendo lo stesso foglio aspetta quel risultato.
+SHEET_CACHE_TTL = 120
+
+@st.cache_resource
+def _sheet_cache():
+    return {'lock': threading.Lock(), 'entries': {}, 'key_locks': {}, 'generation': {},
+            'stats': {'hits': 0, 'misses': 0, 'waits': 0, 'errors': 0, 'invalidations': 0}}
+
+# --- HANDLE FILE/FOGLI (APERTI UNA VOLTA PER PROCESSO) ---
+# client.open(titolo) fa una ricerca su Drive a ogni chiamata e .worksheet() rilegge i metadati.
+# Gli ID vengono da st.secrets["spreadsheet_ids"] (titolo -> ID) o si risolvono una volta per
+# titolo; gli handle Spreadsheet/Worksheet restano poi in cache per tutto il processo.
+@st.cache_resource
+def _sheet_handles():
+    return {'lock': threading.Lock(), 'spreadsheets': {}, 'worksheets': {}, 'ids': {}}
+
+def configured_spreadsheet_ids():
+    try: return dict(st.secrets.get("spreadsheet_ids", {}))
+    except Exception: return {}
+
+def open_spreadsheet(title):
+    h = _sheet_handles()
+    with h['lock']:
+        sh = h['spreadsheets'].get(title)
+        key = configured_spreadsheet_ids().get(title) or h['ids'].get(title)
+    if sh is not None: return sh
+    try: sh = get_client().open_by_key(key) if key else get_client().open(title)
+    except gspread.exceptions.SpreadsheetNotFound:
+        if not key or key == configured_spreadsheet_ids().get(title): raise
+        sh = get_client().open(title)  # file ricreato: ID risolto di nuovo dal titolo
+    with h['lock']:
+        h['spreadsheets'][title] = sh
+        h['ids'][title] = sh.id
+    return sh
+
+def _open_worksheet(spreadsheet, worksheet=None):
+    h, key = _sheet_handles(), (spreadsheet, worksheet)
+    with h['lock']: ws = h['worksheets'].get(key)
+    if ws is None:
+        sh = open_spreadsheet(spreadsheet)
+        ws = sh.worksheet(worksheet) if worksheet else sh.sheet1
+        with h['lock']: h['worksheets'][key] = ws
+    return ws
+
+def forget_sheet_handles(spreadsheet):
+    """Dopo un errore che non sia di quota (foglio rinominato, permessi...) si riapre al prossimo giro."""
+    h = _sheet_handles()
+    with h['lock']:
+        h['spreadsheets'].pop(spreadsheet, None)
+        for key in [k for k in h['worksheets'] if k[0] == spreadsheet]: h['worksheets'].pop(key)
+
+def batch_read(spreadsheet, ranges):
+    """Più range, anche di fogli diversi dello stesso file, con una sola values_batch_get -> liste di righe."""
+    res = open_spreadsheet(spreadsheet).values_batch_get(ranges)
+    return [vr.get('values', []) for vr in res.get('valueRanges', [])]
+
+def a1(worksheet, rng=""):
+    """'CLIENTI_ATTIVI' -> "'CLIENTI_ATTIVI'!A1:B" (il foglio intero se rng è vuoto)."""
+    title = worksheet.replace("'", "''")
+    return f"'{title}'!{rng}" if rng else f"'{title}'"
+
+def records_from_values(values):
+    """Come get_all_records(numericise_ignore=['all']): prima riga = intestazioni, testo grezzo, righe corte completate."""
+    if not values: return []
+    values = gspread.utils.fill_gaps(values)
+    return gspread.utils.to_records(values[0], values[1:])
+
+def _sheet_entry(spreadsheet, worksheet=None, ttl=SHEET_CACHE_TTL):
+    cache, key = _sheet_cache(), (spreadsheet, worksheet)
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry and time.time() - entry['at'] < ttl:
+            cache['stats']['hits'] += 1
+            return entry
+        key_lock = cache['key_locks'].setdefault(key, threading.Lock())
+    with key_lock:
+        with cache['lock']:
+            entry = cache['entries'].get(key)
+            if entry and time.time() - entry['at'] < ttl:  # caricato da un'altra sessione mentre aspettavamo
+                cache['stats']['waits'] += 1
+                return entry
+            cache['stats']['misses'] += 1
+            gen = cache['generation'].get(key, 0)
+        # Testo grezzo come nella replica: numericise trasformerebbe "80,0" in 800
+        try: records = _open_worksheet(spreadsheet, worksheet).get_all_records(numericise_ignore=['all'])
+        except Exception as e:
+            with cache['lock']: cache['stats']['errors'] += 1
+            if api_status(e) != 429 and not isinstance(e, SheetsBusyError): forget_sheet_handles(spreadsheet)
+            raise
+        entry = {'records': records, 'at': time.time(), 'derived': {}}
+        with cache['lock']:
+            # Se nel frattempo c'è stata una scrittura, il dato letto è già vecchio: non lo salviamo
+            if cache['generation'].get(key, 0) == gen: cache['entries'][key] = entry
+        return entry
+
+def sheet_cached(spreadsheet, worksheet=None, ttl=SHEET_CACHE_TTL):
+    cache = _sheet_cache()
+    with cache['lock']:
+        entry = cache['entries'].get((spreadsheet, worksheet))
+        return bool(entry) and time.time() - entry['at'] < ttl
+
+def put_sheet_records(spreadsheet, worksheet, records):
+    """Snapshot letto da un'altra strada (es. values_batch_get di più fogli insieme)."""
+    cache, key = _sheet_cache(), (spreadsheet, worksheet)
+    with cache['lock']: cache['entries'][key] = {'records': records, 'at': time.time(), 'derived': {}}
+
+def get_sheet_records(spreadsheet, worksheet=None, ttl=SHEET_CACHE_TTL):
+    """get_all_records() dallo snapshot condiviso. Il risultato è in sola lettura."""
+    return _sheet_entry(spreadsheet, worksheet, ttl)['records']
+
+def get_sheet_derived(spreadsheet, worksheet, name, build, ttl=SHEET_CACHE_TTL):
+    """Dato derivato (DataFrame, indici...) calcolato una volta per snapshot del foglio."""
+    entry = _sheet_entry(spreadsheet, worksheet, ttl)
+    if name not in entry['derived']: entry['derived'][name] = build(entry['records'])
+    return entry['derived'][name]
+
+def invalidate_sheet(spreadsheet, worksheet=None):
+    """Da chiamare dopo ogni scrittura fatta dall'app sul foglio."""
+    cache, key = _sheet_cache(), (spreadsheet, worksheet)
+    with cache['lock']:
+        cache['generation'][key] = cache['generation'].get(key, 0) + 1
+        cache['entries'].pop(key, None)
+        cache['stats']['invalidations'] += 1
+
+def sheet_cache_stats():
+    cache = _sheet_cache()
+    with cache['lock']:
+        stats = dict(cache['stats'])
+        stats['cached_sheets'] = [f"{k[0]}/{k[1] or 'sheet1'}" for k in cache['entries']]
+    return stats
 
 def clean_json_response(text):
     if not text: return "{}"
@@ -64,307 +433,2183 @@ def clean_json_response(text):
         return text
     except: return text
 
+NUM_RE = r"([-+]?\d*\.\d+|\d+)"
+
 def clean_num(val):
     if not val: return 0.0
     s = str(val).lower().replace(',', '.').replace('kg', '').replace('cm', '').strip()
     try: 
-        match = re.search(r"[-+]?\d*\.\d+|\d+", s)
+        match = re.search(NUM_RE, s)
         return float(match.group()) if match else 0.0
     except: return 0.0
 
+def clean_num_series(col):
+    # Stessa regola di clean_num, ma su tutta la colonna in un colpo solo
+    txt = col.astype(str).str.lower().str.replace(',', '.', regex=False).str.replace('kg', '', regex=False).str.replace('cm', '', regex=False)
+    return pd.to_numeric(txt.str.extract(NUM_RE, expand=False), errors='coerce').fillna(0.0).astype(float)
+
 def normalize_key(key):
     return re.sub(r'[^a-zA-Z0-9]', '', str(key).lower())
 
-def get_val(row, keywords, is_num=False):
-    row_norm = {normalize_key(k): v for k, v in row.items()}
-    for kw in keywords:
-        kw_norm = normalize_key(kw)
-        for k_row, v_row in row_norm.items():
-            if kw_norm in k_row:
-                if is_num: return clean_num(v_row)
-                return str(v_row).strip()
-    return 0.0 if is_num else ""
-
+METRICS_MAP = {
+    "Peso": ["Peso"], "Collo": ["Collo"], "Torace": ["Torace"], "Addome": ["Addome"], "Fianchi": ["Fianchi"],
+    "Braccio Sx": ["Braccio Sx"], "Braccio Dx": ["Braccio Dx"],
+    "Coscia Sx": ["Coscia Sx"], "Coscia Dx": ["Coscia Dx"],
+    "Polpaccio Sx": ["Polpaccio Sx"], "Polpaccio Dx": ["Polpaccio Dx"]
+}
+# Dati anagrafici che servono solo ai trend (es. BF Navy), non sono misure da confrontare
+PROFILE_MAP = {"Altezza": ["Altezza"], "Sesso": ["Sesso", "Genere"]}
+
+@st.cache_data(show_spinner=False)
+def resolve_metric_columns(header):
+    """Header del foglio (tupla) -> {metrica: colonna}. Prima colonna che contiene la keyword normalizzata."""
+    norm = [(h, normalize_key(h)) for h in header]
+    cols = {}
+    for label, kws in {**METRICS_MAP, **PROFILE_MAP}.items():
+        for kw in kws:
+            kw_norm = normalize_key(kw)
+            match = next((h for h, h_norm in norm if kw_norm in h_norm), None)
+            if match is not None:
+                cols[label] = match
+                break
+    return cols
+
+HISTORY_SOURCES = (('anamnesi', "BIO ENTRY ANAMNESI", 'ANAMNESI'), ('checkup', "BIO CHECK-UP", 'CHECKUP'))
+
+def email_column(df):
+    return 'E-mail' if 'E-mail' in df.columns else ('Email' if 'Email' in df.columns else None)
+
+def history_entries(rows, source):
+    """Righe del foglio -> misure pulite, con le stesse colonne per ANAMNESI e CHECK-UP."""
+    cols = resolve_metric_columns(tuple(rows.columns))
+    out = pd.DataFrame(index=rows.index)
+    out['Date'] = rows['Submitted at'] if 'Submitted at' in rows.columns else '01/01/2000'
+    out['Source'] = source
+    for label in METRICS_MAP:
+        out[label] = clean_num_series(rows[cols[label]]) if label in cols else 0.0
+    out['Altezza'] = clean_num_series(rows[cols['Altezza']]) if 'Altezza' in cols else 0.0
+    out['Sesso'] = rows[cols['Sesso']].astype(str).str.strip() if 'Sesso' in cols else ''
+    return out
+
+def history_index(df, source):
+    """Foglio intero -> {email normalizzata: [misure pulite]}. Pulizia fatta una volta per snapshot/versione della replica."""
+    mail_col = email_column(df) if not df.empty else None
+    if mail_col is None: return {}
+    emails = df[mail_col].astype(str).str.strip().str.lower()
+    index = {}
+    for email, rec in zip(emails, history_entries(df, source).to_dict('records')): index.setdefault(email, []).append(rec)
+    return index
+
+# Risorsa e non cache_data: l'indice è condiviso in sola lettura, senza ricopiarlo a ogni atleta
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _replica_history_index(table, source, replica_version):
+    return history_index(replica_frame(table), source)
+
+@traced('data.full_history')
 def get_full_history(email):
-    client = get_client()
     history = []
     clean_email = str(email).strip().lower()
 
-    metrics_map = {
-        "Peso": ["Peso"], "Collo": ["Collo"], "Torace": ["Torace"], "Addome": ["Addome"], "Fianchi": ["Fianchi"],
-        "Braccio Sx": ["Braccio Sx"], "Braccio Dx": ["Braccio Dx"],
-        "Coscia Sx": ["Coscia Sx"], "Coscia Dx": ["Coscia Dx"],
-        "Polpaccio Sx": ["Polpaccio Sx"], "Polpaccio Dx": ["Polpaccio Dx"]
-    }
+    for table, sheet, source in HISTORY_SOURCES:
+        try:
+            if replica_ready(table): index = _replica_history_index(table, source, replica_version(table))
+            else: index = get_sheet_derived(sheet, None, 'history', lambda records, src=source: history_index(pd.DataFrame(records), src))
+            history += [dict(rec) for rec in index.get(clean_email, [])]
+        except SheetsBusyError: raise
+        except Exception: trace_count(f"errors.history.{table}")
 
-    try:
-        sh = client.open("BIO ENTRY ANAMNESI").sheet1
-        for r in sh.get_all_records():
-            if str(r.get('E-mail', r.get('Email',''))).strip().lower() == clean_email:
-                entry = {'Date': r.get('Submitted at', '01/01/2000'), 'Source': 'ANAMNESI'}
-                for label, kws in metrics_map.items(): entry[label] = get_val(r, kws, True)
-                history.append(entry)
-    except: pass
+    return history
 
-    try:
-        sh = client.open("BIO CHECK-UP").sheet1
-        for r in sh.get_all_records():
-            if str(r.get('E-mail', r.get('Email',''))).strip().lower() == clean_email:
-                entry = {'Date': r.get('Submitted at', '01/01/2000'), 'Source': 'CHECKUP'}
-                for label, kws in metrics_map.items(): entry[label] = get_val(r, kws, True)
-                history.append(entry)
-    except: pass
+# ==============================================================================
+# 1b. STORE SCHEDE (INDICE EMAIL -> RIGHE DI SCHEDE_ATTIVE)
+# ==============================================================================
+# SCHEDE_ATTIVE è append-only: teniamo in memoria (condiviso tra sessioni) solo
+# l'indice email -> [(riga, data)], aggiornato leggendo le sole righe nuove.
+# Il login legge poi UNA riga per range, indipendentemente da quanto è grande il foglio.
+PLANS_DB, PLANS_WS = "AREA199_DB", "SCHEDE_ATTIVE"
+PLAN_COLUMNS = ["Data", "Email", "Nome", "Commento", "JSON_Scheda", "JSON_Dieta"]  # ordine scritto dall'app
+PLAN_INDEX_TTL = 60  # secondi tra due controlli di righe aggiunte da fuori app
 
-    return history
+@st.cache_resource
+def _plan_index():
+    return {'lock': threading.Lock(), 'header': [], 'rows': 1, 'by_email': {}, 'synced_at': 0.0, 'tail': ""}
+
+def _col_letter(n):
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def _plans_ws():
+    return _open_worksheet(PLANS_DB, PLANS_WS)
+
+def _index_rows(idx, start_row, dates, emails):
+    for i in range(max(len(dates), len(emails))):
+        d = dates[i][0] if i < len(dates) and dates[i] else ""
+        e = str(emails[i][0]).strip().lower() if i < len(emails) and emails[i] else ""
+        if e: idx['by_email'].setdefault(e, []).append((start_row + i, d))
+        idx['tail'] = e
+    idx['rows'] = start_row + max(len(dates), len(emails)) - 1
+
+def _reset_plan_index(idx):
+    idx.update(header=[], rows=1, by_email={}, tail="")
+
+def _tail_moved(idx, emails):
+    """La prima riga letta è l'ultima già indicizzata: se non ha più la stessa email il foglio
+    è stato accorciato o riordinato a mano e i numeri di riga dell'indice non valgono più."""
+    e = str(emails[0][0]).strip().lower() if emails and emails[0] else ""
+    return e != idx['tail']
+
+def sync_plan_index(ws=None, force=False, rebuild=False):
+    """Aggiunge all'indice solo le righe scritte dopo l'ultima sincronizzazione; lo ricostruisce
+    dalla riga 2 se richiesto o se l'ultima riga indicizzata non è più al suo posto."""
+    idx = _plan_index()
+    with idx['lock']:
+        if not force and idx['header'] and time.time() - idx['synced_at'] < PLAN_INDEX_TTL:
+            return idx
+        ws = ws or _plans_ws()
+        if rebuild: _reset_plan_index(idx)
+        if not idx['header']:
+            idx['header'] = ws.row_values(1)
+        header = idx['header']
+        c_date = _col_letter(header.index('Data') + 1)
+        c_mail = _col_letter(header.index('Email') + 1)
+        # si rilegge anche l'ultima riga già indicizzata, come controllo
+        start = idx['rows'] + 1 if idx['rows'] < 2 else idx['rows']
+        dates, emails = ws.batch_get([f"{c_date}{start}:{c_date}", f"{c_mail}{start}:{c_mail}"])
+        if start == idx['rows']:
+            if _tail_moved(idx, emails):
+                trace_count("plans.index_rebuild")
+                _reset_plan_index(idx)
+                idx['header'] = header
+                start = 2
+                dates, emails = ws.batch_get([f"{c_date}2:{c_date}", f"{c_mail}2:{c_mail}"])
+            else: start, dates, emails = start + 1, dates[1:], emails[1:]
+        _index_rows(idx, start, dates, emails)
+        idx['synced_at'] = time.time()
+        return idx
+
+# --- FORMATO COMPATTO DELLE CELLE JSON_Scheda / JSON_Dieta ---
+# v1: JSON senza spazi con "_v", immagini come ID esercizio del free-exercise-db ("i" + numero
+# di foto "k") e senza i campi che servono solo al matching/debug. Oltre PAYLOAD_COMPRESS_OVER
+# caratteri la cella diventa "Z1:" + base64(zlib(json)). Le righe vecchie (JSON verboso o repr
+# Python) si leggono ancora: decode_plan_payload fa da lettore di migrazione.
+PAYLOAD_VERSION = 1
+PAYLOAD_COMPRESS_OVER = 4000      # caratteri; il limite di una cella Sheets è 50000
+PAYLOAD_DROP_FIELDS = ('debug_info', 'search_name')
+
+def _pack_images(ex):
+    """[BASE/<id>/0.jpg, BASE/<id>/1.jpg] -> {'i': id, 'k': 2}; URL non standard restano come sono."""
+    imgs = ex.get('images') or []
+    if not imgs: return {}
+    ex_id = imgs[0][len(EXERCISE_IMG_BASE):].split('/')[0] if imgs[0].startswith(EXERCISE_IMG_BASE) else ""
+    if ex_id and imgs == [f"{EXERCISE_IMG_BASE}{ex_id}/{n}.jpg" for n in range(len(imgs))]: return {'i': ex_id, 'k': len(imgs)}
+    return {'images': imgs}
+
+def _unpack_images(ex):
+    if 'i' in ex:
+        ex_id, count = ex.pop('i'), ex.pop('k', 1)
+        ex['images'] = [f"{EXERCISE_IMG_BASE}{ex_id}/{n}.jpg" for n in range(count)]
+    return ex
+
+def _compact_exercise(ex):
+    out = {k: v for k, v in ex.items() if k not in PAYLOAD_DROP_FIELDS and k != 'images'}
+    out.update(_pack_images(ex))
+    return out
+
+def encode_plan_payload(obj):
+    """Scheda o dieta -> testo compatto e versionato per la cella."""
+    if not obj: return ""
+    obj = dict(obj)
+    if 'sessions' in obj:
+        obj['sessions'] = [dict(sess, exercises=[_compact_exercise(ex) for ex in sess.get('exercises', [])]) for sess in obj['sessions']]
+    text = json.dumps(dict(obj, _v=PAYLOAD_VERSION), ensure_ascii=False, separators=(',', ':'))
+    if len(text) <= PAYLOAD_COMPRESS_OVER: return text
+    return f"Z{PAYLOAD_VERSION}:" + base64.b64encode(zlib.compress(text.encode('utf-8'), 9)).decode('ascii')
+
+@traced('plan.decode')
+def decode_plan_payload(raw):
+    """Cella -> dict. Gestisce v1 (anche compressa) e le righe vecchie (JSON verboso o repr Python)."""
+    raw = str(raw or "").strip()
+    if not raw: return None
+    if raw.startswith("Z") and ":" in raw[:4]:
+        raw = zlib.decompress(base64.b64decode(raw.split(":", 1)[1])).decode('utf-8')
+    try: obj = json.loads(raw)
+    except ValueError: obj = ast.literal_eval(raw)  # righe scritte prima del JSON: repr di dict Python
+    if not isinstance(obj, dict) or '_v' not in obj: return obj
+    version = obj.pop('_v')
+    if version > PAYLOAD_VERSION: raise ValueError(f"Formato scheda v{version} non supportato da questa versione dell'app.")
+    for sess in obj.get('sessions', []):
+        for ex in sess.get('exercises', []): _unpack_images(ex)
+    return obj
+
+@traced('login.prime_sheets')
+def prime_login_sheets():
+    """Login senza replica: snapshot abbonamenti e righe nuove dell'indice schede con UNA values_batch_get su AREA199_DB."""
+    need_subs = not replica_ready('clienti') and not sheet_cached(PLANS_DB, "CLIENTI_ATTIVI", SUBSCRIPTION_TTL)
+    idx = _plan_index()
+    need_idx = not replica_ready('schede') and (not idx['header'] or time.time() - idx['synced_at'] >= PLAN_INDEX_TTL)
+    if not (need_subs or need_idx): return
+    header, start = idx['header'] or PLAN_COLUMNS, idx['rows'] + 1 if idx['rows'] < 2 else idx['rows']
+    try:
+        c_date, c_mail = header.index('Data'), header.index('Email')
+        lo, hi = min(c_date, c_mail), max(c_date, c_mail)
+        ranges = ([a1("CLIENTI_ATTIVI")] if need_subs else []) + \
+                 ([a1(PLANS_WS, "1:1"), a1(PLANS_WS, f"{_col_letter(lo + 1)}{start}:{_col_letter(hi + 1)}")] if need_idx else [])
+        blocks = batch_read(PLANS_DB, ranges)
+    except Exception: return  # si ripiega sulle letture normali
+    if need_subs: put_sheet_records(PLANS_DB, "CLIENTI_ATTIVI", records_from_values(blocks.pop(0)))
+    if not need_idx: return
+    head = blocks[0][0] if blocks[0] else []
+    # Colonne diverse da quelle ipotizzate (foglio mai indicizzato): ci pensa sync_plan_index
+    if 'Data' not in head or 'Email' not in head or (head.index('Data'), head.index('Email')) != (c_date, c_mail): return
+    cell = lambda r, c: [r[c - lo]] if len(r) > c - lo else []
+    rows = blocks[1]
+    with idx['lock']:
+        if (idx['rows'] if idx['rows'] >= 2 else idx['rows'] + 1) != start: return
+        if start == idx['rows']:
+            # ultima riga indicizzata spostata: ricostruzione completa in sync_plan_index
+            if _tail_moved(idx, [cell(r, c_mail) for r in rows[:1]]): idx['synced_at'] = 0.0; return
+            start, rows = start + 1, rows[1:]
+        idx['header'] = idx['header'] or head
+        _index_rows(idx, start, [cell(r, c_date) for r in rows], [cell(r, c_mail) for r in rows])
+        idx['synced_at'] = time.time()
+
+def get_plan_history(email):
+    """Versioni della scheda per atleta: lista [(riga, data)] dalla più vecchia alla più recente."""
+    if replica_ready('schede'): return replica_versions('schede', email, 'Data')
+    idx = sync_plan_index()
+    return list(idx['by_email'].get(str(email).strip().lower(), []))
+
+def read_plan_row(row, ws=None, email=None):
+    """Riga di SCHEDE_ATTIVE come dict. Con email, None se la riga non è di quell'atleta
+    (righe cancellate o riordinate a mano dopo l'indicizzazione)."""
+    rec = replica_row('schede', row) if replica_ready('schede') else None
+    if rec is None:
+        idx = sync_plan_index(ws)
+        ws = ws or _plans_ws()
+        vals = ws.row_values(row)
+        header = idx['header']
+        rec = dict(zip(header, vals + [""] * (len(header) - len(vals))))
+    if email is not None and str(rec.get('Email', '')).strip().lower() != str(email).strip().lower():
+        trace_count("errors.plans.row_mismatch")
+        return None
+    return rec
+
+def rebuild_plan_index():
+    """Numeri di riga non più validi: replica delle schede (se in uso) o indice riletti da capo."""
+    if replica_ready('schede'):
+        rep = _replica()
+        with rep['sync_lock']: sync_replica_tables(rep, ['schede'], force_full=True)
+    else: sync_plan_index(force=True, rebuild=True)
+
+@traced('login.latest_plan')
+def get_latest_plan(email):
+    for _ in range(2):
+        versions = get_plan_history(email)
+        if not versions: return None
+        rec = read_plan_row(versions[-1][0], email=email)
+        if rec is not None: return rec
+        rebuild_plan_index()
+    return None
+
+def appended_first_row(res):
+    """Es. "SCHEDE_ATTIVE!A57:F60" -> 57 (prima riga scritta), None se non leggibile."""
+    try: return int(re.search(r"![A-Z]+(\d+)", res['updates']['updatedRange']).group(1))
+    except Exception: return None
+
+def append_plans(rows):
+    """Scrive più schede con una sola append_rows. Se append_rows riesce, le righe sono scritte:
+    l'aggiornamento di indice e replica non deve mai far credere il contrario (reinvio = doppione)."""
+    ws = _plans_ws()
+    res = ws.append_rows(rows)
+    invalidate_sheet(PLANS_DB, PLANS_WS)
+    row = appended_first_row(res)
+    try:
+        if row: replica_note_append('schede', row, rows)
+        idx = _plan_index()
+        with idx['lock']:
+            # se sono le righe successive le indicizziamo subito, altrimenti rilettura incrementale
+            if idx['header'] and row == idx['rows'] + 1:
+                _index_rows(idx, row, [[v[0]] for v in rows], [[v[1]] for v in rows])
+                return res
+        sync_plan_index(ws, force=True)
+    except Exception:
+        # righe già scritte: l'indice si riallinea alla prossima sync, la replica al prossimo giro
+        trace_count("errors.plans.index")
+        log.exception("SCHEDE_ATTIVE: aggiornamento indice/replica dopo append_rows fallito")
+    return res
 
 # ==============================================================================
-# 2. MOTORE AI & IMMAGINI
+# 1c. REPLICA LOCALE SQLITE (SYNC INCREMENTALE DEI FOGLI)
 # ==============================================================================
-@st.cache_data(ttl=3600)
-def load_exercise_db():
-    try: 
-        resp = requests.get("https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/dist/exercises.json", timeout=20)
-        if resp.status_code == 200:
-            data = resp.json()
-            return sorted(data, key=lambda x: x['name'])
-        return []
-    except: return []
+# Copia locale indicizzata per email dei fogli principali. Un thread in background scarica
+# solo le righe aggiunte dopo l'ultimo watermark (numero di righe già copiate); le letture
+# (storico, roster, abbonamenti, schede) sono query locali e continuano a funzionare anche
+# se Google non risponde. Finché una tabella non è mai stata sincronizzata si legge dai fogli.
+REPLICA_DB = os.path.join(CACHE_DIR, "replica.sqlite")
+REPLICA_SYNC_INTERVAL = 60        # secondi tra due sync incrementali
+REPLICA_FULL_RESYNC = 6 * 3600    # rilettura completa periodica (righe cancellate/modificate a mano)
+REPLICA_PAGE_ROWS = 5000
+REPLICA_TABLES = {
+    'anamnesi': {'spreadsheet': "BIO ENTRY ANAMNESI", 'worksheet': None, 'mode': 'append'},
+    'checkup': {'spreadsheet': "BIO CHECK-UP", 'worksheet': None, 'mode': 'append'},
+    # CLIENTI_ATTIVI viene modificato a mano (rinnovi): sempre rilettura completa
+    'clienti': {'spreadsheet': "AREA199_DB", 'worksheet': "CLIENTI_ATTIVI", 'mode': 'full'},
+    'schede': {'spreadsheet': PLANS_DB, 'worksheet': PLANS_WS, 'mode': 'append'},
+}
 
-def find_exercise_images(name_query, db_exercises):
-    if not db_exercises or not name_query: return ([], "DB/Query Vuota")
-    BASE_URL = "https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/exercises/"
-    q = name_query.lower().strip()
-
-    synonyms = {
-        "lying leg curl": "lying leg curls",
-        "leg curl": "lying leg curls",
-        "leg extension": "leg extensions",
-        "leg press": "leg press",
-        "calf raise": "calf raise",
-        "hip adduction": "adductor",
-        "adduction": "adductor",
-        "reverse pec deck": "reverse fly",
-        "t-bar": "t-bar",
-        "lat pulldown": "pulldown",
-        "straight arm": "straight-arm pulldown",
-        "cable row": "seated cable row",
-        "hyperextension": "hyperextension",
-        "pec deck": "butterfly",
-        "chest press": "chest press",
-        "face pull": "face pull",
-        "lateral raise": "lateral raise",
-        "pushdown": "pushdown",
-        "triceps pushdown": "pushdown",
-        "preacher curl": "preacher curl",
-        "overhead cable": "overhead triceps",
-        "side plank": ["side plank", "side bridge"],
-        "plank": "plank",
-        "dead bug": "dead bug",
-        "vacuum": "stomach vacuum"
+@st.cache_resource
+def _replica():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(REPLICA_DB, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS replica_meta (tbl TEXT PRIMARY KEY, header TEXT, rows INTEGER, synced_at REAL, full_at REAL, error TEXT)")
+    for table in REPLICA_TABLES:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (row INTEGER PRIMARY KEY, email TEXT, data TEXT)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_email ON {table} (email)")
+    conn.commit()
+    # versione per tabella: le cache derivate si ricalcolano solo quando cambiano le righe di quella tabella
+    rep = {'conn': conn, 'lock': threading.Lock(), 'sync_lock': threading.Lock(),
+           'versions': {t: 0 for t in REPLICA_TABLES}, 'hashes': {}}
+    threading.Thread(target=_replica_loop, args=(rep,), daemon=True).start()
+    return rep
+
+def _replica_loop(rep):
+    _sheets_governor()['local'].priority = 'background'
+    while True:
+        sync_replica(rep)
+        time.sleep(REPLICA_SYNC_INTERVAL)
+
+def _replica_meta(rep, table):
+    with rep['lock']:
+        row = rep['conn'].execute("SELECT header, rows, synced_at, full_at, error FROM replica_meta WHERE tbl = ?", (table,)).fetchone()
+    if not row: return None
+    return {'header': json.loads(row[0] or "[]"), 'rows': row[1] or 1, 'synced_at': row[2] or 0.0, 'full_at': row[3] or 0.0, 'error': row[4] or ""}
+
+def _replica_record(header, vals):
+    rec = dict(zip(header, list(vals) + [""] * (len(header) - len(vals))))
+    email = str(rec.get('E-mail', rec.get('Email', ''))).strip().lower()
+    return email, json.dumps(rec, ensure_ascii=False)
+
+def _replica_write(rep, table, header, start_row, rows, full):
+    now = time.time()
+    # rilettura completa identica alla precedente (es. CLIENTI_ATTIVI ogni minuto): solo i metadati
+    digest = hashlib.sha1(json.dumps([header, rows], ensure_ascii=False).encode()).hexdigest() if full else None
+    unchanged = full and rep['hashes'].get(table) == digest
+    with rep['lock']:
+        conn = rep['conn']
+        meta = conn.execute("SELECT full_at FROM replica_meta WHERE tbl = ?", (table,)).fetchone()
+        if not unchanged:
+            if full: conn.execute(f"DELETE FROM {table}")
+            conn.executemany(f"INSERT OR REPLACE INTO {table} (row, email, data) VALUES (?, ?, ?)",
+                             [(start_row + i, *_replica_record(header, vals)) for i, vals in enumerate(rows)])
+        conn.execute("INSERT OR REPLACE INTO replica_meta VALUES (?, ?, ?, ?, ?, '')",
+                     (table, json.dumps(header), start_row + len(rows) - 1, now, now if full else (meta[0] if meta else now)))
+        conn.commit()
+        if full: rep['hashes'][table] = digest
+        else: rep['hashes'].pop(table, None)
+        if not unchanged and (rows or full): rep['versions'][table] += 1
+
+def replica_version(*tables):
+    """Versioni delle tabelle indicate, da usare come chiave delle cache derivate."""
+    versions = _replica()['versions']
+    return tuple(versions[t] for t in tables)
+
+def _replica_apply(rep, table, ws, meta, full, blocks):
+    if full:
+        values = blocks[0]
+        _replica_write(rep, table, values[0] if values else [], 2, values[1:], True)
+        return
+    start = meta['rows'] + 1
+    header_r, rows = blocks
+    header = header_r[0] if header_r else []
+    if header[:len(meta['header'])] != meta['header']:
+        # Colonne rinominate o spostate: il watermark non basta più
+        return sync_replica_tables(rep, [table], force_full=True)
+    rows = list(rows)
+    while len(rows) and len(rows) % REPLICA_PAGE_ROWS == 0:
+        page = ws.get(f"{start + len(rows)}:{start + len(rows) + REPLICA_PAGE_ROWS - 1}")
+        if not page: break
+        rows += list(page)
+    _replica_write(rep, table, header, start, rows, False)
+
+@traced('replica.sync')
+def sync_replica_tables(rep, tables, force_full=False):
+    """Tabelle dello stesso file (es. CLIENTI_ATTIVI + SCHEDE_ATTIVE): tutti i range in una values_batch_get."""
+    spreadsheet = REPLICA_TABLES[tables[0]]['spreadsheet']
+    jobs, ranges = [], []
+    for table in tables:
+        cfg = REPLICA_TABLES[table]
+        meta = _replica_meta(rep, table)
+        ws = _open_worksheet(spreadsheet, cfg['worksheet'])
+        full = force_full or cfg['mode'] == 'full' or not meta or time.time() - meta['full_at'] > REPLICA_FULL_RESYNC
+        if full: table_ranges = [a1(ws.title)]
+        else:
+            start = meta['rows'] + 1
+            table_ranges = [a1(ws.title, "1:1"), a1(ws.title, f"{start}:{start + REPLICA_PAGE_ROWS - 1}")]
+        jobs.append((table, ws, meta, full, len(ranges), len(table_ranges)))
+        ranges += table_ranges
+    blocks = batch_read(spreadsheet, ranges)
+    for table, ws, meta, full, i, n in jobs:
+        _replica_apply(rep, table, ws, meta, full, blocks[i:i + n])
+
+def sync_replica(rep=None):
+    rep = rep or _replica()
+    groups = {}
+    for table, cfg in REPLICA_TABLES.items(): groups.setdefault(cfg['spreadsheet'], []).append(table)
+    with rep['sync_lock']:
+        for spreadsheet, tables in groups.items():
+            try: sync_replica_tables(rep, tables)
+            except Exception as e:
+                if api_status(e) != 429 and not isinstance(e, SheetsBusyError): forget_sheet_handles(spreadsheet)
+                # Si continua a servire l'ultima copia buona: annotiamo solo l'errore
+                with rep['lock']:
+                    for table in tables:
+                        rep['conn'].execute("INSERT INTO replica_meta (tbl, error) VALUES (?, ?) ON CONFLICT(tbl) DO UPDATE SET error = excluded.error", (table, str(e)))
+                    rep['conn'].commit()
+
+def replica_ready(table):
+    meta = _replica_meta(_replica(), table)
+    return bool(meta and meta['header'])
+
+def replica_header(table):
+    meta = _replica_meta(_replica(), table)
+    return meta['header'] if meta else []
+
+def _replica_query(table, where="", params=()):
+    rep = _replica()
+    with rep['lock']:
+        return rep['conn'].execute(f"SELECT row, data FROM {table} {where} ORDER BY row", params).fetchall()
+
+def replica_rows(table, email=None):
+    """Righe della replica come dict (ordine del foglio); con email usa l'indice."""
+    rows = _replica_query(table, "WHERE email = ?", (str(email).strip().lower(),)) if email is not None else _replica_query(table)
+    return [json.loads(data) for _, data in rows]
+
+def replica_frame(table, email=None):
+    return pd.DataFrame(replica_rows(table, email), columns=replica_header(table))
+
+def replica_row(table, row):
+    found = _replica_query(table, "WHERE row = ?", (row,))
+    return json.loads(found[0][1]) if found else None
+
+def replica_versions(table, email, date_col):
+    return [(row, json.loads(data).get(date_col, "")) for row, data in _replica_query(table, "WHERE email = ?", (str(email).strip().lower(),))]
+
+def replica_emails(table):
+    rep = _replica()
+    with rep['lock']:
+        return [r[0] for r in rep['conn'].execute(f"SELECT DISTINCT email FROM {table} WHERE email != ''").fetchall()]
+
+def replica_note_append(table, row, rows):
+    """Scrittura fatta dall'app: le righe entrano subito nella replica se partono dal watermark."""
+    rep = _replica()
+    meta = _replica_meta(rep, table)
+    if meta and meta['header'] and row == meta['rows'] + 1:
+        _replica_write(rep, table, meta['header'], row, rows, False)
+
+def replica_status():
+    rep = _replica()
+    status = {'versions': dict(rep['versions'])}
+    for table in REPLICA_TABLES:
+        meta = _replica_meta(rep, table) or {}
+        status[table] = {k: v for k, v in meta.items() if k != 'header'}
+    return status
+
+# ==============================================================================
+# 1d. TREND METRICHE (SERIE STORICHE PER ATLETA)
+# ==============================================================================
+# Lo storico ANAMNESI + CHECK-UP diventa un DataFrame indicizzato per giorno:
+# medie mobili, velocità settimanale e proiezione lineare sono calcolate su
+# tutte le colonne insieme (niente cicli sulle righe) e memoizzate sull'hash
+# dello snapshot dell'atleta.
+TREND_ROLLING = "14D"       # finestra della media mobile
+TREND_FIT_DAYS = 56         # giorni usati per la retta di tendenza
+TREND_HORIZON_DAYS = 28     # orizzonte della proiezione
+BF_LABEL = "BF % (Navy)"
+
+def parse_submitted_at(col):
+    """'Submitted at' -> datetime. Prima ISO (Tally), poi gg/mm/aaaa; illeggibili -> NaT."""
+    col = col.astype(str).str.strip()
+    iso = pd.to_datetime(col, format='ISO8601', errors='coerce', utc=True)
+    rest = pd.to_datetime(col.where(iso.isna()), format='mixed', dayfirst=True, errors='coerce', utc=True)
+    return iso.fillna(rest).dt.tz_localize(None)
+
+def normalize_sex(value):
+    s = str(value).strip().lower()
+    if s.startswith(('m', 'u')): return 'M'   # maschio, uomo, male
+    if s.startswith(('f', 'd', 'w')): return 'F'   # femmina, donna, female
+    return None
+
+def history_frame(history):
+    """get_full_history -> (DataFrame giornaliero, altezza, sesso). Zero = campo non compilato."""
+    metrics = list(METRICS_MAP)
+    if not history: return pd.DataFrame(columns=metrics + ['Source']), 0.0, None
+    df = pd.DataFrame(history)
+    df['Date'] = parse_submitted_at(df['Date'])
+    df = df.dropna(subset=['Date']).sort_values('Date', kind='stable')
+    if df.empty: return pd.DataFrame(columns=metrics + ['Source']), 0.0, None
+
+    # Stesso giorno in ANAMNESI e CHECK-UP (o invio doppio): resta l'ultimo valore compilato per colonna
+    frame = df[metrics].where(df[metrics] > 0)
+    frame['Source'] = df['Source']
+    frame = frame.groupby(df['Date'].dt.normalize().rename('Date')).last()
+
+    heights = df['Altezza'].where(df['Altezza'] > 0).dropna() if 'Altezza' in df else pd.Series(dtype=float)
+    sexes = df['Sesso'].map(normalize_sex).dropna() if 'Sesso' in df else pd.Series(dtype=object)
+    return frame, (float(heights.iloc[-1]) if len(heights) else 0.0), (sexes.iloc[-1] if len(sexes) else None)
+
+def navy_body_fat(frame, height, sex):
+    """Formula US Navy (cm) su tutta la serie; valori fuori scala -> NaN."""
+    neck, waist, hips = frame['Collo'], frame['Addome'], frame['Fianchi']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if sex == 'M': bf = 495 / (1.0324 - 0.19077 * np.log10(waist - neck) + 0.15456 * np.log10(height)) - 450
+        elif sex == 'F': bf = 495 / (1.29579 - 0.35004 * np.log10(waist + hips - neck) + 0.22100 * np.log10(height)) - 450
+        else: return pd.Series(np.nan, index=frame.index)
+    return bf.where((bf > 2) & (bf < 70)).round(1)
+
+def linear_fit(values, days=TREND_FIT_DAYS):
+    """Retta ai minimi quadrati per colonna sugli ultimi `days` giorni, ignorando i NaN -> (pendenza/giorno, intercetta, origine)."""
+    origin = values.index.max() - pd.Timedelta(days=days)
+    recent = values.loc[values.index >= origin]
+    x = ((recent.index - origin) / pd.Timedelta(days=1)).to_numpy(float)[:, None]
+    y = recent.to_numpy(float)
+    mask = ~np.isnan(y)
+    n = mask.sum(axis=0)
+    x_mean = np.where(mask, x, 0.0).sum(axis=0) / np.maximum(n, 1)
+    y_mean = np.where(mask, y, 0.0).sum(axis=0) / np.maximum(n, 1)
+    dx = np.where(mask, x - x_mean, 0.0)
+    sxx = (dx ** 2).sum(axis=0)
+    sxy = (dx * np.where(mask, y - y_mean, 0.0)).sum(axis=0)
+    slope = np.divide(sxy, sxx, out=np.full(len(sxx), np.nan), where=(n >= 2) & (sxx > 0))
+    return pd.Series(slope, index=values.columns), pd.Series(y_mean - slope * x_mean, index=values.columns), origin
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_trends(snapshot_key, _history):
+    """Serie, medie mobili, riepilogo per metrica e retta di tendenza. Chiave = hash dello storico."""
+    frame, height, sex = history_frame(_history)
+    if height and sex and not frame.empty: frame[BF_LABEL] = navy_body_fat(frame, height, sex)
+    metrics = [c for c in frame.columns if c != 'Source' and frame[c].notna().any()]
+    values = frame[metrics].astype(float)
+    if values.empty:
+        return {'frame': frame, 'rolling': values, 'summary': pd.DataFrame(), 'fit': None, 'profile': (height, sex)}
+
+    rolling = values.rolling(TREND_ROLLING, min_periods=1).mean()
+    slope, intercept, origin = linear_fit(values)
+    last_x = (values.index.max() - origin) / pd.Timedelta(days=1)
+
+    # Valori validi in formato lungo (data, metrica): ultimo, penultimo e primo per colonna in un colpo
+    long = values.stack().dropna()
+    by_metric = long.groupby(level=1, sort=False)
+    last = by_metric.nth(-1).droplevel(0)
+    prev = by_metric.nth(-2).droplevel(0).reindex(last.index).fillna(last)
+    first = by_metric.nth(0).droplevel(0)
+    summary = pd.DataFrame({
+        'Attuale': last,
+        'Δ prev': last - prev,
+        'Δ start': last - first,
+        'Media mobile': rolling.ffill().iloc[-1],
+        'Δ / settimana': slope * 7,
+        f'Proiezione {TREND_HORIZON_DAYS}g': intercept + slope * (last_x + TREND_HORIZON_DAYS),
+        'Misure': by_metric.size(),
+    }).reindex(metrics)
+    fit = {'slope': slope, 'intercept': intercept, 'origin': origin, 'last_x': last_x}
+    return {'frame': frame, 'rolling': rolling, 'summary': summary, 'fit': fit, 'profile': (height, sex)}
+
+@traced('data.trends')
+def get_athlete_trends(email):
+    history = get_full_history(email)
+    return history, compute_trends(content_hash(history), history)
+
+# --- COORTE (TUTTI GLI ATLETI IN UN PASSAGGIO) ---
+# ANAMNESI e CHECK-UP letti una volta sola (replica o snapshot condiviso) e raggruppati
+# per email normalizzata: niente get_full_history() per ogni atleta del roster.
+COHORT_STALL_RATE = 0.1     # kg/settimana sotto cui il peso è considerato fermo
+COHORT_STALL_MIN = 3        # misure di peso minime nella finestra per dire "fermo"
+COHORT_STALE_DAYS = 21      # giorni senza controllo oltre cui l'atleta è in ritardo
+
+def cohort_entries(df, source):
+    """Foglio intero -> misure di tutti gli atleti con Email normalizzata e Date parsata."""
+    mail_col = email_column(df) if not df.empty else None
+    if mail_col is None: return pd.DataFrame(columns=['Email', 'Date', 'Source'] + list(METRICS_MAP))
+    out = history_entries(df, source)
+    out['Email'] = df[mail_col].astype(str).str.strip().str.lower()
+    out['Date'] = parse_submitted_at(out['Date'])
+    return out.loc[(out['Email'] != '') & (out['Email'] != 'none') & out['Date'].notna()]
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _replica_cohort_entries(table, source, replica_version):
+    return cohort_entries(replica_frame(table), source)
+
+def get_cohort_entries():
+    """(controlli di tutti gli atleti, fogli che non si sono potuti leggere)."""
+    parts, failed = [], []
+    for table, sheet, source in HISTORY_SOURCES:
+        try:
+            if replica_ready(table): parts.append(_replica_cohort_entries(table, source, replica_version(table)))
+            else: parts.append(get_sheet_derived(sheet, None, 'cohort', lambda records, src=source: cohort_entries(pd.DataFrame(records), src)))
+        except SheetsBusyError: raise
+        except Exception:
+            trace_count(f"errors.cohort.{table}")
+            failed.append(sheet)
+    parts = [p for p in parts if not p.empty]
+    return (pd.concat(parts, ignore_index=True) if parts else cohort_entries(pd.DataFrame(), '')), failed
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def compute_cohort(snapshot_key, today, _entries):
+    """Statistiche per atleta (una riga per email) e di coorte, tutte con groupby vettoriali."""
+    if _entries.empty: return pd.DataFrame(), {}
+    today = pd.Timestamp(today)
+    e = _entries.assign(Day=_entries['Date'].dt.normalize()).sort_values('Date', kind='stable')
+    e['Peso'] = e['Peso'].where(e['Peso'] > 0)
+    # un controllo = un giorno, anche se compilato sia in ANAMNESI che in CHECK-UP
+    days = e.groupby(['Email', 'Day'], sort=False).agg(Peso=('Peso', 'last')).reset_index()
+
+    g = days.groupby('Email')
+    stats = pd.DataFrame({'Controlli': g.size(), 'Primo': g['Day'].min(), 'Ultimo': g['Day'].max()})
+    stats['Ultimo check-up'] = e.loc[e['Source'] == 'CHECKUP'].groupby('Email')['Day'].max()
+    stats['Giorni da ultimo'] = (today - stats['Ultimo']).dt.days
+    span = (stats['Ultimo'] - stats['Primo']).dt.days
+    stats['Ogni quanti giorni'] = (span / (stats['Controlli'] - 1)).where(stats['Controlli'] > 1).round(1)
+
+    # Peso: retta ai minimi quadrati per atleta sugli ultimi TREND_FIT_DAYS, con somme per gruppo
+    w = days.dropna(subset=['Peso'])
+    w = w.loc[w['Day'] >= w.groupby('Email')['Day'].transform('max') - pd.Timedelta(days=TREND_FIT_DAYS)]
+    w = w.assign(x=(w['Day'] - w.groupby('Email')['Day'].transform('min')) / pd.Timedelta(days=1))
+    w = w.assign(xx=w['x'] ** 2, xy=w['x'] * w['Peso'])
+    sums = w.groupby('Email')[['x', 'Peso', 'xx', 'xy']].sum()
+    n = w.groupby('Email').size()
+    sxx = sums['xx'] - sums['x'] ** 2 / n
+    sxy = sums['xy'] - sums['x'] * sums['Peso'] / n
+    stats['Misure peso'] = n.reindex(stats.index).fillna(0).astype(int)
+    stats['Δ peso / sett.'] = (sxy / sxx.where(sxx > 0) * 7).round(2)
+    wg = days.dropna(subset=['Peso']).groupby('Email')['Peso']
+    stats['Peso attuale'] = wg.last()
+    stats['Δ peso totale'] = (wg.last() - wg.first()).round(1)
+
+    stalled = (stats['Misure peso'] >= COHORT_STALL_MIN) & (stats['Δ peso / sett.'].abs() < COHORT_STALL_RATE)
+    late = stats['Giorni da ultimo'] > COHORT_STALE_DAYS
+    stats['Stato'] = np.select([late, stalled], ['IN RITARDO', 'FERMO'], 'OK')
+    stats = stats.sort_values('Giorni da ultimo', ascending=False)
+
+    weekly = days.set_index('Day').resample('W')['Email'].count()
+    summary = {
+        'atleti': len(stats),
+        'in_ritardo': int(late.sum()),
+        'fermi': int((stats['Stato'] == 'FERMO').sum()),
+        'mediana_delta_sett': float(stats['Δ peso / sett.'].median()) if stats['Δ peso / sett.'].notna().any() else None,
+        'mediana_giorni_da_ultimo': float(stats['Giorni da ultimo'].median()),
+        'controlli_settimanali': weekly,
     }
+    return stats, summary
 
-    search_terms = [q] 
-    for key in sorted(synonyms.keys(), key=len, reverse=True):
-        if key in q:
-            val = synonyms[key]
-            if isinstance(val, list): search_terms = val
-            else: search_terms = [val]
-            break
-
-    for term in search_terms:
-        candidates = []
-        for ex in db_exercises:
-            if term.lower() in ex['name'].lower():
-                candidates.append(ex)
-        if candidates:
-            best = min(candidates, key=lambda x: len(x['name']))
-            return ([BASE_URL + i for i in best.get('images', [])], f"Synonym: '{term}' -> {best['name']}")
-
-    db_names = [x['name'] for x in db_exercises]
-    match = process.extractOne(q, db_names, scorer=fuzz.token_set_ratio)
-    
-    if match and match[1] > 65:
-        bad_words = ["press", "fly", "row", "curl", "squat", "deadlift"]
+@traced('data.cohort')
+def get_cohort():
+    entries, failed = get_cohort_entries()
+    key = (len(entries), int(pd.util.hash_pandas_object(entries, index=False).sum())) if len(entries) else (0, 0)
+    return *compute_cohort(key, datetime.now().strftime("%Y-%m-%d"), entries), failed
+
+# ==============================================================================
+# 1e. CODA INVIO SCHEDE (OUTBOX LOCALE + APPEND_ROWS A LOTTI)
+# ==============================================================================
+# "INVIA" non scrive più sul foglio dentro il click: la scheda finisce in una outbox SQLite
+# (sopravvive a errori e riavvii) e un thread la consegna con append_rows, a lotti.
+# Errori temporanei (429/5xx/rete) -> nuovo tentativo con backoff esponenziale + jitter.
+# Consegna "almeno una volta": un invio interrotto a metà da un riavvio viene ritentato.
+DISPATCH_DB = os.path.join(CACHE_DIR, "outbox.sqlite")
+DISPATCH_BATCH = 50           # righe massime per append_rows
+DISPATCH_LINGER = 3           # secondi di attesa per raccogliere più schede nello stesso lotto
+DISPATCH_POLL = 15            # controllo periodico dei tentativi in attesa
+DISPATCH_BACKOFF = 2          # secondi, base del backoff (raddoppia a ogni tentativo)
+DISPATCH_BACKOFF_MAX = 300
+DISPATCH_MAX_ATTEMPTS = 8
+DISPATCH_COLUMNS = ['id', 'email', 'nome', 'stato', 'tentativi', 'errore', 'creata', 'inviata', 'riga']
+
+@st.cache_resource
+def _dispatch():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(DISPATCH_DB, check_same_thread=False)
+    conn.execute("""CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT, nome TEXT,
+                    payload TEXT, stato TEXT, tentativi INTEGER DEFAULT 0, next_at REAL DEFAULT 0, errore TEXT DEFAULT '',
+                    creata REAL, inviata REAL, riga INTEGER)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_stato ON outbox (stato, next_at)")
+    # Invii rimasti a metà dal processo precedente: tornano in coda
+    conn.execute("UPDATE outbox SET stato = 'in coda' WHERE stato = 'in invio'")
+    conn.commit()
+    box = {'conn': conn, 'lock': threading.Lock(), 'wake': threading.Event()}
+    threading.Thread(target=_dispatch_loop, args=(box,), daemon=True).start()
+    return box
+
+def enqueue_plans(rows):
+    """rows = righe di SCHEDE_ATTIVE ([Data, Email, Nome, Commento, JSON_Scheda, JSON_Dieta]) -> id in outbox."""
+    box, now = _dispatch(), time.time()
+    with box['lock']:
+        ids = [box['conn'].execute("INSERT INTO outbox (email, nome, payload, stato, creata) VALUES (?, ?, ?, 'in coda', ?)",
+                                   (r[1], r[2], json.dumps(r, ensure_ascii=False), now)).lastrowid for r in rows]
+        box['conn'].commit()
+    box['wake'].set()
+    return ids
+
+def is_retryable(err):
+    """429 e 5xx di Google, quota del governor esaurita o errori di rete: vale la pena riprovare."""
+    if isinstance(err, (SheetsBusyError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)): return True
+    status = api_status(err)
+    return status == 429 or (status is not None and status >= 500)
+
+def retry_delay(attempt):
+    """Backoff esponenziale con full jitter: uniforme tra 0 e base * 2^tentativo (con tetto)."""
+    return random.uniform(0, min(DISPATCH_BACKOFF_MAX, DISPATCH_BACKOFF * 2 ** attempt))
+
+@traced('outbox.flush')
+def flush_outbox(box=None):
+    """Consegna le schede scadute in un'unica append_rows. Ritorna quante ne ha scritte."""
+    box = box or _dispatch()
+    with box['lock']:
+        due = box['conn'].execute("SELECT id, payload, tentativi FROM outbox WHERE stato = 'in coda' AND next_at <= ? ORDER BY id LIMIT ?",
+                                  (time.time(), DISPATCH_BATCH)).fetchall()
+        if not due: return 0
+        box['conn'].executemany("UPDATE outbox SET stato = 'in invio' WHERE id = ?", [(d[0],) for d in due])
+        box['conn'].commit()
+    try:
+        res = append_plans([json.loads(d[1]) for d in due])
+    except Exception as e:
+        trace_count("errors.outbox.append")
+        record_dispatch_error(box, [(d[0], d[2]) for d in due], e, is_retryable(e))
+        return 0
+    first = appended_first_row(res)
+    now = time.time()
+    with box['lock']:
+        box['conn'].executemany("UPDATE outbox SET stato = 'inviata', inviata = ?, riga = ?, errore = '' WHERE id = ?",
+                                [(now, first + i if first else None, d[0]) for i, d in enumerate(due)])
+        box['conn'].commit()
+    return len(due)
+
+def record_dispatch_error(box, items, err, retryable):
+    """items = [(id, tentativi)]: di nuovo in coda con backoff finché ha senso riprovare, altrimenti 'fallita'."""
+    now, msg = time.time(), f"{type(err).__name__}: {err}"[:300]
+    with box['lock']:
+        for item_id, attempts in items:
+            attempts += 1
+            if retryable and attempts < DISPATCH_MAX_ATTEMPTS:
+                box['conn'].execute("UPDATE outbox SET stato = 'in coda', tentativi = ?, next_at = ?, errore = ? WHERE id = ?",
+                                    (attempts, now + retry_delay(attempts), msg, item_id))
+            else:
+                box['conn'].execute("UPDATE outbox SET stato = 'fallita', tentativi = ?, errore = ? WHERE id = ?", (attempts, msg, item_id))
+        box['conn'].commit()
+
+def _dispatch_loop(box):
+    _sheets_governor()['local'].priority = 'background'
+    while True:
+        if box['wake'].wait(DISPATCH_POLL):
+            box['wake'].clear()
+            time.sleep(DISPATCH_LINGER)
+        try:
+            while flush_outbox(box) == DISPATCH_BATCH: pass
+        except Exception as e:
+            # errore inatteso del thread: le righe rimaste 'in invio' non devono restare bloccate lì
+            trace_count("errors.outbox.loop")
+            log.exception("Outbox: invio interrotto")
+            try:
+                with box['lock']: stuck = box['conn'].execute("SELECT id, tentativi FROM outbox WHERE stato = 'in invio'").fetchall()
+                record_dispatch_error(box, stuck, e, retryable=True)
+            except Exception: log.exception("Outbox: impossibile registrare l'errore sulle righe")
+
+def retry_failed_dispatch():
+    box = _dispatch()
+    with box['lock']:
+        box['conn'].execute("UPDATE outbox SET stato = 'in coda', tentativi = 0, next_at = 0 WHERE stato = 'fallita'")
+        box['conn'].commit()
+    box['wake'].set()
+
+def dispatch_status(limit=100, email=None):
+    """Ultimi invii (più recenti prima) come DataFrame per il pannello coach."""
+    box = _dispatch()
+    where, params = ("WHERE email = ?", (email,)) if email else ("", ())
+    with box['lock']:
+        rows = box['conn'].execute(f"SELECT {', '.join(DISPATCH_COLUMNS)} FROM outbox {where} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+    df = pd.DataFrame(rows, columns=DISPATCH_COLUMNS)
+    for col in ('creata', 'inviata'): df[col] = pd.to_datetime(df[col], unit='s', errors='coerce')
+    return df
+
+# ==============================================================================
+# 2. MOTORE AI & IMMAGINI
+# ==============================================================================
+# Snapshot locale compatto del free-exercise-db: si parte sempre da disco e si
+# aggiorna in background con richieste condizionali (ETag / If-Modified-Since).
+EXERCISE_DB_URL = "https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/dist/exercises.json"
+EXERCISE_SNAPSHOT = os.path.join(CACHE_DIR, "exercises.json")
+EXERCISE_DB_TTL = 3600
+EXERCISE_FIELDS = ("id", "name", "images", "primaryMuscles", "secondaryMuscles", "equipment", "level", "category", "mechanic", "force")
+
+@st.cache_resource
+def _exercise_db_state():
+    state = {'lock': threading.Lock(), 'fetch_lock': threading.Lock(), 'data': [], 'version': '',
+             'etag': '', 'last_modified': '', 'checked_at': 0.0, 'refreshing': False, 'error': ''}
+    try:
+        with open(EXERCISE_SNAPSHOT, encoding='utf-8') as f: snap = json.load(f)
+        state.update(data=snap['exercises'], version=snap['version'], etag=snap.get('etag', ''),
+                     last_modified=snap.get('last_modified', ''), checked_at=snap.get('fetched_at', 0.0))
+    except Exception: pass
+    return state
+
+def _write_exercise_snapshot(snap):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = EXERCISE_SNAPSHOT + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f: json.dump(snap, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, EXERCISE_SNAPSHOT)
+
+def refresh_exercise_db(force=False):
+    """Scarica il DB solo se è cambiato su GitHub. In caso di errore resta valida l'ultima versione buona."""
+    state = _exercise_db_state()
+    with state['fetch_lock']:
+        # Senza snapshot si ritenta al massimo una volta al minuto
+        if not force and time.time() - state['checked_at'] < (EXERCISE_DB_TTL if state['data'] else 60):
+            return state['data']
+        headers = {}
+        if not force and state['data']:
+            if state['etag']: headers['If-None-Match'] = state['etag']
+            if state['last_modified']: headers['If-Modified-Since'] = state['last_modified']
+        try:
+            resp = requests.get(EXERCISE_DB_URL, headers=headers, timeout=20)
+            if resp.status_code == 200:
+                data = sorted(({k: x[k] for k in EXERCISE_FIELDS if k in x} for x in resp.json()), key=lambda x: x['name'])
+                snap = {'version': hashlib.md5(resp.content).hexdigest(), 'etag': resp.headers.get('ETag', ''),
+                        'last_modified': resp.headers.get('Last-Modified', ''), 'fetched_at': time.time(), 'exercises': data}
+                _write_exercise_snapshot(snap)
+                state.update(data=data, version=snap['version'], etag=snap['etag'], last_modified=snap['last_modified'], error='')
+            elif resp.status_code != 304:
+                state['error'] = f"HTTP {resp.status_code}"
+        except Exception as e:
+            state['error'] = str(e)
+        state['checked_at'] = time.time()
+        return state['data']
+
+def _refresh_exercise_db_background():
+    state = _exercise_db_state()
+    with state['lock']:
+        if state['refreshing']: return
+        state['refreshing'] = True
+
+    def run():
+        try: refresh_exercise_db()
+        finally: state['refreshing'] = False
+    threading.Thread(target=run, daemon=True).start()
+
+@traced('exercises.load_db')
+def load_exercise_db():
+    state = _exercise_db_state()
+    # Primo avvio senza snapshot su disco: unico caso in cui si aspetta GitHub
+    if not state['data']: return refresh_exercise_db()
+    if time.time() - state['checked_at'] > EXERCISE_DB_TTL: _refresh_exercise_db_background()
+    return state['data']
+
+EXERCISE_IMG_BASE = "https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/exercises/"
+
+EXERCISE_SYNONYMS = {
+    "lying leg curl": "lying leg curls",
+    "leg curl": "lying leg curls",
+    "leg extension": "leg extensions",
+    "leg press": "leg press",
+    "calf raise": "calf raise",
+    "hip adduction": "adductor",
+    "adduction": "adductor",
+    "reverse pec deck": "reverse fly",
+    "t-bar": "t-bar",
+    "lat pulldown": "pulldown",
+    "straight arm": "straight-arm pulldown",
+    "cable row": "seated cable row",
+    "hyperextension": "hyperextension",
+    "pec deck": "butterfly",
+    "chest press": "chest press",
+    "face pull": "face pull",
+    "lateral raise": "lateral raise",
+    "pushdown": "pushdown",
+    "triceps pushdown": "pushdown",
+    "preacher curl": "preacher curl",
+    "overhead cable": "overhead triceps",
+    "side plank": ["side plank", "side bridge"],
+    "plank": "plank",
+    "dead bug": "dead bug",
+    "vacuum": "stomach vacuum"
+}
+# Tabella precompilata: chiavi più lunghe prima, valori sempre liste
+SYNONYM_TABLE = [(k, v if isinstance(v, list) else [v]) for k, v in sorted(EXERCISE_SYNONYMS.items(), key=lambda kv: len(kv[0]), reverse=True)]
+FUZZY_BAD_WORDS = ["press", "fly", "row", "curl", "squat", "deadlift"]
+
+def _trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+# --- RICERCA BROWSER ESERCIZI (RANKING + FACETTE) ---
+# Punteggi per livello: nome esatto > inizio del nome > ogni termine è l'inizio di una parola >
+# sottostringa > typo (un termine somiglia a una parola del nome). I typo restano in coda alla lista.
+EXERCISE_FACETS = {'primaryMuscles': "MUSCOLO", 'equipment': "ATTREZZO", 'level': "LIVELLO", 'category': "CATEGORIA", 'mechanic': "MECCANICA"}
+SEARCH_TOKEN_RE = re.compile(r"[a-z0-9]+")
+SEARCH_EXACT, SEARCH_PREFIX, SEARCH_WORDS, SEARCH_SUBSTRING = 400, 300, 200, 100
+SEARCH_FUZZY_MIN = 80             # fuzz.ratio minimo termine/parola; solo termini di 4+ caratteri
+SEARCH_PAGE_SIZE = 12
+
+class ExerciseIndex:
+    """Indice di ricerca sul DB esercizi, costruito una volta per caricamento del DB."""
+
+    def __init__(self, db_exercises):
+        self.exercises = db_exercises
+        self.names = [x['name'] for x in db_exercises]
+        self.names_lower = [n.lower() for n in self.names]
+        self.by_name = {}
+        for ex in db_exercises: self.by_name.setdefault(ex['name'], ex)
+        # Indice invertito trigramma -> posizioni (per le ricerche "term in name")
+        self.grams = {}
+        for i, n in enumerate(self.names_lower):
+            for g in _trigrams(n): self.grams.setdefault(g, set()).add(i)
+        # Browser: parole dei nomi (ordinate, per i prefissi) e facette come maschere booleane
+        self.word_pos = {}
+        for i, n in enumerate(self.names_lower):
+            for w in SEARCH_TOKEN_RE.findall(n): self.word_pos.setdefault(w, set()).add(i)
+        self.words = sorted(self.word_pos)
+        self.facets = {}
+        for field in EXERCISE_FACETS:
+            values = {}
+            for i, ex in enumerate(db_exercises):
+                raw = ex.get(field)
+                for v in (raw if isinstance(raw, list) else [raw]):
+                    if v: values.setdefault(str(v), []).append(i)
+            self.facets[field] = {v: self._mask(pos) for v, pos in sorted(values.items())}
+
+    def __len__(self):
+        return len(self.exercises)
+
+    def substring_matches(self, term):
+        """Posizioni (in ordine DB) dei nomi che contengono term."""
+        term = term.lower()
+        if len(term) < 3: return [i for i, n in enumerate(self.names_lower) if term in n]
+        postings = sorted((self.grams.get(g, set()) for g in _trigrams(term)), key=len)
+        cand = set(postings[0]).intersection(*postings[1:])
+        return sorted(i for i in cand if term in self.names_lower[i])
+
+    def images(self, ex):
+        return [i if i.startswith("http") else EXERCISE_IMG_BASE + i for i in ex.get('images', [])]
+
+    def _mask(self, positions):
+        mask = np.zeros(len(self.exercises), dtype=bool)
+        mask[list(positions)] = True
+        return mask
+
+    def _word_prefix(self, term):
+        """Posizioni dei nomi con almeno una parola che inizia con term."""
+        hits = set()
+        for w in self.words[bisect.bisect_left(self.words, term):]:
+            if not w.startswith(term): break
+            hits |= self.word_pos[w]
+        return hits
+
+    def _term_matches(self, term):
+        """{posizione: 100 se una parola del nome inizia con term, altrimenti somiglianza col typo}."""
+        hits = dict.fromkeys(self._word_prefix(term), 100.0)
+        if len(term) >= 4:
+            for word, score, _ in process.extract(term, self.words, scorer=fuzz.ratio, score_cutoff=SEARCH_FUZZY_MIN, limit=None):
+                for i in self.word_pos[word]:
+                    if hits.get(i, 0) < score: hits[i] = score
+        return hits
+
+    def rank(self, query):
+        """{posizione: punteggio} dei nomi che corrispondono alla query (vedi SEARCH_*)."""
+        q = query.lower().strip()
+        terms = SEARCH_TOKEN_RE.findall(q)
+        if not terms: return {}
+        per_term = [self._term_matches(t) for t in terms]
+        scores = {}
+        for i in set(per_term[0]).intersection(*per_term[1:]):
+            typo = min(m[i] for m in per_term)
+            n = self.names_lower[i]
+            if typo < 100: scores[i] = typo * SEARCH_SUBSTRING / 101
+            else: scores[i] = SEARCH_EXACT if n == q else (SEARCH_PREFIX if n.startswith(q) else SEARCH_WORDS)
+        for i in self.substring_matches(q):
+            if scores.get(i, 0) < SEARCH_SUBSTRING: scores[i] = SEARCH_SUBSTRING
+        return scores
+
+    def _filter_mask(self, filters, skip=None):
+        """AND tra facette diverse, OR tra i valori scelti della stessa facetta."""
+        mask = np.ones(len(self.exercises), dtype=bool)
+        for field, values in filters.items():
+            if field == skip or not values: continue
+            mask &= np.logical_or.reduce([self.facets[field].get(v, np.zeros_like(mask)) for v in values])
+        return mask
+
+    def search(self, query="", filters=None):
+        """Browser coach -> (posizioni ordinate per rilevanza, {facetta: {valore: conteggio}}).
+        Query vuota = tutti gli esercizi (in ordine alfabetico) che rispettano i filtri. I conteggi di
+        ogni facetta ignorano il filtro sulla facetta stessa, così le alternative restano visibili."""
+        filters = filters or {}
+        scores = self.rank(query) if query.strip() else None
+        base = self._mask(scores) if scores is not None else np.ones(len(self.exercises), dtype=bool)
+        hits = np.flatnonzero(base & self._filter_mask(filters))
+        if scores is not None: hits = sorted(hits, key=lambda i: (-scores[i], len(self.names[i]), i))
+        counts = {}
+        for field, values in self.facets.items():
+            scope = base & self._filter_mask(filters, skip=field)
+            counts[field] = {v: int(np.count_nonzero(scope & m)) for v, m in values.items()}
+        return [int(i) for i in hits], counts
+
+    def _by_synonym(self, q):
+        search_terms = [q]
+        for key, terms in SYNONYM_TABLE:
+            if key in q:
+                search_terms = terms
+                break
+        for term in search_terms:
+            hits = self.substring_matches(term)
+            if hits:
+                best = self.exercises[min(hits, key=lambda i: len(self.names[i]))]
+                return (self.images(best), f"Synonym: '{term}' -> {best['name']}")
+        return None
+
+    def _by_fuzzy(self, q, name, score):
+        if score <= 65: return None
+        cand_name = name.lower()
         is_safe = True
-        cand_name = match[0].lower()
-        for w in bad_words:
+        for w in FUZZY_BAD_WORDS:
             if (w in q and w not in cand_name) or (w not in q and w in cand_name):
                 is_safe = False
-                if "bench press" in cand_name and "chest press" in q: is_safe = True 
-        
-        if is_safe:
-            for ex in db_exercises:
-                if ex['name'] == match[0]:
-                    return ([BASE_URL + i for i in ex.get('images', [])], f"Fuzzy: {match[0]} ({match[1]}%)")
+                if "bench press" in cand_name and "chest press" in q: is_safe = True
+        if not is_safe: return None
+        return (self.images(self.by_name[name]), f"Fuzzy: {name} ({score}%)")
+
+    def find(self, name_query):
+        return self.find_many([name_query])[0]
+
+    def find_many(self, queries):
+        """Match di tutta una scheda: sinonimi/substring via indice, il resto in un'unica process.cdist."""
+        results = [None] * len(queries)
+        pending = []
+        for i, raw in enumerate(queries):
+            if not self.exercises or not raw:
+                results[i] = ([], "DB/Query Vuota")
+                continue
+            q = raw.lower().strip()
+            results[i] = self._by_synonym(q)
+            if results[i] is None: pending.append((i, q))
+
+        if pending:
+            scores = process.cdist([q for _, q in pending], self.names, scorer=fuzz.token_set_ratio, dtype=np.float64, workers=-1)
+            for (i, q), row in zip(pending, scores):
+                j = int(row.argmax())
+                results[i] = self._by_fuzzy(q, self.names[j], float(row[j])) or ([], f"Nessun risultato per '{q}'")
+        return results
+
+def exercise_db_fingerprint(db_exercises):
+    return hashlib.md5("\n".join(x['name'] for x in db_exercises).encode()).hexdigest() if db_exercises else ""
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _build_exercise_index(_db_exercises, fingerprint):
+    return ExerciseIndex(_db_exercises)
+
+def get_exercise_index(db_exercises):
+    return _build_exercise_index(db_exercises, exercise_db_fingerprint(db_exercises))
+
+@traced('images.find')
+def find_exercise_images(name_query, db_exercises):
+    return get_exercise_index(db_exercises).find(name_query)
+
+@traced('images.match')
+def attach_exercise_images(plan_json, db_exercises):
+    exercises = [ex for s in plan_json.get('sessions', []) for ex in s.get('exercises', [])]
+    queries = [ex.get('search_name', ex.get('name')) for ex in exercises]
+    for ex, query, (imgs, debug_msg) in zip(exercises, queries, get_exercise_index(db_exercises).find_many(queries)):
+        ex['images'] = imgs[:2]
+        ex['debug_info'] = f"Query: '{query}' -> {debug_msg}"
+    prefetch_plan_images(plan_json)
+    return plan_json
+
+def build_workout_prompt(raw_workout, note_workout):
+    return f"""
+    Agisci come un parser JSON "FOTOCOPIATRICE".
+    
+    INPUT UTENTE:
+    {raw_workout}
+    
+    NOTE COACH:
+    {note_workout}
+    
+    REGOLA SUPREMA: NON TRADURRE NULLA.
+    Se l'input è in Italiano, l'output DEVE ESSERE IN ITALIANO.
+    Copia 'details' e 'note' ESATTAMENTE come scritti dall'utente, parola per parola.
+    Solo 'search_name' deve essere in inglese per il database immagini.
+    
+    SCHEMA JSON:
+    {{
+        "sessions": [
+            {{
+                "name": "Nome Sessione",
+                "exercises": [
+                    {{
+                        "name": "Nome Esercizio (Originale)",
+                        "search_name": "Nome in Inglese (Solo per ricerca)",
+                        "details": "Dettagli (COPIA ESATTA DALL'INPUT)",
+                        "note": "Note (COPIA ESATTA DALL'INPUT)"
+                    }}
+                ]
+            }}
+        ],
+        "note_coach": "{note_workout}"
+    }}
+    """
+
+def build_diet_prompt(raw_diet, raw_supp, note_diet):
+    return f"""
+    Agisci come un nutrizionista sportivo ITALIANO.
+    
+    INPUT DIETA: {raw_diet if raw_diet else 'Nessuna'}. 
+    INPUT INTEGRAZIONE: {raw_supp if raw_supp else 'Nessuna'}.
+    NOTE DEL COACH: {note_diet}.
+    
+    ISTRUZIONI CRITICHE:
+    1. LINGUA: Usa SOLO ITALIANO.
+    2. CALORIE: Copia TUTTA la stringa dei target calorici (es. "2300 Training / 1900 Rest"). NON tagliarla.
+    3. GIORNI MULTIPLI: Se l'input contiene più tipologie di giorni, CREA un elemento nell'array 'days' PER OGNUNO DI ESSI. 
+    4. NOMI GIORNI: Usa ESATTAMENTE i nomi scritti dall'utente.
+    
+    SCHEMA JSON OBBLIGATORIO:
+    {{
+        "daily_calories": "Copia esatta della stringa target", 
+        "water_intake": "es. 3-4 Litri", 
+        "diet_note": "{note_diet}",
+        "days": [ 
+            {{ 
+                "day_name": "Nome Giorno 1", 
+                "meals": [ {{ "name": "Colazione", "foods": ["..."], "notes": "..." }} ] 
+            }}
+        ],
+        "supplements": [ 
+            {{ "name": "Creatina", "dose": "5g", "timing": "Post Workout", "notes": "..." }} 
+        ]
+    }}
+    """
 
-    return ([], f"Nessun risultato per '{q}'")
+# --- PARSER LOCALE SCHEDE (FAST PATH SENZA LLM) ---
+# La maggior parte delle schede incollate ha la forma "Sessione A" + una riga per esercizio
+# con serie x ripetizioni: le trasformiamo nello stesso schema JSON del prompt senza chiamare l'AI.
+SESSION_LINE_RE = re.compile(r"^(?:sessione|seduta|giorno|day|allenamento|workout|scheda|"
+                             r"luned[iì]|marted[iì]|mercoled[iì]|gioved[iì]|venerd[iì]|sabato|domenica|"
+                             r"monday|tuesday|wednesday|thursday|friday|saturday|sunday)(?!\w)", re.I)
+# "Sessione A: Petto e tricipiti", "Lunedì - Gambe": si riconosce la parte prima del titolo
+HEADER_TITLE_RE = re.compile(r"\s*(?::|\s[-–—]\s)\s*")
+# Nomi di split ("Push", "Pull A", "Upper 2", "Legs day"): solo se sono tutta l'intestazione,
+# altrimenti "Pull up 4 serie..." o "Lower back: ..." diventerebbero sessioni
+SPLIT_HEADER_RE = re.compile(r"^(?:upper|lower|push|pull|legs|full\s*body)(?:\s+(?:body|day|[a-e]|\d{1,2}))?$", re.I)
+SESSION_HEADER_MAX_WORDS = 6   # parola chiave + etichetta, titolo escluso
+SESSION_TITLE_MAX_WORDS = 12
+SETS_REPS_RE = re.compile(r"\b\d+\s*[x×*]\s*(?:\d+|max|amrap|cedimento)", re.I)
+BULLET_RE = re.compile(r"^\s*(?:[-•*·▪]|\d+\s*[.)])\s*")
+NOTE_LINE_RE = re.compile(r"^(?:note?|nota|nb|n\.b\.?|rec(?:upero)?|riposo|rest|->|→|>)\b", re.I)
+NOTE_SPLIT_RE = re.compile(r"\s+[-–—]\s+|\s*\|\s*|\s*//\s*|\s*\(|\s+(?:note?|nota)\s*:", re.I)
+
+# Vocabolario IT -> EN per search_name (le frasi più lunghe vengono sostituite per prime)
+EXERCISE_VOCAB_IT = {
+    "panca piana": "bench press", "panca inclinata": "incline bench press", "panca declinata": "decline bench press",
+    "panca": "bench press", "spinte manubri": "dumbbell press", "distensioni": "press", "spinte": "press",
+    "croci inverse": "reverse fly", "croci ai cavi": "cable crossover", "croci": "fly", "pectoral machine": "butterfly",
+    "lat machine": "lat pulldown", "pulley basso": "seated cable row", "pulley": "seated cable row",
+    "rematore": "row", "trazioni": "pullups", "pullover": "pullover",
+    "stacco rumeno": "romanian deadlift", "stacco da terra": "deadlift", "stacco": "deadlift",
+    "squat bulgaro": "bulgarian split squat", "affondi": "lunges", "pressa": "leg press",
+    "polpacci": "calf raise", "calf": "calf raise", "ponte glutei": "glute bridge",
+    "alzate laterali": "lateral raise", "alzate frontali": "front raise", "alzate a 90": "reverse fly",
+    "lento avanti": "military press", "lento dietro": "behind the neck press",
+    "curl martello": "hammer curl", "curl panca scott": "preacher curl", "curl alla scott": "preacher curl",
+    "french press": "skullcrusher", "push down": "pushdown", "estensioni tricipiti": "triceps extension",
+    "iperestensioni": "hyperextension", "adduttori": "hip adduction", "abduttori": "hip abduction",
+    "plank laterale": "side plank", "crunch inverso": "reverse crunch", "addominali": "crunch",
+    "manubri": "dumbbell", "manubrio": "dumbbell", "bilanciere": "barbell", "cavi": "cable", "cavo": "cable",
+    "macchina": "machine", "multipower": "smith machine", "elastico": "band", "kettlebell": "kettlebell",
+}
+VOCAB_IT_RE = re.compile(r"\b(" + "|".join(re.escape(k) for k in sorted(EXERCISE_VOCAB_IT, key=len, reverse=True)) + r")\b")
+STOPWORDS_IT_RE = re.compile(r"\b(?:ai|al|alla|alle|allo|con|col|su|sul|in|di|da|del|della|a|e)\b")
+
+def italian_to_search_name(name):
+    q = VOCAB_IT_RE.sub(lambda m: EXERCISE_VOCAB_IT[m.group(1)], name.lower())
+    return re.sub(r"\s+", " ", STOPWORDS_IT_RE.sub(" ", q)).strip()
+
+def parse_workout_line(line):
+    """'Panca piana 4x8 rec 90'' - fermo al petto' -> (nome, dettagli, note); None se non riconosciuta."""
+    body = BULLET_RE.sub("", line).strip()
+    m = SETS_REPS_RE.search(body)
+    if not m: return None
+    name = body[:m.start()].strip(" \t:-–—,;")
+    if not name: return None
+    rest = body[m.start():]
+    split = NOTE_SPLIT_RE.search(rest)
+    if split:
+        details, note = rest[:split.start()], rest[split.end():].rstrip(")").strip()
+    else:
+        details, note = rest, ""
+    return name, details.strip(" ,;"), note
+
+def header_text(line):
+    return BULLET_RE.sub("", line.strip()).strip().strip("#*:= ").strip()
+
+def session_header(line):
+    """'## Sessione A: Petto' -> 'Sessione A: Petto'; None se la riga non apre una sessione."""
+    header = header_text(line)
+    if not header or len(header.split()) > SESSION_TITLE_MAX_WORDS or SETS_REPS_RE.search(header): return None
+    head = HEADER_TITLE_RE.split(header, 1)[0]
+    if SPLIT_HEADER_RE.match(head): return header
+    if len(head.split()) > SESSION_HEADER_MAX_WORDS: return None
+    return header if SESSION_LINE_RE.match(head) else None
+
+def drop_empty_sessions(plan_json, unparsed=()):
+    """Toglie le sessioni senza esercizi (titoli tipo "Scheda ipertrofia") e riallinea gli indici delle righe non riconosciute."""
+    pending = {s for s, *_ in unparsed}
+    keep = [i for i, sess in enumerate(plan_json["sessions"]) if sess["exercises"] or i in pending]
+    remap = {old: new for new, old in enumerate(keep)}
+    plan_json["sessions"] = [plan_json["sessions"][i] for i in keep]
+    return plan_json, [(remap[s], pos, line) for s, pos, line in unparsed]
+
+def split_workout_sessions(raw_workout):
+    """Testo della scheda -> un blocco di testo per sessione (righe prima della prima intestazione a parte)."""
+    chunks = [[]]
+    for line in str(raw_workout).splitlines():
+        if session_header(line) and any(l.strip() for l in chunks[-1]): chunks.append([])
+        chunks[-1].append(line)
+    return ["\n".join(c).strip() for c in chunks if any(l.strip() for l in c)]
+
+def parse_workout_text(raw_workout, note_workout=""):
+    """Parser deterministico: ritorna (scheda nello schema del prompt, righe non riconosciute).
+    Le righe non riconosciute sono tuple (indice sessione, posizione esercizio, testo)."""
+    sessions, unparsed = [], []
+    last_ex = None
+    for raw_line in str(raw_workout).splitlines():
+        line = raw_line.strip()
+        if not line: continue
+        header = session_header(line)
+        if header:
+            sessions.append({"name": header, "exercises": []})
+            last_ex = None
+            continue
+        if not sessions: sessions.append({"name": "Sessione", "exercises": []})
+        exercises = sessions[-1]["exercises"]
+        parsed = parse_workout_line(line)
+        if parsed:
+            name, details, note = parsed
+            last_ex = {"name": name, "search_name": italian_to_search_name(name), "details": details, "note": note}
+            exercises.append(last_ex)
+        elif last_ex is not None and NOTE_LINE_RE.match(BULLET_RE.sub("", line)):
+            last_ex["note"] = f"{last_ex['note']} {line}".strip()
+        else:
+            unparsed.append((len(sessions) - 1, len(exercises), line))
+            last_ex = None
+    return drop_empty_sessions({"sessions": sessions, "note_coach": note_workout}, unparsed)
+
+def build_lines_prompt(lines):
+    righe = "\n".join(f"{i}. {line}" for i, line in enumerate(lines, 1))
+    return f"""
+    Agisci come un parser JSON "FOTOCOPIATRICE".
+    Le righe numerate qui sotto vengono da una scheda di allenamento: di solito sono esercizi,
+    ma possono essere intestazioni di sessione (giorno, split, "Sessione A: Petto"...) o altro.
+
+    RIGHE:
+    {righe}
+
+    REGOLA SUPREMA: NON TRADURRE NULLA. Copia 'details' e 'note' ESATTAMENTE come scritti.
+    Solo 'search_name' deve essere in inglese per il database immagini.
+    Restituisci ESATTAMENTE {len(lines)} elementi, uno per riga e nello stesso ordine, con "line" = numero della riga.
+    "type": "exercise" per un esercizio; "session" se la riga apre una nuova sessione ("name" = intestazione
+    copiata com'è, altri campi vuoti); "other" per tutto il resto (titoli, commenti), altri campi vuoti.
+
+    SCHEMA JSON:
+    {{ "exercises": [ {{ "line": 1, "type": "exercise", "name": "...", "search_name": "...", "details": "...", "note": "..." }} ] }}
+    """
+
+def line_items_ok(items, expected):
+    """Risposta del prompt delle righe: un elemento per riga, numerato da 1 a expected."""
+    return isinstance(items, list) and len(items) == expected and all(isinstance(e, dict) for e in items) \
+        and {e.get('line') for e in items} == set(range(1, expected + 1))
+
+def merge_parsed_lines(plan_json, unparsed, exercises):
+    """Ricompone la scheda con le righe classificate dall'AI: esercizi al loro posto, intestazioni come nuove
+    sessioni. ValueError se le righe non tornano o se una riga non è né esercizio né sessione: il chiamante
+    rigenera allora la scheda intera, invece di fondere sessioni in silenzio."""
+    if not line_items_ok(exercises, len(unparsed)):
+        raise ValueError(f"l'AI ha restituito {len(exercises)} righe su {len(unparsed)}")
+    by_line = {e['line']: e for e in exercises}
+    pending = {}
+    for n, (s_idx, pos, line) in enumerate(unparsed, 1):
+        item = by_line[n]
+        kind = item.get('type', 'exercise')
+        if kind not in ('exercise', 'session') or (kind == 'exercise' and not item.get('name')):
+            raise ValueError(f"riga non riconosciuta come esercizio né come sessione: '{line}'")
+        pending.setdefault(s_idx, []).append((pos, kind, item, line))
+
+    sessions = []
+    for s_idx, sess in enumerate(plan_json["sessions"]):
+        current, extra = dict(sess, exercises=[]), deque(pending.get(s_idx, []))
+        sessions.append(current)
+        for pos in range(len(sess["exercises"]) + 1):
+            while extra and extra[0][0] == pos:
+                _, kind, item, line = extra.popleft()
+                if kind == 'session':
+                    current = {"name": item.get('name') or header_text(line), "exercises": []}
+                    sessions.append(current)
+                else: current["exercises"].append({k: item.get(k, "") for k in ("name", "search_name", "details", "note")})
+            if pos < len(sess["exercises"]): current["exercises"].append(sess["exercises"][pos])
+    plan_json["sessions"] = sessions
+    return drop_empty_sessions(plan_json)[0]
+
+# --- CACHE GENERAZIONI AI (SQLITE, INDIRIZZATA PER CONTENUTO) ---
+# Chiave = hash(versione prompt, modello, prompt normalizzato): stesso input -> zero token e zero latenza.
+# Va incrementata PROMPT_VERSION ogni volta che cambia il testo di build_workout_prompt/build_diet_prompt.
+AI_MODEL = "gpt-4o"
+PROMPT_VERSION = 3
+AI_CACHE_DB = os.path.join(CACHE_DIR, "ai_cache.sqlite")
+AI_CACHE_MAX_ENTRIES = 500
+AI_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+@st.cache_resource
+def _ai_cache():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(AI_CACHE_DB, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_accessed ON ai_cache (accessed)")
+    conn.commit()
+    return {'conn': conn, 'lock': threading.Lock()}
+
+def ai_cache_key(prompt, model):
+    norm = "\n".join(line.strip() for line in prompt.strip().splitlines())
+    return hashlib.sha256(f"{PROMPT_VERSION}\0{model}\0{norm}".encode()).hexdigest()
+
+def ai_cache_get(key):
+    c = _ai_cache()
+    with c['lock']:
+        row = c['conn'].execute("SELECT response FROM ai_cache WHERE key = ?", (key,)).fetchone()
+        if row:
+            c['conn'].execute("UPDATE ai_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            c['conn'].commit()
+    return row[0] if row else None
+
+def ai_cache_put(key, response, model):
+    c = _ai_cache()
+    now = time.time()
+    with c['lock']:
+        conn = c['conn']
+        conn.execute("INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?, ?, ?, ?)", (key, model, response, len(response.encode()), now, now))
+        # LRU: via le voci meno usate finché si rientra nei limiti di numero e dimensione
+        count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ai_cache").fetchone()
+        for old_key, old_size in conn.execute("SELECT key, size FROM ai_cache ORDER BY accessed").fetchall():
+            if count <= AI_CACHE_MAX_ENTRIES and size <= AI_CACHE_MAX_BYTES: break
+            conn.execute("DELETE FROM ai_cache WHERE key = ?", (old_key,))
+            count, size = count - 1, size - old_size
+        conn.commit()
+
+def ai_cache_invalidate(key):
+    c = _ai_cache()
+    with c['lock']:
+        c['conn'].execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+        c['conn'].commit()
+
+def ai_cache_clear():
+    c = _ai_cache()
+    with c['lock']:
+        c['conn'].execute("DELETE FROM ai_cache")
+        c['conn'].commit()
+
+def ai_cache_stats():
+    c = _ai_cache()
+    with c['lock']: count, size = c['conn'].execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ai_cache").fetchone()
+    return {'voci': count, 'mb': round(size / 1024 / 1024, 2)}
+
+# --- GENERAZIONE CONCORRENTE IN STREAMING ---
+def parse_partial_json(text):
+    """Parse best-effort di un JSON troncato (stream): taglia all'ultimo punto sicuro e chiude le parentesi aperte."""
+    start = text.find('{')
+    if start == -1: return None
+    stack, in_str, esc, cut, closers = [], False, False, None, ""
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if esc: esc = False
+            elif c == '\\': esc = True
+            elif c == '"': in_str = False
+        elif c == '"': in_str = True
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+            cut, closers = i + 1, "".join(reversed(stack))
+        elif c in '}]':
+            if not stack: break
+            stack.pop()
+            cut, closers = i + 1, "".join(reversed(stack))
+            if not stack: break
+        elif c == ',':
+            cut, closers = i, "".join(reversed(stack))
+    if cut is None: return None
+    try: return json.loads(text[start:cut] + closers)
+    except ValueError: return None
+
+def stream_completion(client_ai, prompt, buf, model=AI_MODEL, deadline=None, usage=None):
+    # Gira in un thread: niente chiamate st.* qui dentro, solo accumulo del testo
+    kwargs = {'stream_options': {'include_usage': True}} if usage is not None else {}
+    if deadline: kwargs['timeout'] = deadline
+    started = time.time()
+    stream = client_ai.chat.completions.create(model=model, messages=[{"role": "system", "content": prompt}], stream=True, **kwargs)
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            buf.append(chunk.choices[0].delta.content)
+        if usage is not None and getattr(chunk, 'usage', None):
+            usage['prompt_tokens'] = chunk.usage.prompt_tokens
+            usage['completion_tokens'] = chunk.usage.completion_tokens
+        if deadline and time.time() - started > deadline:
+            if hasattr(stream, 'close'): stream.close()
+            raise TimeoutError(f"{model}: oltre {deadline}s")
+    return "".join(buf)
+
+# --- ROUTER MODELLI (TIER PER DIMENSIONE, ESCALATION SU SCHEMA NON VALIDO) ---
+# È pura trascrizione in uno schema fisso: il modello piccolo basta quasi sempre. Input lunghi
+# o complessi vanno diretti al modello grande; se il piccolo sfora la scadenza o restituisce
+# JSON fuori schema si riprova una volta sul grande. Statistiche per tier nel pannello coach.
+AI_TIERS = {
+    'mini': {'model': "gpt-4o-mini", 'deadline': 45},
+    'full': {'model': AI_MODEL, 'deadline': 120},
+}
+AI_ROUTER_MAX_CHARS = 8000      # prompt più lunghi -> direttamente 'full'
+AI_ROUTER_MAX_LINES = 150       # righe non vuote oltre cui il testo è "complesso"
+AI_ROUTER_SAMPLES = 200         # latenze tenute per tier (p50/p95)
+
+@st.cache_resource
+def _ai_router_stats():
+    return {'lock': threading.Lock(), 'tiers': {t: {'calls': 0, 'ok': 0, 'errors': 0, 'timeouts': 0, 'schema_fail': 0,
+                                                      'escalations': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'latency': []}
+                                                  for t in AI_TIERS}}
+
+def job_kind(key):
+    return 'diet' if key == 'd' else ('lines' if key == 'w_lines' else 'workout')
+
+def pick_tier(prompt):
+    lines = sum(1 for l in prompt.splitlines() if l.strip())
+    return 'full' if len(prompt) > AI_ROUTER_MAX_CHARS or lines > AI_ROUTER_MAX_LINES else 'mini'
+
+def route_tiers(prompt):
+    """Tier da provare in ordine: il secondo solo come escalation."""
+    return ['mini', 'full'] if pick_tier(prompt) == 'mini' else ['full']
+
+def ai_cache_keys(prompt):
+    """Una chiave per ogni modello che può rispondere a questo prompt (la voce in cache è di chi ha risposto)."""
+    return [ai_cache_key(prompt, AI_TIERS[t]['model']) for t in route_tiers(prompt)]
+
+def schema_ok(kind, text):
+    """Controllo minimo dello schema atteso per tipo di job ('lines:N' = N righe numerate)."""
+    try: data = json.loads(text)
+    except Exception: return False
+    if not isinstance(data, dict): return False
+    if kind == 'diet': return isinstance(data.get('days'), list) and isinstance(data.get('supplements', []), list)
+    if kind.startswith('lines'):
+        lines, expected = data.get('exercises'), kind.partition(':')[2]
+        if expected and not line_items_ok(lines, int(expected)): return False
+        return isinstance(lines, list) and all(isinstance(e, dict) and (e.get('name') or e.get('type') == 'other') for e in lines)
+    else:
+        sessions = data.get('sessions')
+        if not isinstance(sessions, list) or not all(isinstance(x, dict) and isinstance(x.get('exercises'), list) for x in sessions): return False
+        exercises = [e for x in sessions for e in x['exercises']]
+    return isinstance(exercises, list) and all(isinstance(e, dict) and e.get('name') for e in exercises)
+
+def _record_ai_call(tier, elapsed, outcome, usage):
+    stats = _ai_router_stats()
+    with stats['lock']:
+        t = stats['tiers'][tier]
+        t['calls'] += 1
+        t[outcome] += 1
+        t['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        t['completion_tokens'] += usage.get('completion_tokens', 0)
+        t['latency'] = (t['latency'] + [elapsed])[-AI_ROUTER_SAMPLES:]
+
+def routed_completion(client_ai, kind, prompt, buf):
+    """Tier scelto da pick_tier, scadenza per chiamata, escalation a 'full' se fallisce o esce dallo schema.
+    Ritorna (testo, modello che l'ha prodotto)."""
+    tiers = route_tiers(prompt)
+    for i, tier in enumerate(tiers):
+        cfg, usage = AI_TIERS[tier], {}
+        del buf[:]  # l'anteprima live riparte da zero col nuovo modello
+        t0 = time.time()
+        try:
+            with span('ai.completion', tier=tier, kind=kind, model=cfg['model']) as attrs:
+                text = clean_json_response(stream_completion(client_ai, prompt, buf, cfg['model'], cfg['deadline'], usage))
+                attrs.update(usage)
+        except Exception as e:
+            _record_ai_call(tier, time.time() - t0, 'timeouts' if isinstance(e, (TimeoutError, openai.APITimeoutError)) else 'errors', usage)
+            if i == len(tiers) - 1: raise
+        else:
+            if schema_ok(kind, text):
+                _record_ai_call(tier, time.time() - t0, 'ok', usage)
+                return text, cfg['model']
+            _record_ai_call(tier, time.time() - t0, 'schema_fail', usage)
+            if i == len(tiers) - 1: return text, cfg['model']  # fuori schema: il chiamante non lo mette in cache
+        with _ai_router_stats()['lock']: _ai_router_stats()['tiers'][tier]['escalations'] += 1
+
+def ai_router_report():
+    """Tabella per tier: chiamate, esiti, token e latenze p50/p95 in secondi."""
+    stats = _ai_router_stats()
+    with stats['lock']: tiers = {t: dict(v) for t, v in stats['tiers'].items()}
+    rows = {}
+    for t, v in tiers.items():
+        lat = np.array(v.pop('latency')) if v['latency'] else None
+        rows[f"{t} ({AI_TIERS[t]['model']})"] = dict(v, p50_s=round(float(np.percentile(lat, 50)), 2) if lat is not None else None,
+                                                     p95_s=round(float(np.percentile(lat, 95)), 2) if lat is not None else None)
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def _live_workout_md(partial, ex_db):
+    lines = []
+    for s in partial.get('sessions', []):
+        lines.append(f"**{s.get('name', 'Sessione')}**")
+        exs = [ex for ex in s.get('exercises', []) if ex.get('name')]
+        matches = get_exercise_index(ex_db).find_many([ex.get('search_name', ex.get('name')) for ex in exs]) if ex_db else [([], "")] * len(exs)
+        for ex, (imgs, _) in zip(exs, matches):
+            lines.append(f"- {'🖼️' if imgs else '⬜'} {ex['name']}")
+    return "\n".join(lines)
+
+def _live_diet_md(partial):
+    lines = [f"🔥 {partial['daily_calories']}"] if partial.get('daily_calories') else []
+    for day in partial.get('days', []):
+        lines.append(f"**{day.get('day_name', 'Giornata')}**: " + ", ".join(m.get('name', '') for m in day.get('meals', [])))
+    if partial.get('supplements'): lines.append(f"💊 {len(partial['supplements'])} integratori")
+    return "\n\n".join(lines)
+
+# --- GENERAZIONE A BLOCCHI (UNA RICHIESTA PER SESSIONE) ---
+# Ogni sessione è una richiesta indipendente e parallela; la chiave della cache AI è l'hash del
+# suo prompt, quindi cambiando una riga si rigenera solo la sessione che la contiene.
+SESSION_JOB = "w:"   # chiavi dei job: w:0, w:1, ...
+
+def build_session_jobs(raw_workout):
+    """Un prompt per sessione. Le note coach non entrano nel prompt: cambiarle non rigenera nulla."""
+    return {f"{SESSION_JOB}{i}": build_workout_prompt(chunk, "") for i, chunk in enumerate(split_workout_sessions(raw_workout))}
+
+def stitch_session_results(results, note_workout):
+    """Risultati per sessione -> scheda unica nello schema 'sessions'. Ritorna (scheda, indici falliti)."""
+    plan, failed = {"sessions": [], "note_coach": note_workout}, []
+    keys = sorted((k for k in results if k.startswith(SESSION_JOB)), key=lambda k: int(k[len(SESSION_JOB):]))
+    for k in keys:
+        try: plan["sessions"] += json.loads(results[k]).get("sessions", [])
+        except Exception: failed.append(int(k[len(SESSION_JOB):]))
+    return plan, failed
+
+@traced('ai.generate')
+def run_generation_jobs(client_ai, jobs, ex_db, use_cache=True, kinds=None):
+    """Lancia in parallelo le generazioni ({'w': prompt, 'd': prompt}) e mostra l'anteprima man mano che arriva.
+    Ritorna {chiave: testo JSON pulito}, None se la chiamata è fallita. Con use_cache=False rigenera e sovrascrive.
+    kinds: tipo di schema per chiave quando job_kind non basta (es. {'w_lines': 'lines:12'})."""
+    kinds = {k: (kinds or {}).get(k) or job_kind(k) for k in jobs}
+    keys = {k: ai_cache_keys(prompt) for k, prompt in jobs.items()}
+    results = {}
+    for k in list(jobs):
+        cached = next((hit for hit in map(ai_cache_get, keys[k]) if hit is not None), None) if use_cache else None
+        trace_count('ai_cache.hit' if cached is not None else 'ai_cache.miss')
+        if cached is not None: results[k] = cached
+        elif not use_cache:
+            for key in keys[k]: ai_cache_invalidate(key)
+    jobs = {k: prompt for k, prompt in jobs.items() if k not in results}
+    if not jobs: return results
+    bufs = {k: [] for k in jobs}
+    titles = {'w': "🏋️‍♂️ SCHEDA IN ARRIVO", 'w_lines': "🏋️‍♂️ RIGHE NON RICONOSCIUTE", 'd': "🥗 DIETA IN ARRIVO"}
+    titles.update({k: f"🏋️‍♂️ SESSIONE {int(k[len(SESSION_JOB):]) + 1}" for k in jobs if k.startswith(SESSION_JOB)})
+    cols = st.columns(len(jobs))
+    live = {k: col.empty() for k, col in zip(jobs, cols)}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {k: pool.submit(routed_completion, client_ai, kinds[k], prompt, bufs[k]) for k, prompt in jobs.items()}
+        while True:
+            done = all(f.done() for f in futures.values())
+            for k in jobs:
+                partial = parse_partial_json("".join(bufs[k]))
+                if partial:
+                    if k == 'd': body = _live_diet_md(partial)
+                    elif k == 'w_lines': body = _live_workout_md({'sessions': [{'name': 'AI', 'exercises': partial.get('exercises', [])}]}, ex_db)
+                    else: body = _live_workout_md(partial, ex_db)
+                    live[k].markdown(f"#### {titles[k]}\n\n{body}")
+            if done: break
+            time.sleep(0.2)
+    for k, f in futures.items():
+        try: results[k], model = f.result()
+        except Exception:
+            results[k] = None
+            continue
+        # in cache solo risposte nello schema, sotto la chiave del modello che ha risposto
+        if schema_ok(kinds[k], results[k]): ai_cache_put(ai_cache_key(jobs[k], model), results[k], model)
+    for ph in live.values(): ph.empty()
+    return results
+
+# --- CACHE LOCALE IMMAGINI + MINIATURE ---
+# Ogni immagine di GitHub viene scaricata una volta sola; al browser mandiamo una miniatura
+# WebP già alla larghezza di visualizzazione, letta dal disco.
+THUMB_WIDTH = 480
+IMAGE_RAW_DIR = os.path.join(CACHE_DIR, "images")
+STATIC_THUMB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "thumbs")
+# Fuori da static/ (es. benchmark) le miniature non sono servite: <img> usa l'URL originale
+THUMB_DIR = os.path.abspath(os.environ.get("AREA199_THUMB_DIR", STATIC_THUMB_DIR))
+
+@st.cache_resource
+def _image_cache():
+    # .tmp rimasti da scritture interrotte (processo terminato a metà salvataggio)
+    if os.path.isdir(THUMB_DIR):
+        for name in os.listdir(THUMB_DIR):
+            if name.endswith(".tmp"):
+                try: os.remove(os.path.join(THUMB_DIR, name))
+                except OSError: pass
+    return {'pool': ThreadPoolExecutor(max_workers=8), 'lock': threading.Lock(), 'inflight': set()}
+
+def _image_key(url):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+def thumb_path(url):
+    return os.path.join(THUMB_DIR, _image_key(url) + ".webp")
+
+@traced('images.thumbnail')
+def cache_exercise_image(url):
+    """Scarica l'immagine (una volta sola) e salva la miniatura. Ritorna il path della miniatura o None."""
+    path = thumb_path(url)
+    if os.path.exists(path): return path
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        resp = requests.get(url, timeout=15)
+        if resp.status_code != 200: return None
+        os.makedirs(IMAGE_RAW_DIR, exist_ok=True)
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        with open(os.path.join(IMAGE_RAW_DIR, _image_key(url) + os.path.splitext(url)[1]), 'wb') as f: f.write(resp.content)
+        img = Image.open(io.BytesIO(resp.content))
+        if img.mode not in ("RGB", "RGBA"): img = img.convert("RGB")
+        img.thumbnail((THUMB_WIDTH, THUMB_WIDTH * 4))
+        img.save(tmp, "WEBP", quality=80, method=4)
+        os.replace(tmp, path)
+        return path
+    except Exception:
+        try: os.remove(tmp)
+        except OSError: pass
+        return None
+
+def prefetch_images(urls):
+    cache = _image_cache()
+    for url in urls:
+        if not url or os.path.exists(thumb_path(url)): continue
+        with cache['lock']:
+            if url in cache['inflight']: continue
+            cache['inflight'].add(url)
+
+        def run(u=url):
+            try: cache_exercise_image(u)
+            finally:
+                with cache['lock']: cache['inflight'].discard(u)
+        cache['pool'].submit(run)
+
+def prefetch_plan_images(plan_json):
+    prefetch_images([img for s in plan_json.get('sessions', []) for ex in s.get('exercises', []) for img in ex.get('images', [])])
 
 # ==============================================================================
 # 3. INTERFACCIA COMUNE (RENDER & DOWNLOAD)
 # ==============================================================================
 
-def create_download_link_html(content_html, filename, label):
-    b64 = base64.b64encode(content_html.encode()).decode()
-    return f'<a href="data:text/html;base64,{b64}" download="{filename}" style="background-color:#E20613; color:white; padding:10px 20px; text-decoration:none; border-radius:5px; font-weight:bold; display:block; text-align:center; margin-top:10px; width:100%;">📄 {label}</a>'
-
+def esc(value):
+    """Unico punto di escaping HTML per tutto ciò che arriva da input utente o AI."""
+    return html.escape("" if value is None else str(value))
+
+def content_hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+# --- EXPORT (HTML/PDF) GENERATO SOLO AL DOWNLOAD, IN CACHE PER HASH DEL CONTENUTO ---
+PLAN_EXPORT_TMPL = Template("""<html><head><meta charset="utf-8"><style>body{font-family:Arial;padding:20px;} h1{color:#E20613;} .session{margin-top:20px;border-bottom:2px solid #333;} .ex{margin-bottom:10px;}</style></head><body><h1>SCHEDA ALLENAMENTO - AREA 199</h1>$sessions$note</body></html>""")
+PLAN_SESSION_TMPL = Template("<div class='session'><h2>$name</h2>$exercises</div>")
+PLAN_EXERCISE_TMPL = Template("<div class='ex'><strong>$name</strong><br>$details<br><em>$note</em></div>")
+PLAN_NOTE_TMPL = Template("<div style='margin-top:20px; border:1px solid #E20613; padding:10px;'><strong>NOTE COACH:</strong><br>$note</div>")
+DIET_EXPORT_TMPL = Template("""<html><head><meta charset="utf-8"><style>body{font-family:Arial;padding:20px;} h1{color:#4ade80;} h2{color:#60a5fa;} .meal{margin-bottom:10px;padding-left:10px;border-left:3px solid #4ade80;}</style></head><body><h1>PIANO ALIMENTARE</h1><p>Target: $calories | Acqua: $water</p>$days$note$supplements</body></html>""")
+DIET_MEAL_TMPL = Template("<div class='meal'><strong>$name</strong><br>$foods<br><em>$notes</em></div>")
+DIET_SUPP_TMPL = Template("<li><strong>$name</strong>: $dose ($timing) - <em>$notes</em></li>")
+
+def plan_sessions(plan_json):
+    return plan_json.get('sessions', plan_json.get('Sessions', []))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def export_plan_html(plan_hash, _plan_json):
+    sessions = "".join(
+        PLAN_SESSION_TMPL.substitute(name=esc(s.get('name', 'Sessione')), exercises="".join(
+            PLAN_EXERCISE_TMPL.substitute(name=esc(ex.get('name', 'Ex')), details=esc(ex.get('details', '')), note=esc(ex.get('note', '')))
+            for ex in s.get('exercises', [])))
+        for s in plan_sessions(_plan_json))
+    note = PLAN_NOTE_TMPL.substitute(note=esc(_plan_json['note_coach'])) if _plan_json.get('note_coach') else ""
+    return PLAN_EXPORT_TMPL.substitute(sessions=sessions, note=note).encode()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def export_diet_html(diet_hash, _diet_json):
+    days = "".join(
+        f"<h3>{esc(day.get('day_name'))}</h3>" + "".join(
+            DIET_MEAL_TMPL.substitute(name=esc(m.get('name')), foods=esc(', '.join(m.get('foods', []))), notes=esc(m.get('notes', '')))
+            for m in day.get('meals', []))
+        for day in _diet_json.get('days', []))
+    note = f"<br><strong>NOTE DIETA:</strong> {esc(_diet_json['diet_note'])}" if _diet_json.get('diet_note') else ""
+    supps = _diet_json.get('supplements', [])
+    supplements = "<h2>INTEGRAZIONE</h2><ul>" + "".join(
+        DIET_SUPP_TMPL.substitute(name=esc(x.get('name')), dose=esc(x.get('dose')), timing=esc(x.get('timing')), notes=esc(x.get('notes', '')))
+        for x in supps) + "</ul>" if supps else ""
+    return DIET_EXPORT_TMPL.substitute(calories=esc(_diet_json.get('daily_calories', '')), water=esc(_diet_json.get('water_intake', '')),
+                                       days=days, note=note, supplements=supplements).encode()
+
+@traced('export.pdf')
+@st.cache_data(max_entries=16, show_spinner=False)
+def export_plan_pdf(plan_hash, _plan_json):
+    """PDF A4 compatto: una riga per esercizio con la prima immagine (miniatura locale) accanto al testo."""
+    buf = io.BytesIO()
+    pages = PdfPages(buf)
+    fig, y = None, 0.0
+
+    def new_page():
+        nonlocal fig, y
+        if fig is not None: pages.savefig(fig)
+        fig = Figure(figsize=(8.27, 11.69))
+        fig.text(0.06, 0.96, "SCHEDA ALLENAMENTO - AREA 199", color="#E20613", fontsize=16, weight="bold")
+        y = 0.92
+
+    new_page()
+    for s in plan_sessions(_plan_json):
+        if y < 0.2: new_page()
+        fig.text(0.06, y, str(s.get('name', 'Sessione')), fontsize=13, weight="bold", color="#E20613")
+        y -= 0.03
+        for ex in s.get('exercises', []):
+            if y < 0.12: new_page()
+            img = ex.get('images', [None])[0] if ex.get('images') else None
+            path = cache_exercise_image(img) if img else None
+            if path:
+                ax = fig.add_axes([0.06, y - 0.085, 0.15, 0.085])
+                ax.imshow(np.asarray(Image.open(path).convert("RGB")))
+                ax.axis("off")
+            fig.text(0.24, y - 0.015, str(ex.get('name', '')), fontsize=11, weight="bold")
+            fig.text(0.24, y - 0.035, "\n".join(textwrap.wrap(str(ex.get('details', '')), 80)[:2]), fontsize=9, va="top")
+            if ex.get('note'):
+                fig.text(0.24, y - 0.065, "\n".join(textwrap.wrap(str(ex['note']), 90)[:2]), fontsize=8, style="italic", color="#555", va="top")
+            y -= 0.1
+        y -= 0.02
+    if _plan_json.get('note_coach'):
+        if y < 0.15: new_page()
+        fig.text(0.06, y, "NOTE COACH: " + "\n".join(textwrap.wrap(str(_plan_json['note_coach']), 100)), fontsize=9, va="top")
+    pages.savefig(fig)
+    pages.close()
+    return buf.getvalue()
+
+def render_download_buttons(plan_json=None, diet_json=None):
+    # I dati vengono generati solo al click (callable), poi restano in cache per hash del contenuto
+    if plan_json:
+        h = content_hash(plan_json)
+        c1, c2 = st.columns(2)
+        c1.download_button("📄 SCARICA SCHEDA ALLENAMENTO", data=lambda: export_plan_html(h, plan_json), file_name="Scheda_Allenamento.html",
+                           mime="text/html", on_click="ignore", key=f"dl_plan_html_{h}", use_container_width=True)
+        c2.download_button("🖨️ SCARICA PDF CON IMMAGINI", data=lambda: export_plan_pdf(h, plan_json), file_name="Scheda_Allenamento.pdf",
+                           mime="application/pdf", on_click="ignore", key=f"dl_plan_pdf_{h}", use_container_width=True)
+    if diet_json:
+        h = content_hash(diet_json)
+        st.download_button("📄 SCARICA PIANO NUTRIZIONALE", data=lambda: export_diet_html(h, diet_json), file_name="Piano_Nutrizionale.html",
+                           mime="text/html", on_click="ignore", key=f"dl_diet_html_{h}", use_container_width=True)
+
+# --- RENDER A BLOCCHI: UNA SESSIONE / UNA GIORNATA = UN SOLO ELEMENTO HTML, MEMOIZZATO ---
+SESSION_BLOCK_TMPL = Template("<div class='session-header'>$name</div>$exercises")
+EXERCISE_BLOCK_TMPL = Template("<div class='ex-block'>$debug<div class='ex-row'><div class='ex-imgs'>$images</div><div class='ex-text'><div class='exercise-name'>$name</div><div class='exercise-details'>$details</div>$note</div></div></div>")
+NO_IMAGE_HTML = "<div style='color:#444; font-size:0.8em; padding:20px; border:1px dashed #333; text-align:center; width:100%;'>NO IMAGE</div>"
+DAY_BLOCK_TMPL = Template("<div class='day-block'>$meals</div>")
+MEAL_BLOCK_TMPL = Template("<div class='meal-header'>$name</div>$foods$notes")
+SUPP_BLOCK_TMPL = Template("<div class='supp-item'><strong style='color:#60a5fa; font-size:1.1em;'>$name</strong><br><span style='color:white;'>⚖️ $dose</span> | <span style='color:#aaa;'>🕒 $timing</span><div style='color:#666; font-style:italic; font-size:0.9em;'>$notes</div></div>")
+
+def thumb_url(url):
+    """URL per <img>: miniatura servita da /app/static se pronta, altrimenti l'originale (scaricata in background)."""
+    if THUMB_DIR == STATIC_THUMB_DIR and os.path.exists(thumb_path(url)): return f"app/static/thumbs/{_image_key(url)}.webp"
+    prefetch_images([url])
+    return url
+
+def _thumbs_ready(session):
+    return tuple(os.path.exists(thumb_path(u)) for ex in session.get('exercises', []) for u in ex.get('images', [])[:2])
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_session_html(plan_hash, idx, _session, show_debug, thumbs_ready):
+    # thumbs_ready fa parte della chiave: quando le miniature arrivano il blocco si rigenera
+    blocks = []
+    for ex in _session.get('exercises', []):
+        debug = ""
+        if show_debug:
+            debug_msg = ex.get('debug_info', 'N/A')
+            color = "#ff4b4b" if "Nessun risultato" in debug_msg else "#4ade80"
+            debug = f"<div class='debug-img' style='color:{color}'>🔍 {esc(debug_msg)}</div>"
+        images = "".join(f"<img src='{esc(thumb_url(u))}' loading='lazy' alt=''>" for u in ex.get('images', [])[:2]) or NO_IMAGE_HTML
+        note = f"<div class='exercise-note'>{esc(ex['note'])}</div>" if ex.get('note') else ""
+        blocks.append(EXERCISE_BLOCK_TMPL.substitute(debug=debug, images=images, name=esc(ex.get('name', '')), details=esc(ex.get('details', '')), note=note))
+    return SESSION_BLOCK_TMPL.substitute(name=esc(_session.get('name', _session.get('Name', 'Sessione'))), exercises="".join(blocks))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_day_html(diet_hash, idx, _day):
+    meals = []
+    for meal in _day.get('meals', []):
+        foods = meal.get('foods', [])
+        foods_html = "".join(f"<div class='food-item'>• {esc(f)}</div>" for f in foods) if isinstance(foods, list) else f"<div class='food-item'>{esc(foods)}</div>"
+        notes = f"<div class='meal-notes'>📝 {esc(meal['notes'])}</div>" if meal.get('notes') else ""
+        meals.append(MEAL_BLOCK_TMPL.substitute(name=esc(meal.get('name', 'Pasto')), foods=foods_html, notes=notes))
+    return DAY_BLOCK_TMPL.substitute(meals="".join(meals))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_supplements_html(diet_hash, _supps):
+    return "".join(SUPP_BLOCK_TMPL.substitute(name=esc(x.get('name')), dose=esc(x.get('dose')), timing=esc(x.get('timing')), notes=esc(x.get('notes', ''))) for x in _supps)
+
+def _pick_page(labels, key, icon):
+    # Solo la pagina selezionata viene renderizzata
+    if len(labels) < 2: return 0
+    return st.radio(key, range(len(labels)), format_func=lambda i: f"{icon} {labels[i]}", horizontal=True, key=key, label_visibility="collapsed")
+
+@traced('render.plan')
 def render_preview_card(plan_json, show_debug=False):
     if not plan_json: return
     if isinstance(plan_json, str):
         try: plan_json = json.loads(plan_json)
         except: return
 
-    sessions = plan_json.get('sessions', plan_json.get('Sessions', []))
+    sessions = plan_sessions(plan_json)
     if not sessions: return
 
-    html_content = """<html><head><style>body{font-family:Arial;padding:20px;} h1{color:#E20613;} .session{margin-top:20px;border-bottom:2px solid #333;} .ex{margin-bottom:10px;}</style></head><body><h1>SCHEDA ALLENAMENTO - AREA 199</h1>"""
-    for s in sessions:
-        html_content += f"<div class='session'><h2>{s.get('name','Sessione')}</h2>"
-        for ex in s.get('exercises', []):
-            html_content += f"<div class='ex'><strong>{ex.get('name','Ex')}</strong><br>{ex.get('details','')}<br><em>{ex.get('note','')}</em></div>"
-        html_content += "</div>"
-    if plan_json.get('note_coach'):
-        html_content += f"<div style='margin-top:20px; border:1px solid #E20613; padding:10px;'><strong>NOTE COACH:</strong><br>{plan_json.get('note_coach')}</div>"
-    html_content += "</body></html>"
-    
-    st.markdown(create_download_link_html(html_content, "Scheda_Allenamento.html", "SCARICA SCHEDA ALLENAMENTO"), unsafe_allow_html=True)
-
-    for session in sessions:
-        s_name = session.get('name', session.get('Name', 'Sessione'))
-        st.markdown(f"<div class='session-header'>{s_name}</div>", unsafe_allow_html=True)
-        for ex in session.get('exercises', []):
-            with st.container():
-                if show_debug:
-                    debug_msg = ex.get('debug_info', 'N/A')
-                    color = "#ff4b4b" if "Nessun risultato" in debug_msg else "#4ade80"
-                    st.markdown(f"<div class='debug-img' style='color:{color}'>🔍 {debug_msg}</div>", unsafe_allow_html=True)
-                c1, c2 = st.columns([2, 3])
-                with c1:
-                    if ex.get('images'):
-                        cols_img = st.columns(2)
-                        if len(ex['images']) > 0: cols_img[0].image(ex['images'][0], use_container_width=True)
-                        if len(ex['images']) > 1: cols_img[1].image(ex['images'][1], use_container_width=True)
-                    else: st.markdown("<div style='color:#444; font-size:0.8em; padding:20px; border:1px dashed #333; text-align:center;'>NO IMAGE</div>", unsafe_allow_html=True)
-                with c2:
-                    st.markdown(f"<div class='exercise-name'>{ex.get('name','')}</div>", unsafe_allow_html=True)
-                    st.markdown(f"<div class='exercise-details'>{ex.get('details','')}</div>", unsafe_allow_html=True)
-                    if ex.get('note'): st.markdown(f"<div class='exercise-note'>{ex.get('note')}</div>", unsafe_allow_html=True)
-            st.divider()
-    
+    render_download_buttons(plan_json=plan_json)
+
+    h = content_hash(plan_json)
+    idx = _pick_page([s.get('name', s.get('Name', 'Sessione')) for s in sessions], f"page_plan_{h}", "🏋️")
+    session = sessions[idx]
+    st.markdown(render_session_html(h, idx, session, show_debug, _thumbs_ready(session)), unsafe_allow_html=True)
+
     if plan_json.get('note_coach'):
         st.info(f"📝 NOTE SCHEDA: {plan_json.get('note_coach')}")
 
+@traced('render.diet')
 def render_diet_card(diet_json):
     if not diet_json: return
     if isinstance(diet_json, str):
         try: diet_json = json.loads(diet_json)
         except: return
 
-    html_content = f"""<html><head><style>body{{font-family:Arial;padding:20px;}} h1{{color:#4ade80;}} h2{{color:#60a5fa;}} .meal{{margin-bottom:10px;padding-left:10px;border-left:3px solid #4ade80;}}</style></head><body><h1>PIANO ALIMENTARE</h1><p>Target: {diet_json.get('daily_calories','')} | Acqua: {diet_json.get('water_intake','')}</p>"""
-    
-    for day in diet_json.get('days', []):
-        html_content += f"<h3>{day.get('day_name')}</h3>"
-        for m in day.get('meals', []):
-            html_content += f"<div class='meal'><strong>{m.get('name')}</strong><br>{', '.join(m.get('foods',[]))}<br><em>{m.get('notes','')}</em></div>"
-    if diet_json.get('diet_note'): html_content += f"<br><strong>NOTE DIETA:</strong> {diet_json.get('diet_note')}"
-    
-    supps = diet_json.get('supplements', [])
-    if supps:
-        html_content += "<h2>INTEGRAZIONE</h2><ul>"
-        for s in supps:
-            html_content += f"<li><strong>{s.get('name')}</strong>: {s.get('dose')} ({s.get('timing')}) - <em>{s.get('notes','')}</em></li>"
-        html_content += "</ul>"
-    
-    html_content += "</body></html>"
-    st.markdown(create_download_link_html(html_content, "Piano_Nutrizionale.html", "SCARICA PIANO NUTRIZIONALE"), unsafe_allow_html=True)
+    render_download_buttons(diet_json=diet_json)
 
     if 'daily_calories' in diet_json:
         st.info(f"🔥 Target: {diet_json.get('daily_calories')} | 💧 {diet_json.get('water_intake', '2-3L')}")
 
+    h = content_hash(diet_json)
     days = diet_json.get('days', [])
-    for day in days:
-        with st.expander(f"📅 {day.get('day_name', 'Giornata Tipo')}", expanded=False):
-            for meal in day.get('meals', []):
-                st.markdown(f"<div class='meal-header'>{meal.get('name', 'Pasto')}</div>", unsafe_allow_html=True)
-                foods = meal.get('foods', [])
-                if isinstance(foods, list):
-                    for food in foods: st.markdown(f"<div class='food-item'>• {food}</div>", unsafe_allow_html=True)
-                else: st.write(foods)
-                if meal.get('notes'): st.caption(f"📝 {meal['notes']}")
+    if days:
+        idx = _pick_page([d.get('day_name', 'Giornata Tipo') for d in days], f"page_diet_{h}", "📅")
+        st.markdown(render_day_html(h, idx, days[idx]), unsafe_allow_html=True)
 
     if diet_json.get('diet_note'):
-        st.markdown(f"<div class='note-box'><strong style='color:#4ade80;'>💬 NOTE DIETA:</strong><br><span style='color:#ddd;'>{diet_json['diet_note']}</span></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='note-box'><strong style='color:#4ade80;'>💬 NOTE DIETA:</strong><br><span style='color:#ddd;'>{esc(diet_json['diet_note'])}</span></div>", unsafe_allow_html=True)
 
     supps = diet_json.get('supplements', [])
     if supps:
         st.markdown("---")
         st.markdown("### 💊 INTEGRAZIONE")
-        for s in supps:
-            st.markdown(f"""
-            <div class="supp-item">
-                <strong style="color:#60a5fa; font-size:1.1em;">{s.get('name')}</strong><br>
-                <span style="color:white;">⚖️ {s.get('dose')}</span> | 
-                <span style="color:#aaa;">🕒 {s.get('timing')}</span>
-                <div style="color:#666; font-style:italic; font-size:0.9em;">{s.get('notes','')}</div>
-            </div>
-            """, unsafe_allow_html=True)
+        st.markdown(render_supplements_html(h, supps), unsafe_allow_html=True)
 
 # ==============================================================================
 # 4. DASHBOARD COACH (BROWSER AGGIORNATO: 2 FOTO + FIX LINK)
 # ==============================================================================
+TREND_METRIC_BOX = """
+<div class="metric-box">
+    <div style="color:#888;">{key}</div>
+    <div style="font-size:1.8em; color:white;">{curr:.1f}</div>
+    <div style="display:flex; justify-content:space-between; font-size:0.9em;">
+        <span style="color:{color}">Prev: {d_prev:+.1f}</span>
+        <span style="color:#888">Start: {d_start:+.1f}</span>
+    </div>
+    <div style="color:#888; font-size:0.8em;">{rate}</div>
+</div>"""
+
+def trend_figure(trends, metric):
+    """Misure reali, media mobile e proiezione lineare di una metrica."""
+    series = trends['frame'][metric].dropna()
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=series.index, y=series.values, mode='markers', name='Misure',
+                             marker=dict(color='#E20613', size=8), customdata=trends['frame'].loc[series.index, 'Source'],
+                             hovertemplate='%{x|%d/%m/%Y}: %{y:.1f} (%{customdata})<extra></extra>'))
+    fig.add_trace(go.Scatter(x=trends['rolling'].index, y=trends['rolling'][metric].values, mode='lines',
+                             name=f'Media {TREND_ROLLING}', line=dict(color='#60a5fa', width=2)))
+    fit = trends['fit']
+    if fit and not np.isnan(fit['slope'][metric]):
+        xs = np.array([0.0, fit['last_x'] + TREND_HORIZON_DAYS])
+        dates = fit['origin'] + pd.to_timedelta(xs, unit='D')
+        fig.add_trace(go.Scatter(x=dates, y=fit['intercept'][metric] + fit['slope'][metric] * xs, mode='lines',
+                                 name=f'Tendenza (+{TREND_HORIZON_DAYS}g)', line=dict(color='#4ade80', dash='dash')))
+    fig.update_layout(title=metric, template='plotly_dark', height=320, margin=dict(l=10, r=10, t=40, b=10),
+                      paper_bgcolor='#000', plot_bgcolor='#111', legend=dict(orientation='h', y=-0.2))
+    return fig
+
+@traced('render.trends')
+def render_trend_panel(trends):
+    summary = trends['summary']
+    if summary.empty: st.info("Nessuna misura compilata."); return
+
+    row_cols = st.columns(3)
+    for i, (key, r) in enumerate(summary.iterrows()):
+        rate = "" if np.isnan(r['Δ / settimana']) else f"Trend: {r['Δ / settimana']:+.2f} / sett."
+        with row_cols[i % 3]:
+            st.markdown(TREND_METRIC_BOX.format(key=key, curr=r['Attuale'], d_prev=r['Δ prev'], d_start=r['Δ start'],
+                                                color='#4ade80' if r['Δ prev'] < 0 else '#f87171', rate=rate), unsafe_allow_html=True)
+
+    metrics = list(summary.index)
+    default = [m for m in ("Peso", BF_LABEL, "Addome") if m in metrics][:2] or metrics[:1]
+    chosen = st.multiselect("📉 GRAFICI", metrics, default=default, key="trend_metrics")
+    chart_cols = st.columns(2)
+    for i, metric in enumerate(chosen):
+        with chart_cols[i % 2]:
+            st.plotly_chart(trend_figure(trends, metric), key=f"trend_{metric}")
+
+    with st.expander("📋 TABELLA TREND", expanded=False):
+        st.dataframe(summary.round(2), width='stretch')
+        if BF_LABEL not in metrics: st.caption("BF Navy non calcolabile: servono Altezza, Sesso, Collo e Addome (+ Fianchi per le donne).")
+
+
+DISPATCH_STATE_ICONS = {'in coda': '🕒', 'in invio': '📤', 'inviata': '✅', 'fallita': '❌'}
+
+@st.fragment(run_every=5)
+def render_dispatch_panel():
+    """Si aggiorna da solo ogni 5s senza rieseguire il resto della dashboard."""
+    df = dispatch_status()
+    if df.empty: st.info("Nessun invio in coda."); return
+    counts = df['stato'].value_counts()
+    st.write(" | ".join(f"{DISPATCH_STATE_ICONS.get(k, '')} {k.upper()}: {v}" for k, v in counts.items()))
+    if counts.get('fallita', 0) and st.button("🔁 RIPROVA FALLITE", key="retry_dispatch"):
+        retry_failed_dispatch()
+    df['stato'] = df['stato'].map(lambda x: f"{DISPATCH_STATE_ICONS.get(x, '')} {x}")
+    st.dataframe(df, width='stretch', hide_index=True, column_config={
+        'creata': st.column_config.DatetimeColumn(format="DD/MM HH:mm:ss"),
+        'inviata': st.column_config.DatetimeColumn(format="DD/MM HH:mm:ss"),
+    })
+
+# --- FRAMMENTI DASHBOARD ---
+# Ogni blocco è un st.fragment: un widget al suo interno riesegue solo quel blocco.
+# Scrivere nella scheda o cercare un esercizio non rilegge roster, storico né grafici.
+@st.cache_data(show_spinner=False, ttl=SHEET_CACHE_TTL, max_entries=4)
+def get_roster(replica_version):
+    """Email degli atleti da ANAMNESI (replica o snapshot), ordinate e senza vuoti."""
+    if replica_ready('anamnesi'): raw_emails = replica_emails('anamnesi')
+    else: raw_emails = [str(r.get('E-mail') or r.get('Email')).strip().lower() for r in get_sheet_records("BIO ENTRY ANAMNESI")]
+    return sorted(list(set([e for e in raw_emails if e and e != 'none'])))
+
+@st.cache_data(show_spinner=False, ttl=SHEET_CACHE_TTL, max_entries=32)
+def athlete_snapshot(email, replica_version):
+    """Storico + trend dell'atleta: si ricalcola solo quando cambia la replica (o scade il ttl)."""
+    return get_athlete_trends(email)
+
+@st.fragment
+@traced('render.coach_browser')
+def render_exercise_browser(ex_db):
+    c1, c2 = st.columns([3, 1])
+    with c1:
+        db_len = len(ex_db)
+        st.write(f"📊 **Database:** {db_len} esercizi.")
+        if db_len < 800: st.error("⚠️ DATABASE INCOMPLETO! Premi il tasto rosso.")
+        else: st.success("✅ Database OK")
+        db_state = _exercise_db_state()
+        if db_state['error']: st.caption(f"⚠️ Ultimo aggiornamento fallito ({db_state['error']}): uso lo snapshot locale.")
+    with c2:
+        if st.button("🧨 FORZA RESET DB", type="primary"):
+            refresh_exercise_db(force=True)
+            st.cache_data.clear(); st.rerun()
+
+    st.info("Scrivi qui sotto il nome dell'esercizio per vedere le FOTO e il NOME ESATTO da copiare nella scheda.")
+    search_term = st.text_input("Cerca esercizio (es. 'plank', 'chest')", key="ex_search")
+    index = get_exercise_index(ex_db)
+    filters = {field: st.session_state.get(f"ex_facet_{field}", []) for field in EXERCISE_FACETS}
+    with span('exercises.search', query_len=len(search_term)):
+        hits, counts = index.search(search_term, filters)
+
+    # Opzioni fisse (tutti i valori del DB): cambiano solo i conteggi, la selezione resta
+    facet_cols = st.columns(len(EXERCISE_FACETS))
+    for col, (field, label) in zip(facet_cols, EXERCISE_FACETS.items()):
+        col.multiselect(label, list(index.facets[field]), key=f"ex_facet_{field}",
+                        format_func=lambda v, c=counts[field]: f"{v} ({c.get(v, 0)})")
+
+    if not search_term.strip() and not any(filters.values()): return
+    if not hits: st.warning("Nessun esercizio trovato."); return
+
+    # Nuova ricerca -> si riparte dalla prima pagina
+    signature = (search_term, tuple((f, tuple(v)) for f, v in filters.items()))
+    if st.session_state.get('ex_search_sig') != signature:
+        st.session_state['ex_search_sig'] = signature
+        st.session_state['ex_page'] = 0
+    pages = (len(hits) - 1) // SEARCH_PAGE_SIZE + 1
+    page = min(st.session_state.get('ex_page', 0), pages - 1)
+
+    c_prev, c_info, c_next = st.columns([1, 3, 1])
+    if c_prev.button("◀", key="ex_prev", disabled=page == 0):
+        page -= 1
+    if c_next.button("▶", key="ex_next", disabled=page >= pages - 1):
+        page += 1
+    page = max(0, min(page, pages - 1))  # i pulsanti mostrano lo stato del giro precedente
+    st.session_state['ex_page'] = page
+    c_info.write(f"Trovati {len(hits)} esercizi · pagina {page + 1}/{pages}")
+
+    # Solo la pagina visibile: una miniatura per esercizio, caricata dal browser quando entra in vista
+    cols_db = st.columns(4)
+    for idx, pos in enumerate(hits[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]):
+        res = index.exercises[pos]
+        with cols_db[idx % 4]:
+            st.markdown(f"**{esc(res['name'])}**")
+            images = index.images(res)
+            if images: st.markdown(f"<img src='{esc(thumb_url(images[0]))}' loading='lazy' alt='' style='width:100%; border-radius:4px;'>", unsafe_allow_html=True)
+            tags = " · ".join(str(v) for v in [", ".join(res.get('primaryMuscles', [])), res.get('equipment'), res.get('level')] if v)
+            if tags: st.caption(tags)
+            st.code(res['name'], language=None)
+
+@st.fragment
+@traced('render.coach_analysis')
+def render_athlete_analysis(sel_email):
+    history, trends = athlete_snapshot(sel_email, replica_version('anamnesi', 'checkup'))
+    st.header(f"Analisi: {sel_email}")
+    
+    if not history: st.warning("Nessun dato storico trovato.")
+    else:
+        st.success(f"📈 CONTROLLO ({len(history)} ingressi)")
+        render_trend_panel(trends)
+
+@st.fragment
+@traced('render.coach_editor')
+def render_plan_editor(sel_email, ex_db):
+    st.subheader("🛠️ CREAZIONE PIANO")
+    tab_w, tab_d = st.tabs(["🏋️‍♂️ ALLENAMENTO", "🥗 ALIMENTAZIONE (Dieta + Integrazione)"])
+
+    with tab_w:
+        raw_workout = st.text_area("1. Incolla Scheda Allenamento", height=300, key="input_raw_workout", placeholder="Sessione A...")
+        note_workout = st.text_area("2. Note specifiche Scheda", height=80, key="input_note_w")
+        
+    with tab_d:
+        st.info("Compila i box qui sotto. L'AI unirà tutto in un unico Piano Nutrizionale.")
+            
+        c_diet, c_supp = st.columns(2)
+        with c_diet:
+            st.markdown("#### 1. CIBO")
+            raw_diet = st.text_area("Lista Pasti", height=300, key="input_raw_diet", placeholder="Lunedì: Colazione...")
+        with c_supp:
+            st.markdown("#### 2. INTEGRAZIONE")
+            raw_supp = st.text_area("Lista Integratori", height=300, key="input_raw_supp", placeholder="Creatina 5g...")
+            
+        st.markdown("#### 3. NOTE NUTRIZIONE")
+        note_diet = st.text_area("Note per il cliente", height=80, key="input_note_d_combined")
+
+    st.markdown("---")
+    comment_input = st.text_area("💬 MESSAGGIO CHAT GENERALE (Visibile in alto a tutto)", height=100, key="input_comment")
+
+    force_regen = st.checkbox("♻️ Rigenera da zero (ignora la cache AI)", key="input_force_regen")
+    if st.button("🔄 GENERA ANTEPRIMA"):
+        with st.spinner("Elaborazione..."):
+            client_ai = openai.Client(api_key=st.secrets["openai_key"])
+            jobs = {}
+            local_plan, unparsed = parse_workout_text(raw_workout, note_workout) if raw_workout else (None, [])
+            has_local = local_plan and any(sess['exercises'] for sess in local_plan['sessions'])
+            if raw_workout and not has_local: jobs.update(build_session_jobs(raw_workout))
+            elif unparsed: jobs['w_lines'] = build_lines_prompt([line for *_, line in unparsed])
+            if raw_diet or raw_supp: jobs['d'] = build_diet_prompt(raw_diet, raw_supp, note_diet)
+            results = run_generation_jobs(client_ai, jobs, ex_db, use_cache=not force_regen, kinds={'w_lines': f"lines:{len(unparsed)}"})
+
+            # 1. WORKOUT (parser locale, l'AI solo per le righe che non riconosce)
+            plan = local_plan if has_local and not unparsed else None
+            if has_local and unparsed:
+                st.info(f"⚡ Parser locale: {len(unparsed)} righe inviate all'AI:\n\n" + "\n".join(f"- `{line}`" for *_, line in unparsed))
+                try: plan = merge_parsed_lines(local_plan, unparsed, json.loads(results['w_lines']).get('exercises', []))
+                except Exception as e:
+                    # meglio una generazione completa che una scheda con sessioni fuse
+                    st.warning(f"⚠️ Parser locale scartato ({e}): scheda generata per intero dall'AI.")
+                    session_jobs = build_session_jobs(raw_workout)
+                    jobs.update(session_jobs)
+                    results.update(run_generation_jobs(client_ai, session_jobs, ex_db, use_cache=not force_regen))
+            if plan is not None: st.session_state['generated_plan'] = attach_exercise_images(plan, ex_db)
+            elif any(k.startswith(SESSION_JOB) for k in jobs):
+                plan, failed = stitch_session_results(results, note_workout)
+                if failed: st.error("Errore AI Workout: sessioni " + ", ".join(str(i + 1) for i in failed) + " non generate.")
+                st.session_state['generated_plan'] = attach_exercise_images(plan, ex_db) if plan['sessions'] else None
+            else: st.session_state['generated_plan'] = None
+
+            # 2. DIETA
+            if 'd' in jobs:
+                try: st.session_state['generated_diet'] = json.loads(results['d'])
+                except: st.error("Errore AI Dieta/Supp")
+            else: st.session_state['generated_diet'] = None
+
+    if st.session_state.get('generated_plan') or st.session_state.get('generated_diet'):
+        st.markdown("---")
+        st.subheader("👁️ ANTEPRIMA FINALE")
+        if st.session_state['coach_comment']: st.info(f"💬 CHAT: {st.session_state['coach_comment']}")
+            
+        t1, t2 = st.tabs(["SCHEDA", "NUTRIZIONE"])
+        with t1:
+            if st.session_state.get('generated_plan'): render_preview_card(st.session_state['generated_plan'], show_debug=True)
+            else: st.warning("Nessuna scheda.")
+        with t2:
+            if st.session_state.get('generated_diet'): render_diet_card(st.session_state['generated_diet'])
+            else: st.warning("Nessuna dieta.")
+
+        if st.button("✅ INVIA TUTTO AL CLIENTE", type="primary"):
+            try:
+                full_name = f"{sel_email}" 
+                    
+                json_w = encode_plan_payload(st.session_state['generated_plan'])
+                json_d = encode_plan_payload(st.session_state['generated_diet'])
+                    
+                enqueue_plans([[
+                    datetime.now().strftime("%Y-%m-%d"),
+                    sel_email,
+                    full_name,
+                    st.session_state['coach_comment'],
+                    json_w, 
+                    json_d  
+                ]])
+                st.success("IN CODA DI INVIO! Puoi passare al prossimo atleta (stato in 📤 CODA INVII).")
+                st.session_state['generated_plan'] = None
+                st.session_state['generated_diet'] = None
+            except Exception as e: st.error(f"Errore coda: {e}")
+
+    last_sent = dispatch_status(limit=1, email=sel_email)
+    if not last_sent.empty:
+        item = last_sent.iloc[0]
+        st.caption(f"📤 Ultimo invio per {sel_email}: {DISPATCH_STATE_ICONS.get(item['stato'], '')} {item['stato'].upper()}"
+                   + (f" - {item['errore']}" if item['errore'] else ""))
+
+def render_trace_panel():
+    report = trace_report()
+    if report.empty: st.info("Nessuno span registrato."); return
+    st.dataframe(report, width='stretch')
+    _, counters = _trace_snapshot()
+    if counters: st.json(counters)
+    c1, c2, c3 = st.columns(3)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    c1.download_button("⬇️ JSON", data=export_trace_json, file_name=f"trace_{stamp}.json", mime="application/json", on_click="ignore", key="dl_trace_json")
+    c2.download_button("⬇️ CHROME TRACE", data=export_chrome_trace, file_name=f"chrome_trace_{stamp}.json", mime="application/json", on_click="ignore", key="dl_trace_chrome")
+    if c3.button("🧹 AZZERA", key="reset_traces"): reset_traces(); st.rerun()
 
 def coach_dashboard():
-    client = get_client()
     ex_db = load_exercise_db()
     
     st.title("DASHBOARD COACH")
 
     with st.expander("🔎 BROWSER DATABASE ESERCIZI", expanded=True):
-        c1, c2 = st.columns([3, 1])
-        with c1:
-            db_len = len(ex_db)
-            st.write(f"📊 **Database:** {db_len} esercizi.")
-            if db_len < 800: st.error("⚠️ DATABASE INCOMPLETO! Premi il tasto rosso.")
-            else: st.success("✅ Database OK")
-        with c2:
-            if st.button("🧨 FORZA RESET DB", type="primary"):
-                st.cache_data.clear(); st.rerun()
-
-        st.info("Scrivi qui sotto il nome dell'esercizio per vedere le FOTO e il NOME ESATTO da copiare nella scheda.")
-        search_term = st.text_input("Cerca esercizio (es. 'plank', 'chest')")
-        
-        if search_term and len(search_term) > 2:
-            results = [x for x in ex_db if search_term.lower() in x['name'].lower()]
-            if results:
-                st.write(f"Trovati {len(results)} esercizi:")
-                cols_db = st.columns(4) # Griglia da 4 colonne
-                
-                for idx, res in enumerate(results[:20]):
-                    with cols_db[idx % 4]:
-                        st.markdown(f"**{res['name']}**")
-                        
-                        # --- MODIFICA: MOSTRA TUTTE LE IMMAGINI (Max 2) ---
-                        if res.get('images'):
-                            # Base URL per GitHub
-                            BASE_URL = "https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/exercises/"
-                            
-                            for img_path in res['images'][:2]: # Prende al massimo le prime 2
-                                # Controllo intelligente: è un link completo o serve il pezzo prima?
-                                if img_path.startswith("http"):
-                                    full_url = img_path
-                                else:
-                                    full_url = BASE_URL + img_path
-                                
-                                st.image(full_url, use_container_width=True)
-                                
-                        st.code(res['name'], language=None)
-            else: st.warning("Nessun esercizio trovato.")
+        render_exercise_browser(ex_db)
     
+    with st.expander("⏳ RINNOVI ABBONAMENTI", expanded=False):
+        render_renewals_panel()
+
+    with st.expander("📤 CODA INVII", expanded=False):
+        render_dispatch_panel()
+
+    with st.expander("🤖 MODELLI AI", expanded=False):
+        st.dataframe(ai_router_report(), width='stretch')
+        cache = ai_cache_stats()
+        st.caption(f"Cache generazioni: {cache['voci']} voci, {cache['mb']} MB")
+        if st.button("🧹 SVUOTA CACHE AI", key="clear_ai_cache"):
+            ai_cache_clear()
+            st.success("Cache AI svuotata: le prossime anteprime vengono rigenerate.")
+
+    with st.expander("⏱️ PRESTAZIONI (TRACING)", expanded=False):
+        render_trace_panel()
+
+    with st.expander("🗄️ CACHE FOGLI", expanded=False):
+        st.json({'snapshot': sheet_cache_stats(), 'replica': replica_status()})
+        api = sheets_api_stats()
+        st.write("**API Sheets** (token bucket letture/scritture):")
+        st.json(api['buckets'])
+        if api['calls']: st.dataframe(pd.DataFrame(api['calls']).T.sort_values('calls', ascending=False), width='stretch')
+
     st.divider()
 
-    try:
-        sh_ana = client.open("BIO ENTRY ANAMNESI").sheet1
-        raw_emails = [str(r.get('E-mail') or r.get('Email')).strip().lower() for r in sh_ana.get_all_records()]
-        emails = sorted(list(set([e for e in raw_emails if e and e != 'none'])))
+    try: emails = get_roster(replica_version('anamnesi'))
     except: st.error("⚠️ Errore critico: Impossibile leggere BIO ENTRY ANAMNESI"); return
 
     sel_email = st.selectbox("SELEZIONA ATLETA", [""] + emails)
@@ -376,243 +2621,150 @@ def coach_dashboard():
             st.session_state['generated_diet'] = None 
             st.session_state['coach_comment'] = ""
 
-        history = get_full_history(sel_email)
-        st.header(f"Analisi: {sel_email}")
-        
-        if not history: st.warning("Nessun dato storico trovato.")
-        else:
-            last = history[-1]
-            st.success(f"📈 CONTROLLO ({len(history)} ingressi)")
-            metrics_keys = [k for k, v in last.items() if isinstance(v, (int, float)) and v > 0]
-            row_cols = st.columns(3)
-            for i, key in enumerate(metrics_keys):
-                vals = [h.get(key, 0) for h in history]
-                curr = vals[-1]; prev = vals[-2] if len(vals)>1 else vals[0]; start = vals[0]
-                d_prev = curr - prev; d_start = curr - start
-                with row_cols[i % 3]:
-                    st.markdown(f"""
-                    <div class="metric-box">
-                        <div style="color:#888;">{key}</div>
-                        <div style="font-size:1.8em; color:white;">{curr}</div>
-                        <div style="display:flex; justify-content:space-between; font-size:0.9em;">
-                            <span style="color:{'#4ade80' if d_prev<0 else '#f87171'}">Prev: {d_prev:+.1f}</span>
-                            <span style="color:#888">Start: {d_start:+.1f}</span>
-                        </div>
-                    </div>""", unsafe_allow_html=True)
+        render_athlete_analysis(sel_email)
 
         st.divider()
 
-        st.subheader("🛠️ CREAZIONE PIANO")
-        tab_w, tab_d = st.tabs(["🏋️‍♂️ ALLENAMENTO", "🥗 ALIMENTAZIONE (Dieta + Integrazione)"])
-
-        with tab_w:
-            raw_workout = st.text_area("1. Incolla Scheda Allenamento", height=300, key="input_raw_workout", placeholder="Sessione A...")
-            note_workout = st.text_area("2. Note specifiche Scheda", height=80, key="input_note_w")
-        
-        with tab_d:
-            st.info("Compila i box qui sotto. L'AI unirà tutto in un unico Piano Nutrizionale.")
-            
-            c_diet, c_supp = st.columns(2)
-            with c_diet:
-                st.markdown("#### 1. CIBO")
-                raw_diet = st.text_area("Lista Pasti", height=300, key="input_raw_diet", placeholder="Lunedì: Colazione...")
-            with c_supp:
-                st.markdown("#### 2. INTEGRAZIONE")
-                raw_supp = st.text_area("Lista Integratori", height=300, key="input_raw_supp", placeholder="Creatina 5g...")
-            
-            st.markdown("#### 3. NOTE NUTRIZIONE")
-            note_diet = st.text_area("Note per il cliente", height=80, key="input_note_d_combined")
-
-        st.markdown("---")
-        comment_input = st.text_area("💬 MESSAGGIO CHAT GENERALE (Visibile in alto a tutto)", height=100, key="input_comment")
-
-        if st.button("🔄 GENERA ANTEPRIMA"):
-            with st.spinner("Elaborazione..."):
-                client_ai = openai.Client(api_key=st.secrets["openai_key"])
-                
-                # 1. WORKOUT
-                if raw_workout:
-                    prompt_w = f"""
-                    Agisci come un parser JSON "FOTOCOPIATRICE".
-                    
-                    INPUT UTENTE:
-                    {raw_workout}
-                    
-                    NOTE COACH:
-                    {note_workout}
-                    
-                    REGOLA SUPREMA: NON TRADURRE NULLA.
-                    Se l'input è in Italiano, l'output DEVE ESSERE IN ITALIANO.
-                    Copia 'details' e 'note' ESATTAMENTE come scritti dall'utente, parola per parola.
-                    Solo 'search_name' deve essere in inglese per il database immagini.
-                    
-                    SCHEMA JSON:
-                    {{
-                        "sessions": [
-                            {{
-                                "name": "Nome Sessione",
-                                "exercises": [
-                                    {{
-                                        "name": "Nome Esercizio (Originale)",
-                                        "search_name": "Nome in Inglese (Solo per ricerca)",
-                                        "details": "Dettagli (COPIA ESATTA DALL'INPUT)",
-                                        "note": "Note (COPIA ESATTA DALL'INPUT)"
-                                    }}
-                                ]
-                            }}
-                        ],
-                        "note_coach": "{note_workout}"
-                    }}
-                    """
-                    try:
-                        res_w = client_ai.chat.completions.create(model="gpt-4o", messages=[{"role":"system","content":prompt_w}])
-                        clean_w = clean_json_response(res_w.choices[0].message.content)
-                        plan_json = json.loads(clean_w)
-                        for s in plan_json.get('sessions', []):
-                            for ex in s.get('exercises', []):
-                                query = ex.get('search_name', ex.get('name'))
-                                imgs, debug_msg = find_exercise_images(query, ex_db)
-                                ex['images'] = imgs[:2]
-                                ex['debug_info'] = f"Query: '{query}' -> {debug_msg}"
-                        st.session_state['generated_plan'] = plan_json
-                    except: st.error("Errore AI Workout")
-                else: st.session_state['generated_plan'] = None
-
-                # 2. DIETA
-                if raw_diet or raw_supp:
-                    prompt_d = f"""
-                    Agisci come un nutrizionista sportivo ITALIANO.
-                    
-                    INPUT DIETA: {raw_diet if raw_diet else 'Nessuna'}. 
-                    INPUT INTEGRAZIONE: {raw_supp if raw_supp else 'Nessuna'}.
-                    NOTE DEL COACH: {note_diet}.
-                    
-                    ISTRUZIONI CRITICHE:
-                    1. LINGUA: Usa SOLO ITALIANO.
-                    2. CALORIE: Copia TUTTA la stringa dei target calorici (es. "2300 Training / 1900 Rest"). NON tagliarla.
-                    3. GIORNI MULTIPLI: Se l'input contiene più tipologie di giorni, CREA un elemento nell'array 'days' PER OGNUNO DI ESSI. 
-                    4. NOMI GIORNI: Usa ESATTAMENTE i nomi scritti dall'utente.
-                    
-                    SCHEMA JSON OBBLIGATORIO:
-                    {{
-                        "daily_calories": "Copia esatta della stringa target", 
-                        "water_intake": "es. 3-4 Litri", 
-                        "diet_note": "{note_diet}",
-                        "days": [ 
-                            {{ 
-                                "day_name": "Nome Giorno 1", 
-                                "meals": [ {{ "name": "Colazione", "foods": ["..."], "notes": "..." }} ] 
-                            }}
-                        ],
-                        "supplements": [ 
-                            {{ "name": "Creatina", "dose": "5g", "timing": "Post Workout", "notes": "..." }} 
-                        ]
-                    }}
-                    """
-                    try:
-                        res_d = client_ai.chat.completions.create(model="gpt-4o", messages=[{"role":"system","content":prompt_d}])
-                        diet_json = json.loads(clean_json_response(res_d.choices[0].message.content))
-                        st.session_state['generated_diet'] = diet_json
-                    except: st.error("Errore AI Dieta/Supp")
-                else: st.session_state['generated_diet'] = None
-
-        if st.session_state.get('generated_plan') or st.session_state.get('generated_diet'):
-            st.markdown("---")
-            st.subheader("👁️ ANTEPRIMA FINALE")
-            if st.session_state['coach_comment']: st.info(f"💬 CHAT: {st.session_state['coach_comment']}")
-            
-            t1, t2 = st.tabs(["SCHEDA", "NUTRIZIONE"])
-            with t1:
-                if st.session_state.get('generated_plan'): render_preview_card(st.session_state['generated_plan'], show_debug=True)
-                else: st.warning("Nessuna scheda.")
-            with t2:
-                if st.session_state.get('generated_diet'): render_diet_card(st.session_state['generated_diet'])
-                else: st.warning("Nessuna dieta.")
-
-            if st.button("✅ INVIA TUTTO AL CLIENTE", type="primary"):
-                try:
-                    db = client.open("AREA199_DB").worksheet("SCHEDE_ATTIVE")
-                    full_name = f"{sel_email}" 
-                    
-                    json_w = json.dumps(st.session_state['generated_plan']) if st.session_state['generated_plan'] else ""
-                    json_d = json.dumps(st.session_state['generated_diet']) if st.session_state['generated_diet'] else ""
-                    
-                    db.append_row([
-                        datetime.now().strftime("%Y-%m-%d"),
-                        sel_email,
-                        full_name,
-                        st.session_state['coach_comment'],
-                        json_w, 
-                        json_d  
-                    ])
-                    st.success("INVIATA CORRETTAMENTE!")
-                    st.session_state['generated_plan'] = None
-                    st.session_state['generated_diet'] = None
-                except Exception as e: st.error(f"Errore DB: {e}")
+        render_plan_editor(sel_email, ex_db)
+
+# --- ANALISI COORTE ---
+COHORT_STATE_COLORS = {'OK': '#4ade80', 'FERMO': '#facc15', 'IN RITARDO': '#E20613'}
+
+@traced('render.cohort')
+def cohort_dashboard():
+    st.title("ANALISI COORTE")
+    try: stats, summary, failed = get_cohort()
+    except SheetsBusyError as e: st.warning(str(e)); return
+    if failed: st.error(f"⚠️ Impossibile leggere {', '.join(failed)}: statistiche parziali.")
+    if stats.empty: st.warning("Nessun dato in ANAMNESI / CHECK-UP."); return
+
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("ATLETI", summary['atleti'])
+    c2.metric(f"IN RITARDO (>{COHORT_STALE_DAYS}g)", summary['in_ritardo'])
+    c3.metric(f"FERMI (<{COHORT_STALL_RATE} kg/sett.)", summary['fermi'])
+    med = summary['mediana_delta_sett']
+    c4.metric("Δ PESO MEDIANO / SETT.", f"{med:+.2f} kg" if med is not None else "-")
+
+    view = st.radio("FILTRO", ["TUTTI", "IN RITARDO", "FERMO", "OK"], horizontal=True, key="cohort_filter")
+    table = stats if view == "TUTTI" else stats.loc[stats['Stato'] == view]
+    st.caption(f"{len(table)} atleti - clicca sulle intestazioni per ordinare.")
+    st.dataframe(table, width='stretch', column_config={
+        'Primo': st.column_config.DateColumn(format="DD/MM/YYYY"),
+        'Ultimo': st.column_config.DateColumn(format="DD/MM/YYYY"),
+        'Ultimo check-up': st.column_config.DateColumn(format="DD/MM/YYYY"),
+        'Δ peso / sett.': st.column_config.NumberColumn(format="%+.2f"),
+        'Δ peso totale': st.column_config.NumberColumn(format="%+.1f"),
+    })
+
+    plot = stats.reset_index()
+    ch1, ch2 = st.columns(2)
+    with ch1:
+        fig = go.Figure()
+        for state, color in COHORT_STATE_COLORS.items():
+            part = plot.loc[plot['Stato'] == state]
+            fig.add_trace(go.Scatter(x=part['Giorni da ultimo'], y=part['Δ peso / sett.'], mode='markers', name=state,
+                                     marker=dict(color=color, size=9), text=part['Email'],
+                                     hovertemplate='%{text}<br>%{x} giorni - %{y:+.2f} kg/sett.<extra></extra>'))
+        fig.add_vline(x=COHORT_STALE_DAYS, line_dash='dot', line_color='#888')
+        fig.update_layout(title="Giorni dall'ultimo controllo vs Δ peso / sett.", template='plotly_dark', height=360,
+                          paper_bgcolor='#000', plot_bgcolor='#111', margin=dict(l=10, r=10, t=40, b=10))
+        st.plotly_chart(fig, key="cohort_scatter")
+    with ch2:
+        weekly = summary['controlli_settimanali']
+        fig = go.Figure(go.Bar(x=weekly.index, y=weekly.values, marker_color='#E20613'))
+        fig.update_layout(title="Controlli per settimana", template='plotly_dark', height=360,
+                          paper_bgcolor='#000', plot_bgcolor='#111', margin=dict(l=10, r=10, t=40, b=10))
+        st.plotly_chart(fig, key="cohort_weekly")
 
 # ==============================================================================
 # 5. DASHBOARD ATLETA (CON PALLINO VERDE E DATA IN ALTO)
 # ==============================================================================
 
+SUBSCRIPTION_TTL = 300  # secondi, sullo snapshot condiviso del foglio
+EXPIRY_WARNING_DAYS = 5
+
+def build_subscription_index(records, now=None):
+    """Righe di CLIENTI_ATTIVI -> {email normalizzata: stato}, con scadenze e colori calcolati per tutti in un colpo."""
+    df = pd.DataFrame(records)
+    if df.empty or 'Email' not in df.columns: return {}
+    now = now or datetime.now()
+    df['email'] = df['Email'].astype(str).str.strip().str.lower()
+    df = df.drop_duplicates('email', keep='first')  # come prima: vale la prima riga dell'email
+    scadenza = df['Scadenza'].astype(str) if 'Scadenza' in df.columns else pd.Series('None', index=df.index)
+    expiry = pd.to_datetime(scadenza, format="%d/%m/%Y", errors='coerce')
+    days_left = (expiry - now).dt.days + 1
+    state = np.select([expiry.isna(), expiry < now, days_left <= EXPIRY_WARNING_DAYS], ['invalid', 'red', 'yellow'], 'green')
+    out = pd.DataFrame({
+        'email': df['email'],
+        'nome': df['Nome'].astype(str) if 'Nome' in df.columns else "",
+        'scadenza': scadenza,
+        'days_left': days_left.fillna(0).astype(int),
+        'state': state,
+        'link': df['Link_Pagamento'].astype(str).str.strip() if 'Link_Pagamento' in df.columns else "",
+    })
+    return {r['email']: r for r in out.to_dict('records')}
+
+@st.cache_data(ttl=SUBSCRIPTION_TTL, max_entries=4, show_spinner=False)
+def _replica_subscription_index(replica_version):
+    return build_subscription_index(replica_rows('clienti'))
+
+def get_subscription_index():
+    """Indice abbonamenti condiviso, ricostruito una volta per snapshot di CLIENTI_ATTIVI. None se il foglio non esiste."""
+    if replica_ready('clienti'): return _replica_subscription_index(replica_version('clienti'))
+    try: return get_sheet_derived("AREA199_DB", "CLIENTI_ATTIVI", 'subscriptions', build_subscription_index, ttl=SUBSCRIPTION_TTL)
+    except gspread.exceptions.WorksheetNotFound: return None
+
+@traced('login.subscription')
 def check_subscription_status(email):
     """
     Ritorna: is_blocked, status_color, msg, custom_link, scadenza_str
+    SheetsBusyError passa al chiamante: un limite di quota non deve sembrare un abbonamento scaduto.
     """
     try:
-        client = get_client()
-        try:
-            sh = client.open("AREA199_DB").worksheet("CLIENTI_ATTIVI")
-        except:
+        index = get_subscription_index()
+        if index is None:
             return False, 'green', "Foglio Controllo Assente", "", "N/A"
 
-        records = sh.get_all_records()
-        clean_email = email.strip().lower()
-        
-        user_record = None
-        for r in records:
-            if str(r.get('Email')).strip().lower() == clean_email:
-                user_record = r
-                break
-        
-        if not user_record:
+        user = index.get(email.strip().lower())
+        if not user:
             return True, 'red', "❌ UTENTE NON TROVATO. Contatta il coach.", "", ""
-            
-        # Dati Utente
-        scadenza_str = str(user_record.get('Scadenza'))
-        custom_link = str(user_record.get('Link_Pagamento', '')).strip()
-        
-        try:
-            scadenza_dt = datetime.strptime(scadenza_str, "%d/%m/%Y")
-            oggi = datetime.now()
-            
-            # Calcoliamo la differenza di giorni
-            delta = scadenza_dt - oggi
-            giorni_rimanenti = delta.days + 1 
-            
-            # CASO 1: SCADUTO (Zona Rossa)
-            if scadenza_dt < oggi: 
-                return True, 'red', f"⛔ ABBONAMENTO SCADUTO IL {scadenza_str}", custom_link, scadenza_str
-            
-            # CASO 2: IN SCADENZA (Zona Gialla - 5 giorni o meno)
-            elif giorni_rimanenti <= 5:
-                return False, 'yellow', f"⚠️ ATTENZIONE: Il tuo abbonamento scade tra {giorni_rimanenti} giorni.", custom_link, scadenza_str
-            
-            # CASO 3: ATTIVO (Zona Verde)
-            else:
-                return False, 'green', "OK", custom_link, scadenza_str
-                
-        except:
-            return True, 'red', "⚠️ ERRORE FORMATO DATA (Usa GG/MM/AAAA).", custom_link, scadenza_str
 
+        scadenza_str, custom_link = user['scadenza'], user['link']
+        if user['state'] == 'invalid':
+            return True, 'red', "⚠️ ERRORE FORMATO DATA (Usa GG/MM/AAAA).", custom_link, scadenza_str
+        # CASO 1: SCADUTO (Zona Rossa)
+        if user['state'] == 'red':
+            return True, 'red', f"⛔ ABBONAMENTO SCADUTO IL {scadenza_str}", custom_link, scadenza_str
+        # CASO 2: IN SCADENZA (Zona Gialla - 5 giorni o meno)
+        if user['state'] == 'yellow':
+            return False, 'yellow', f"⚠️ ATTENZIONE: Il tuo abbonamento scade tra {user['days_left']} giorni.", custom_link, scadenza_str
+        # CASO 3: ATTIVO (Zona Verde)
+        return False, 'green', "OK", custom_link, scadenza_str
+
+    except SheetsBusyError: raise  # quota Sheets, non abbonamento: niente blocco, ci pensa il chiamante
     except Exception as e:
         return True, 'red', f"Errore verifica: {e}", "", ""
 
+def render_renewals_panel():
+    try: index = get_subscription_index()
+    except Exception as e:
+        st.error(f"Errore lettura CLIENTI_ATTIVI: {e}"); return
+    if not index:
+        st.info("Nessun dato in CLIENTI_ATTIVI."); return
+    df = pd.DataFrame(index.values())
+    blocked = df[df['state'].isin(['red', 'invalid'])]
+    expiring = df[df['state'] == 'yellow'].sort_values('days_left')
+    c1, c2, c3 = st.columns(3)
+    c1.metric("🔴 Bloccati", len(blocked))
+    c2.metric("🟡 In scadenza", len(expiring))
+    c3.metric("🟢 Attivi", int((df['state'] == 'green').sum()))
+    cols = {'email': "Email", 'nome': "Nome", 'scadenza': "Scadenza", 'days_left': "Giorni", 'link': st.column_config.LinkColumn("Link_Pagamento")}
+    for title, part in (("🟡 IN SCADENZA", expiring), ("🔴 SCADUTI / DATA NON VALIDA", blocked)):
+        if not part.empty:
+            st.markdown(f"**{title}**")
+            st.dataframe(part[list(cols)], column_config=cols, hide_index=True, use_container_width=True)
+
 def athlete_dashboard():
-    client = get_client()
-    
-    # LINK DI RISERVA
-    LINK_DEFAULT = "https://revolut.me/antope1909?currency=EUR&amount=40" 
-    
     st.sidebar.title("Login Atleta")
     email = st.sidebar.text_input("La tua Email")
     
@@ -620,99 +2772,117 @@ def athlete_dashboard():
         if not email:
             st.warning("Inserisci la tua email.")
             return
+        st.session_state['athlete_email'] = email
+
+    # Il login resta valido nei rerun (cambio sessione/giornata) finché non cambia l'email
+    if not email or st.session_state.get('athlete_email') != email: return
 
-        # 1. CONTROLLO STATO
-        is_blocked, color, msg, user_link, scadenza_display = check_subscription_status(email)
-        final_link = user_link if user_link.startswith("http") else LINK_DEFAULT
+    # Login atleta: precedenza sulle quote Sheets rispetto a dashboard coach e sync
+    with sheets_priority('athlete'):
+        render_athlete_plan(email)
+
+@traced('render.athlete')
+def render_athlete_plan(email):
+    # LINK DI RISERVA
+    LINK_DEFAULT = "https://revolut.me/antope1909?currency=EUR&amount=40" 
+
+    prime_login_sheets()
+
+    # 1. CONTROLLO STATO
+    try: is_blocked, color, msg, user_link, scadenza_display = check_subscription_status(email)
+    except SheetsBusyError as e: st.warning(str(e)); return
+    final_link = user_link if user_link.startswith("http") else LINK_DEFAULT
+    
+    # --- GESTIONE ZONA ROSSA (BLOCCO) ---
+    if is_blocked:
+        st.error(msg)
+        st.markdown(f"""
+        <div style="background-color:#450a0a; padding:20px; border-radius:10px; border:1px solid #ef4444; text-align:center; margin-bottom: 20px;">
+            <h2 style="color:#f87171; margin-top:0;">ACCESSO NEGATO</h2>
+            <p style="color:#fca5a5; font-size:1.1em;">Il percorso è in pausa amministrativa.</p>
+            <a href="{final_link}" target="_blank" style="background-color:#dc2626; color:white; padding:15px 30px; text-decoration:none; border-radius:5px; font-weight:bold; font-size:1.2em; display:inline-block; margin-top:15px; border:1px solid white;">
+                💳 RINNOVA ORA PER SBLOCCARE
+            </a>
+        </div>
+        """, unsafe_allow_html=True)
+        return # STOP
         
-        # --- GESTIONE ZONA ROSSA (BLOCCO) ---
-        if is_blocked:
-            st.error(msg)
-            st.markdown(f"""
-            <div style="background-color:#450a0a; padding:20px; border-radius:10px; border:1px solid #ef4444; text-align:center; margin-bottom: 20px;">
-                <h2 style="color:#f87171; margin-top:0;">ACCESSO NEGATO</h2>
-                <p style="color:#fca5a5; font-size:1.1em;">Il percorso è in pausa amministrativa.</p>
-                <a href="{final_link}" target="_blank" style="background-color:#dc2626; color:white; padding:15px 30px; text-decoration:none; border-radius:5px; font-weight:bold; font-size:1.2em; display:inline-block; margin-top:15px; border:1px solid white;">
-                    💳 RINNOVA ORA PER SBLOCCARE
-                </a>
+    # --- MOSTRA SCADENZA CON PALLINO VERDE (Solo se attivo) ---
+    if scadenza_display and scadenza_display != "N/A":
+        # Se è giallo mette pallino giallo, altrimenti verde
+        pallino = "🟡" if color == 'yellow' else "🟢"
+        colore_testo = "#facc15" if color == 'yellow' else "#4ade80"
+        
+        st.markdown(f"""
+        <div style="text-align: right; font-size: 0.9em; color: #888; margin-bottom: 10px; border-bottom: 1px solid #333; padding-bottom: 5px;">
+            {pallino} Scadenza Piano: <strong style="color: {colore_testo};">{scadenza_display}</strong>
+        </div>
+        """, unsafe_allow_html=True)
+
+    # --- GESTIONE ZONA GIALLA (AVVISO EXTRA) ---
+    if color == 'yellow':
+        st.markdown(f"""
+        <div style="background-color:#422006; padding:15px; border-radius:10px; border:1px solid #eab308; display:flex; justify-content:space-between; align-items:center; margin-bottom:20px;">
+            <div>
+                <strong style="color:#facc15; font-size:1.2em;">⚠️ SCADENZA IMMINENTE</strong><br>
+                <span style="color:#fde047;">{msg}</span>
             </div>
-            """, unsafe_allow_html=True)
-            return # STOP
+            <a href="{final_link}" target="_blank" style="background-color:#ca8a04; color:black; padding:10px 20px; text-decoration:none; border-radius:5px; font-weight:bold; white-space:nowrap; margin-left:10px;">
+                RINNOVA
+            </a>
+        </div>
+        """, unsafe_allow_html=True)
+
+    # 2. CARICAMENTO SCHEDA
+    try:
+        last_plan = get_latest_plan(email)
+        
+        if last_plan:
+            st.title(f"Piano del {last_plan['Data']}")
+            if last_plan.get('Commento'): st.info(f"💬 **Messaggio dal Coach:**\n\n{last_plan['Commento']}")
             
-        # --- MOSTRA SCADENZA CON PALLINO VERDE (Solo se attivo) ---
-        if scadenza_display and scadenza_display != "N/A":
-            # Se è giallo mette pallino giallo, altrimenti verde
-            pallino = "🟡" if color == 'yellow' else "🟢"
-            colore_testo = "#facc15" if color == 'yellow' else "#4ade80"
+            raw_w = last_plan.get('JSON_Completo') or last_plan.get('JSON_Scheda')
+            raw_d = last_plan.get('JSON_Dieta') 
             
-            st.markdown(f"""
-            <div style="text-align: right; font-size: 0.9em; color: #888; margin-bottom: 10px; border-bottom: 1px solid #333; padding-bottom: 5px;">
-                {pallino} Scadenza Piano: <strong style="color: {colore_testo};">{scadenza_display}</strong>
-            </div>
-            """, unsafe_allow_html=True)
-
-        # --- GESTIONE ZONA GIALLA (AVVISO EXTRA) ---
-        if color == 'yellow':
-            st.markdown(f"""
-            <div style="background-color:#422006; padding:15px; border-radius:10px; border:1px solid #eab308; display:flex; justify-content:space-between; align-items:center; margin-bottom:20px;">
-                <div>
-                    <strong style="color:#facc15; font-size:1.2em;">⚠️ SCADENZA IMMINENTE</strong><br>
-                    <span style="color:#fde047;">{msg}</span>
-                </div>
-                <a href="{final_link}" target="_blank" style="background-color:#ca8a04; color:black; padding:10px 20px; text-decoration:none; border-radius:5px; font-weight:bold; white-space:nowrap; margin-left:10px;">
-                    RINNOVA
-                </a>
-            </div>
-            """, unsafe_allow_html=True)
+            tab_w, tab_n = st.tabs(["🏋️‍♂️ ALLENAMENTO", "🥗 NUTRIZIONE"])
+            
+            with tab_w:
+                if raw_w:
+                    try:
+                        render_preview_card(decode_plan_payload(raw_w), show_debug=False)
+                    except: st.error("Errore visualizzazione scheda.")
+                else: st.info("Nessun allenamento.")
 
-        # 2. CARICAMENTO SCHEDA
-        try:
-            sh = client.open("AREA199_DB").worksheet("SCHEDE_ATTIVE")
-            data = sh.get_all_records()
-            my_plans = [x for x in data if str(x.get('Email','')).strip().lower() == email.strip().lower()]
+            with tab_n:
+                if raw_d:
+                    try:
+                        render_diet_card(decode_plan_payload(raw_d))
+                    except: st.error("Errore visualizzazione nutrizione.")
+                else: st.info("Nessuna alimentazione.")
+
+        else: 
+            st.warning("Abbonamento ATTIVO, ma non hai ancora schede caricate dal Coach.")
             
-            if my_plans:
-                last_plan = my_plans[-1]
-                st.title(f"Piano del {last_plan['Data']}")
-                if last_plan.get('Commento'): st.info(f"💬 **Messaggio dal Coach:**\n\n{last_plan['Commento']}")
-                
-                raw_w = last_plan.get('JSON_Completo') or last_plan.get('JSON_Scheda')
-                raw_d = last_plan.get('JSON_Dieta') 
-                
-                tab_w, tab_n = st.tabs(["🏋️‍♂️ ALLENAMENTO", "🥗 NUTRIZIONE"])
-                
-                with tab_w:
-                    if raw_w:
-                        try:
-                            try: w_json = json.loads(raw_w)
-                            except: w_json = ast.literal_eval(raw_w)
-                            render_preview_card(w_json, show_debug=False)
-                        except: st.error("Errore visualizzazione scheda.")
-                    else: st.info("Nessun allenamento.")
-
-                with tab_n:
-                    if raw_d:
-                        try:
-                            try: d_json = json.loads(raw_d)
-                            except: d_json = ast.literal_eval(raw_d)
-                            render_diet_card(d_json)
-                        except: st.error("Errore visualizzazione nutrizione.")
-                    else: st.info("Nessuna alimentazione.")
-
-            else: 
-                st.warning("Abbonamento ATTIVO, ma non hai ancora schede caricate dal Coach.")
-                
-        except Exception as e: st.error(f"Errore connessione: {e}")
+    except SheetsBusyError as e: st.warning(str(e))
+    except Exception as e: st.error(f"Errore connessione: {e}")
 
 # ==============================================================================
 # MAIN
 # ==============================================================================
 
 def main():
+    start_rerun()
+    with span('rerun'):
+        route()
+
+def route():
     mode = st.sidebar.radio("MODALITÀ", ["Coach Admin", "Atleta"])
     if mode == "Coach Admin":
         pwd = st.sidebar.text_input("Password", type="password")
-        if pwd == "PETRUZZI199": coach_dashboard()
+        if pwd == "PETRUZZI199":
+            page = st.sidebar.radio("SEZIONE", ["👤 Atleta", "📊 Coorte"])
+            if page == "📊 Coorte": cohort_dashboard()
+            else: coach_dashboard()
     else: athlete_dashboard()
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""Backend HTTP locale per i benchmark: endpoint OpenAI (chat completions, anche in streaming)
+con latenza configurabile e i file del free-exercise-db (exercises.json e foto) al posto di GitHub."""
+import io
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+GITHUB_RAW = "https://raw.githubusercontent.com/"
+
+WORKOUT_REPLY = {"sessions": [{"name": "Sessione A", "exercises": [
+    {"name": "Panca piana", "search_name": "barbell bench press", "details": "4x8", "note": ""},
+    {"name": "Rematore con manubrio", "search_name": "dumbbell bent over row", "details": "4x10", "note": "Schiena neutra"},
+    {"name": "Leg curl", "search_name": "lying leg curl", "details": "3x12", "note": ""}]}], "note_coach": ""}
+DIET_REPLY = {"daily_calories": "2400", "water_intake": "3L", "diet_note": "",
+              "days": [{"day_name": "ON", "meals": [{"name": "Colazione", "foods": ["Avena 80g", "Uova 3"], "notes": ""},
+                                                     {"name": "Pranzo", "foods": ["Riso 100g", "Pollo 150g"], "notes": ""}]}],
+              "supplements": [{"name": "Creatina", "dose": "5g", "timing": "post workout"}]}
+
+
+def _jpeg():
+    buf = io.BytesIO()
+    Image.new("RGB", (320, 240), (226, 6, 19)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def reply_for(prompt):
+    """Risposta nello schema che il prompt chiede (righe singole, sessione di scheda, dieta)."""
+    m = re.search(r"ESATTAMENTE (\d+) elementi", prompt)
+    if m:
+        return {"exercises": [dict(WORKOUT_REPLY["sessions"][0]["exercises"][i % 3], line=i + 1, type="exercise") for i in range(int(m.group(1)))]}
+    return WORKOUT_REPLY if '"sessions"' in prompt else DIET_REPLY
+
+
+class FakeBackend:
+    """latency: attesa prima del primo token; token_delay: attesa tra un chunk e l'altro dello stream."""
+
+    def __init__(self, exercises, latency=0.5, token_delay=0.01, chunk_chars=16):
+        self.exercises, self.latency, self.token_delay, self.chunk_chars = exercises, latency, token_delay, chunk_chars
+        self.hits, self.lock, self.image = Counter(), threading.Lock(), _jpeg()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def do_GET(self): backend.github(self)
+
+            def do_POST(self): backend.completions(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def hit(self, name):
+        with self.lock: self.hits[name] += 1
+
+    def _send(self, h, status, body, ctype):
+        h.send_response(status)
+        h.send_header("Content-Type", ctype)
+        h.send_header("Content-Length", str(len(body)))
+        h.end_headers()
+        h.wfile.write(body)
+
+    def github(self, h):
+        if h.path.endswith("/dist/exercises.json"):
+            self.hit('github.exercises')
+            return self._send(h, 200, json.dumps(self.exercises).encode(), "application/json")
+        if h.path.endswith(".jpg"):
+            self.hit('github.image')
+            return self._send(h, 200, self.image, "image/jpeg")
+        self._send(h, 404, b"not found", "text/plain")
+
+    def completions(self, h):
+        if not h.path.endswith("/chat/completions"): return self._send(h, 404, b"{}", "application/json")
+        req = json.loads(h.rfile.read(int(h.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "\n".join(str(m.get("content", "")) for m in req.get("messages", []))
+        text, model = json.dumps(reply_for(prompt), ensure_ascii=False), req.get("model", "gpt-4o")
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4, "total_tokens": (len(prompt) + len(text)) // 4}
+        self.hit(f"openai.{model}")
+        time.sleep(self.latency)
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": model}
+        if not req.get("stream"):
+            body = dict(base, object="chat.completion", usage=usage,
+                        choices=[{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}])
+            return self._send(h, 200, json.dumps(body).encode(), "application/json")
+
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.end_headers()
+        event = lambda obj: h.wfile.write(f"data: {json.dumps(obj)}\n\n".encode())
+        chunk = lambda delta, finish=None: dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": delta, "finish_reason": finish}])
+        event(chunk({"role": "assistant", "content": ""}))
+        for i in range(0, len(text), self.chunk_chars):
+            if self.token_delay: time.sleep(self.token_delay)
+            event(chunk({"content": text[i:i + self.chunk_chars]}))
+        event(chunk({}, "stop"))
+        if (req.get("stream_options") or {}).get("include_usage"):
+            event(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        h.wfile.write(b"data: [DONE]\n\n")
+        h.wfile.flush()
+
+
+def route_github_to(backend):
+    """requests.get verso raw.githubusercontent.com finisce sul backend locale (DB esercizi e foto)."""
+    original = requests.get
+
+    def get(url, *args, **kwargs):
+        if isinstance(url, str) and url.startswith(GITHUB_RAW):
+            url = f"{backend.url}/github/{url[len(GITHUB_RAW):]}"
+        return original(url, *args, **kwargs)
+    requests.get = get
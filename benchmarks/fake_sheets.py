@@ -0,0 +1,288 @@
+"""Sostituto in memoria di gspread (client / file / foglio) con dati sintetici per i benchmark."""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import gspread
+
+# Atleti 0..ACTIVE_FIXED-1: abbonamento attivo e almeno una scheda (email usate per login e dashboard)
+ACTIVE_FIXED = 10
+EXERCISE_IMG_BASE = "https://raw.githubusercontent.com/yuhonas/free-exercise-db/main/exercises/"
+
+ANAMNESI_HEADER = ["Submitted at", "E-mail", "Nome", "Cognome", "Altezza (cm)", "Sesso", "Peso (kg)",
+                   "Collo (cm)", "Torace (cm)", "Addome (cm)", "Fianchi (cm)", "Braccio Sx (cm)", "Braccio Dx (cm)",
+                   "Coscia Sx (cm)", "Coscia Dx (cm)", "Polpaccio Sx (cm)", "Polpaccio Dx (cm)", "Obiettivo"]
+CHECKUP_HEADER = ["Submitted at", "Email", "Peso", "Collo", "Torace", "Addome", "Fianchi", "Braccio Sx", "Braccio Dx",
+                  "Coscia Sx", "Coscia Dx", "Polpaccio Sx", "Polpaccio Dx", "Note"]
+CLIENTI_HEADER = ["Email", "Nome", "Scadenza", "Link_Pagamento"]
+PLAN_HEADER = ["Data", "Email", "Nome", "Commento", "JSON_Scheda", "JSON_Dieta"]
+# misura -> (valore tipico, variazione per check-up)
+BODY = {"Collo": (38, 0.1), "Torace": (100, 0.3), "Addome": (88, 0.5), "Fianchi": (98, 0.3),
+        "Braccio Sx": (34, 0.1), "Braccio Dx": (34.5, 0.1), "Coscia Sx": (58, 0.2), "Coscia Dx": (58.5, 0.2),
+        "Polpaccio Sx": (37, 0.05), "Polpaccio Dx": (37, 0.05)}
+
+
+def athlete_email(i):
+    return f"atleta{i:05d}@bench.area199.it"
+
+
+# ==============================================================================
+# GSPREAD IN MEMORIA
+# ==============================================================================
+def _col_index(letters):
+    n = 0
+    for ch in letters: n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+class FakeWorksheet:
+    """Foglio: lista di righe di stringhe, come le restituisce l'API Sheets (valori formattati)."""
+
+    def __init__(self, client, title, values):
+        self.client, self.title, self.values = client, title, values
+        self.id = abs(hash(title)) % 10 ** 9
+
+    def _range(self, rng):
+        """'A5:B', '1:1', '5:5004', 'B2' -> righe ritagliate, senza celle/righe vuote in coda (come l'API)."""
+        m = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", rng.split('!')[-1])
+        c1, r1, c2, r2 = m.groups()
+        r1 = int(r1) if r1 else 1
+        r2 = int(r2) if r2 else (r1 if m.group(3) is None else len(self.values))
+        a = _col_index(c1) if c1 else 0
+        b = _col_index(c2) + 1 if c2 else (a + 1 if c1 and m.group(3) is None else None)
+        out = []
+        for row in self.values[r1 - 1:r2]:
+            row = row[a:b]
+            while row and row[-1] == "": row = row[:-1]
+            out.append(list(row))
+        while out and not out[-1]: out.pop()
+        return out
+
+    def get_all_values(self):
+        self.client.hit('get_all_values')
+        return [list(r) for r in self.values]
+
+    def get_all_records(self, numericise_ignore=None, **kwargs):
+        self.client.hit('get_all_records')
+        if not self.values: return []
+        values = gspread.utils.fill_gaps(self.values)
+        rows = values[1:] if numericise_ignore == ['all'] else [gspread.utils.numericise_all(r) for r in values[1:]]
+        return gspread.utils.to_records(values[0], rows)
+
+    def row_values(self, row):
+        self.client.hit('row_values')
+        rows = self._range(f"{row}:{row}")
+        return rows[0] if rows else []
+
+    def col_values(self, col):
+        self.client.hit('col_values')
+        return [r[col - 1] if len(r) >= col else "" for r in self.values]
+
+    def get(self, rng):
+        self.client.hit('get')
+        return self._range(rng)
+
+    def batch_get(self, ranges):
+        self.client.hit('batch_get')
+        return [self._range(r) for r in ranges]
+
+    def append_rows(self, rows, **kwargs):
+        self.client.hit('append_rows')
+        with self.client.lock:
+            first = len(self.values) + 1
+            self.values.extend([str(v) for v in r] for r in rows)
+            last = len(self.values)
+        end = gspread.utils.rowcol_to_a1(last, max(len(r) for r in rows))
+        return {'updates': {'updatedRange': f"{self.title}!A{first}:{end}", 'updatedRows': len(rows)}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, title, sheets):
+        self.client, self.title = client, title
+        self.id = "bench_" + re.sub(r"\W+", "_", title).lower()
+        self._sheets = {name: FakeWorksheet(client, name, values) for name, values in sheets.items()}
+
+    @property
+    def sheet1(self):
+        self.client.hit('sheet1')
+        return next(iter(self._sheets.values()))
+
+    def worksheet(self, title):
+        self.client.hit('worksheet')
+        if title not in self._sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def worksheets(self):
+        self.client.hit('worksheets')
+        return list(self._sheets.values())
+
+    def values_batch_get(self, ranges, params=None):
+        self.client.hit('values_batch_get')
+        out = []
+        for r in ranges:
+            title, _, rng = r.partition('!')
+            title = title.strip("'").replace("''", "'")
+            if title not in self._sheets: title, rng = next(iter(self._sheets)), r  # range senza nome del foglio
+            ws = self._sheets[title]
+            values = ws._range(rng) if rng else [list(x) for x in ws.values]
+            out.append({'range': r, 'values': values} if values else {'range': r})
+        return {'spreadsheetId': self.id, 'valueRanges': out}
+
+
+class FakeClient:
+    """Client gspread: ogni chiamata API attende `latency` secondi (rete simulata) e viene contata.
+    Le chiamate dei thread in background dell'app (replica, coda invii) sono contate a parte."""
+
+    def __init__(self, book, latency=0.0):
+        self.latency, self.lock = latency, threading.Lock()
+        self.calls, self.background_calls = Counter(), Counter()
+        self.files = {title: FakeSpreadsheet(self, title, sheets) for title, sheets in book.items()}
+
+    def hit(self, name):
+        background = threading.current_thread().name.endswith("_loop)")
+        with self.lock: (self.background_calls if background else self.calls)[name] += 1
+        if self.latency: time.sleep(self.latency)
+
+    def reset_counts(self):
+        with self.lock: self.calls.clear(); self.background_calls.clear()
+
+    def open(self, title):
+        self.hit('open')
+        if title not in self.files: raise gspread.exceptions.SpreadsheetNotFound(title)
+        return self.files[title]
+
+    def open_by_key(self, key):
+        self.hit('open_by_key')
+        for sh in self.files.values():
+            if sh.id == key: return sh
+        raise gspread.exceptions.SpreadsheetNotFound(key)
+
+
+def install(client):
+    """Sostituisce autenticazione e client di gspread: get_client() dell'app riceve il client finto."""
+    from google.oauth2.service_account import Credentials
+    gspread.authorize = lambda creds, *args, **kwargs: client
+    Credentials.from_service_account_info = classmethod(lambda cls, info, **kwargs: None)
+
+
+def spreadsheet_ids(client):
+    """Per st.secrets["spreadsheet_ids"]: l'app apre i file per ID come in produzione."""
+    return {title: sh.id for title, sh in client.files.items()}
+
+
+# ==============================================================================
+# DATI SINTETICI
+# ==============================================================================
+def _num(value, comma):
+    text = f"{value:.1f}"
+    return text.replace(".", ",") if comma else text
+
+
+def _form_date(day):
+    return day.strftime("%d/%m/%Y %H:%M:%S")
+
+
+def build_plan(rng, exercises):
+    sessions = []
+    for s in range(rng.randint(3, 5)):
+        picks = rng.sample(exercises, 7)
+        sessions.append({"name": f"Sessione {chr(65 + s)}", "exercises": [
+            {"name": ex['name'], "details": f"{rng.randint(3, 5)}x{rng.choice([6, 8, 10, 12])} rec {rng.choice([60, 90, 120])}''",
+             "note": rng.choice(["", "Fermo al petto", "Controlla l'eccentrica", "Ultima serie a cedimento"]),
+             "images": [EXERCISE_IMG_BASE + img for img in ex['images']]} for ex in picks]})
+    return {"sessions": sessions, "note_coach": "Spingi sui fondamentali, scarico alla quarta settimana."}
+
+
+def build_diet(rng):
+    days = [{"day_name": name, "meals": [
+        {"name": meal, "foods": [f"{rng.choice(['Riso', 'Avena', 'Pollo', 'Uova', 'Yogurt greco', 'Pane integrale', 'Salmone'])} {rng.randint(50, 250)}g"
+                                 for _ in range(rng.randint(2, 5))], "notes": ""}
+        for meal in ["Colazione", "Spuntino", "Pranzo", "Merenda", "Cena"]]} for name in ["ON", "OFF"]]
+    return {"daily_calories": str(rng.randint(1800, 3200)), "water_intake": "3L", "diet_note": "", "days": days,
+            "supplements": [{"name": "Creatina", "dose": "5g", "timing": "post workout"}, {"name": "Omega 3", "dose": "2 cps", "timing": "pranzo"}]}
+
+
+def build_book(rows, exercises, seed=199, now=None):
+    """Libro di fogli con `rows` righe in ANAMNESI e CHECK-UP, un atleta ogni 10 righe,
+    un abbonamento per atleta e una scheda ogni 5 righe. Deterministico per seed."""
+    rng, now = random.Random(seed), now or datetime.now()
+    athletes = max(ACTIVE_FIXED, rows // 10)
+    profiles = [(rng.choice(["Uomo", "Donna"]), rng.randint(155, 195), rng.uniform(55, 105)) for _ in range(athletes)]
+
+    anamnesi, checkup = [ANAMNESI_HEADER], [CHECKUP_HEADER]
+    for r in range(rows):
+        i = r % athletes
+        sex, height, weight = profiles[i]
+        k = r // athletes  # k-esimo modulo dell'atleta: misure in lento calo
+        day = now - timedelta(days=7 * (rows // athletes - k) + rng.randint(0, 6), seconds=rng.randint(0, 86400))
+        body = {m: base * (0.9 if sex == "Donna" else 1.0) - k * step + rng.uniform(-0.5, 0.5) for m, (base, step) in BODY.items()}
+        comma = rng.random() < 0.3
+        anamnesi.append([_form_date(day), athlete_email(i), f"Nome{i}", f"Cognome{i}", str(height), sex, _num(weight - k * 0.3, comma)]
+                        + [_num(body[m], comma) for m in BODY] + [rng.choice(["Ricomposizione", "Massa", "Definizione"])])
+        checkup.append([_form_date(day + timedelta(days=3)), athlete_email(i).upper() if rng.random() < 0.05 else athlete_email(i),
+                        _num(weight - k * 0.3 - 0.2, comma)] + [_num(body[m] - 0.1, comma) for m in BODY] + [""])
+
+    clienti = [CLIENTI_HEADER]
+    for i in range(athletes):
+        days_left = rng.randint(10, 120) if i < ACTIVE_FIXED else rng.choice([rng.randint(-60, -1), rng.randint(0, 5), rng.randint(6, 365)])
+        clienti.append([athlete_email(i), f"Nome{i} Cognome{i}", (now + timedelta(days=days_left)).strftime("%d/%m/%Y"), "https://revolut.me/area199"])
+
+    # Poche varianti di scheda/dieta riusate: generare 20k JSON diversi non cambia la misura
+    templates = [(json.dumps(build_plan(rng, exercises), ensure_ascii=False), json.dumps(build_diet(rng), ensure_ascii=False)) for _ in range(8)]
+    plans = [PLAN_HEADER]
+    for r in range(max(ACTIVE_FIXED, rows // 5)):
+        i = r % athletes
+        plan, diet = templates[r % len(templates)]
+        sent = now - timedelta(days=max(ACTIVE_FIXED, rows // 5) - r)
+        plans.append([sent.strftime("%Y-%m-%d"), athlete_email(i), f"Nome{i} Cognome{i}", "Nuova scheda!", plan, diet])
+
+    return {"BIO ENTRY ANAMNESI": {"Risposte del modulo 1": anamnesi},
+            "BIO CHECK-UP": {"Risposte del modulo 1": checkup},
+            "AREA199_DB": {"CLIENTI_ATTIVI": clienti, "SCHEDE_ATTIVE": plans}}
+
+
+# Nomi costruiti come quelli del free-exercise-db, inclusi i bersagli dei sinonimi dell'app
+EQUIPMENT = [("Barbell", "barbell"), ("Dumbbell", "dumbbell"), ("Cable", "cable"), ("Machine", "machine"),
+             ("Kettlebell", "kettlebells"), ("Smith Machine", "machine"), ("Band", "bands"), ("Lever", "machine"), ("", "body only")]
+MOVEMENTS = [("Bench Press", "chest", "compound", "push"), ("Squat", "quadriceps", "compound", "push"),
+             ("Deadlift", "lower back", "compound", "pull"), ("Bent Over Row", "middle back", "compound", "pull"),
+             ("Curl", "biceps", "isolation", "pull"), ("Lateral Raise", "shoulders", "isolation", "push"),
+             ("Pulldown", "lats", "compound", "pull"), ("Fly", "chest", "isolation", "push"), ("Lunge", "quadriceps", "compound", "push"),
+             ("Shrug", "traps", "isolation", "pull"), ("Pushdown", "triceps", "isolation", "push"), ("Face Pull", "shoulders", "isolation", "pull"),
+             ("Leg Press", "quadriceps", "compound", "push"), ("Leg Extensions", "quadriceps", "isolation", "push"),
+             ("Lying Leg Curls", "hamstrings", "isolation", "pull"), ("Calf Raise", "calves", "isolation", "push"),
+             ("Hip Thrust", "glutes", "compound", "push"), ("Plank", "abdominals", "isolation", "static"),
+             ("Side Bridge", "abdominals", "isolation", "static"), ("Crunch", "abdominals", "isolation", "pull"),
+             ("Dead Bug", "abdominals", "isolation", "static"), ("Hyperextension", "lower back", "isolation", "pull"),
+             ("Preacher Curl", "biceps", "isolation", "pull"), ("Overhead Triceps Extension", "triceps", "isolation", "push"),
+             ("Seated Cable Row", "middle back", "compound", "pull"), ("Straight-Arm Pulldown", "lats", "isolation", "pull"),
+             ("Reverse Fly", "shoulders", "isolation", "pull"), ("Butterfly", "chest", "isolation", "push"),
+             ("Chest Press", "chest", "compound", "push"), ("Adductor", "adductors", "isolation", "pull"),
+             ("Stomach Vacuum", "abdominals", "isolation", "static"), ("T-Bar Row", "middle back", "compound", "pull"),
+             ("Military Press", "shoulders", "compound", "push"), ("Hammer Curl", "biceps", "isolation", "pull"),
+             ("Glute Bridge", "glutes", "compound", "push"), ("Romanian Deadlift", "hamstrings", "compound", "pull")]
+VARIANTS = ["", " - Incline", " - Decline", " - Close Grip", " - Wide Grip", " - Single Arm", " - Seated", " - Standing", " - Paused"]
+
+
+def build_exercises(count=900, seed=199):
+    """Record nello stesso formato (e con gli stessi campi) di dist/exercises.json del free-exercise-db."""
+    rng = random.Random(seed)
+    combos = [(e, m, v) for e in EQUIPMENT for m in MOVEMENTS for v in VARIANTS]
+    rng.shuffle(combos)
+    out = []
+    for (equip, eq_key), (move, muscle, mechanic, force), variant in combos[:count]:
+        name = f"{equip} {move}{variant}".strip()
+        ex_id = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+        out.append({"id": ex_id, "name": name, "force": force, "level": rng.choice(["beginner", "intermediate", "expert"]),
+                    "mechanic": mechanic, "equipment": eq_key, "primaryMuscles": [muscle],
+                    "secondaryMuscles": rng.sample(["forearms", "glutes", "triceps", "shoulders", "abdominals"], 2),
+                    "category": "stretching" if variant == " - Paused" and mechanic == "isolation" else "strength",
+                    "images": [f"{ex_id}/0.jpg", f"{ex_id}/1.jpg"]})
+    return sorted(out, key=lambda x: x['name'])
@@ -0,0 +1,156 @@
+"""Benchmark offline di AREA 199: Sheets in memoria, OpenAI e GitHub finti su un server locale,
+app guidata con streamlit.testing (AppTest). Ogni scenario gira in un processo separato.
+
+    python benchmarks/run.py                           # 100, 1000, 10000 righe
+    python benchmarks/run.py --sizes 100000 --scenarios history,login
+    python benchmarks/run.py --save-baseline           # aggiorna benchmarks/baseline.json
+    python benchmarks/run.py --compare                 # exit 1 se qualcosa peggiora oltre --tolerance
+
+Metriche: *_s secondi (meno è meglio), *_per_s operazioni al secondo (più è meglio),
+*_calls chiamate API in primo piano, *_mb memoria (RSS di picco del processo).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["login", "coach", "history", "images"]
+BASELINE = os.path.join(HERE, "baseline.json")
+RESULTS_DIR = os.path.join(HERE, "results")
+CONFIG_KEYS = ("exercises", "sheets_latency", "ai_latency", "ai_token_delay")
+# Sotto queste differenze assolute è rumore, qualunque sia la percentuale
+NOISE_FLOOR = {'_s': 0.05, '_mb': 15, '_calls': 0, '_per_s': 0}
+
+
+def run_scenario(name, rows, args):
+    cmd = [sys.executable, os.path.join(HERE, "scenarios.py"), name, "--rows", str(rows), "--timeout", str(args.timeout)] + \
+          [f"--{k.replace('_', '-')}={getattr(args, k)}" for k in CONFIG_KEYS]
+    try: proc = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout * 4)
+    except subprocess.TimeoutExpired: return None, "timeout"
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("BENCH_RESULT "): return json.loads(line[len("BENCH_RESULT "):]), None
+    tail = [l for l in proc.stderr.splitlines() if "ScriptRunContext" not in l][-15:]
+    return None, "\n".join(tail) or f"exit {proc.returncode}"
+
+
+def median_metrics(samples):
+    return {k: round(statistics.median(s[k] for s in samples if k in s), 4) for k in samples[0]}
+
+
+def worse_by(metric, old, new):
+    """Peggioramento relativo (0.2 = 20% peggio), 0 se migliora o resta sotto la soglia di rumore."""
+    suffix = next((s for s in ('_per_s', '_calls', '_mb', '_s') if metric.endswith(s)), '_s')
+    delta = (old - new) if suffix == '_per_s' else (new - old)
+    if delta <= NOISE_FLOOR[suffix] or not old: return 0.0
+    return delta / abs(old)
+
+
+def load_baseline(path):
+    try:
+        with open(path, encoding='utf-8') as f: return json.load(f)
+    except FileNotFoundError: return None
+
+
+def compare(results, baseline, tolerance):
+    """[(righe, metrica, baseline, ora, peggioramento)] oltre la tolleranza."""
+    out = []
+    for rows, metrics in results.items():
+        for metric, new in metrics.items():
+            old = baseline['results'].get(rows, {}).get(metric)
+            if old is None: continue
+            worse = worse_by(metric, old, new)
+            if worse > tolerance: out.append((rows, metric, old, new, worse))
+    return out
+
+
+def print_table(results, baseline=None):
+    sizes = sorted(results, key=int)
+    metrics = list(dict.fromkeys(m for r in sizes for m in results[r]))
+    width = max(len(m) for m in metrics) + 2
+    print("".ljust(width) + "".join(f"{r + ' righe':>22}" for r in sizes))
+    for m in metrics:
+        cells = []
+        for r in sizes:
+            val = results[r].get(m)
+            old = (baseline or {}).get('results', {}).get(r, {}).get(m)
+            text = "-" if val is None else f"{val:g}"
+            if val is not None and old: text += f" ({(val - old) / abs(old):+.0%})"
+            cells.append(f"{text:>22}")
+        print(m.ljust(width) + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--sizes", default="100,1000,10000", help="righe di ANAMNESI/CHECK-UP per giro (es. 100,1000,100000)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=1, help="giri per scenario: si tiene la mediana")
+    parser.add_argument("--exercises", type=int, default=900, help="esercizi nel DB sintetico")
+    parser.add_argument("--sheets-latency", type=float, default=0.05, help="secondi per chiamata Sheets simulata")
+    parser.add_argument("--ai-latency", type=float, default=0.5, help="secondi prima del primo token OpenAI")
+    parser.add_argument("--ai-token-delay", type=float, default=0.005, help="secondi tra due chunk dello stream")
+    parser.add_argument("--timeout", type=float, default=300, help="secondi massimi per un rerun AppTest")
+    parser.add_argument("--output", help="file JSON dei risultati (default benchmarks/results/<data>.json)")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="peggioramento relativo ammesso con --compare")
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown: parser.error(f"scenari sconosciuti: {', '.join(sorted(unknown))}")
+
+    results, failures = {}, []
+    for rows in sizes:
+        results[rows] = {}
+        for name in scenarios:
+            samples = []
+            for i in range(args.repeat):
+                print(f"[{rows} righe] {name} ({i + 1}/{args.repeat})...", file=sys.stderr, flush=True)
+                metrics, error = run_scenario(name, int(rows), args)
+                if error:
+                    failures.append((rows, name, error))
+                    print(f"  FALLITO:\n{error}", file=sys.stderr)
+                    break
+                samples.append(metrics)
+            if samples: results[rows].update(median_metrics(samples))
+
+    report = {'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'cpus': os.cpu_count(), 'repeat': args.repeat,
+                       'config': {k: getattr(args, k) for k in CONFIG_KEYS}},
+              'results': results}
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+
+    baseline = load_baseline(args.baseline) if args.compare else None
+    print_table(results, baseline)
+    print(f"\nRisultati: {output}")
+
+    status = 2 if failures else 0
+    if args.compare:
+        if baseline is None: print(f"Nessuna baseline in {args.baseline}: usa --save-baseline."); status = status or 2
+        else:
+            if baseline['meta'].get('config') != report['meta']['config']:
+                print(f"⚠️ Configurazione diversa dalla baseline ({baseline['meta'].get('config')}): confronto poco significativo.")
+            regressions = compare(results, baseline, args.tolerance)
+            for rows, metric, old, new, worse in regressions:
+                print(f"REGRESSIONE [{rows} righe] {metric}: {old:g} -> {new:g} ({worse:+.0%})")
+            if regressions: status = 1
+            else: print(f"Nessuna regressione oltre il {args.tolerance:.0%} rispetto a {baseline['meta']['date']}.")
+    if args.save_baseline:
+        if failures: print("Baseline NON salvata: alcuni scenari sono falliti.")
+        else:
+            with open(args.baseline, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+            print(f"Baseline salvata in {args.baseline}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Un singolo scenario di benchmark, in un processo pulito (cache Streamlit, replica e RSS da zero).
+Lanciato da run.py; stampa le metriche come riga JSON "BENCH_RESULT {...}".
+
+    python benchmarks/scenarios.py login --rows 1000
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from fake_backend import FakeBackend, route_github_to
+from fake_sheets import FakeClient, athlete_email, build_book, build_exercises, install, spreadsheet_ids
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(REPO, "app.py")
+COACH_PASSWORD = "PETRUZZI199"
+
+WORKOUT_TEXT = """Sessione A
+Panca piana 4x8 rec 90''
+Rematore con manubrio 4x10 - schiena neutra
+Leg press 3x12
+Alzate laterali 3x15
+Sessione B
+Squat 5x5 rec 120''
+Trazioni alla sbarra fino a cedimento
+Stacco rumeno 4x8
+Curl martello 3x12"""
+DIET_TEXT = "ON: colazione avena e uova, pranzo riso e pollo, cena salmone e patate. OFF: meno carboidrati."
+# Nomi come arrivano dal parser/AI (search_name): sinonimi, substring e fuzzy
+IMAGE_QUERIES = ["barbell bench press", "dumbbell bench press incline", "lat pulldown", "lying leg curl", "leg extension",
+                 "leg press", "calf raise", "cable row", "face pull", "lateral raise", "triceps pushdown", "preacher curl",
+                 "squat", "romanian deadlift", "hip thrust", "plank", "side plank", "dead bug", "hammer curl", "military press",
+                 "pec deck", "reverse pec deck", "chest press", "t-bar", "hyperextension", "glute bridge", "smith machine squat",
+                 "kettlebell swing", "band pull apart", "single arm dumbbell row", "close grip bench", "overhead cable",
+                 "straight arm", "hip adduction", "vacuum", "wide grip pulldown", "seated shoulder press", "bulgarian split squat"]
+
+
+def rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return round(time.perf_counter() - t0, 4)
+
+
+class Env:
+    """Cartella di lavoro temporanea con secrets, snapshot esercizi e cache dell'app, più i backend finti."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="area199_bench_")
+        self.cache_dir = os.path.join(self.workdir, "cache")
+        os.makedirs(os.path.join(self.workdir, ".streamlit"))
+        os.makedirs(self.cache_dir)
+        os.chdir(self.workdir)
+        os.environ["AREA199_CACHE_DIR"] = self.cache_dir
+        # Le foto finte non devono mai finire in static/thumbs del repo (servite in produzione)
+        os.environ["AREA199_THUMB_DIR"] = os.path.join(self.workdir, "thumbs")
+
+        self.exercises = build_exercises(args.exercises)
+        self.rows = args.rows
+        self.client = FakeClient(build_book(args.rows, self.exercises), latency=args.sheets_latency)
+        install(self.client)
+        self.backend = FakeBackend(self.exercises, latency=args.ai_latency, token_delay=args.ai_token_delay).start()
+        route_github_to(self.backend)
+        os.environ["OPENAI_BASE_URL"] = f"{self.backend.url}/v1"
+
+        self.secrets = {"gcp_service_account": {"type": "service_account", "client_email": "bench@area199.iam.gserviceaccount.com"},
+                        "openai_key": "sk-bench", "spreadsheet_ids": spreadsheet_ids(self.client)}
+        with open(os.path.join(self.workdir, ".streamlit", "secrets.toml"), "w") as f:
+            f.write(f'openai_key = "sk-bench"\n\n[gcp_service_account]\n')
+            for k, v in self.secrets["gcp_service_account"].items(): f.write(f'{k} = "{v}"\n')
+            f.write("\n[spreadsheet_ids]\n")
+            for k, v in self.secrets["spreadsheet_ids"].items(): f.write(f'"{k}" = "{v}"\n')
+        # Snapshot fresco su disco: l'app non scarica il DB all'avvio (come in produzione dopo il primo giro)
+        with open(os.path.join(self.cache_dir, "exercises.json"), "w", encoding="utf-8") as f:
+            json.dump({'version': "bench", 'etag': "", 'last_modified': "", 'fetched_at': time.time(), 'exercises': self.exercises}, f)
+        self.setup_rss = rss_mb()
+
+    def app_test(self):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_file(APP, default_timeout=self.args.timeout)
+        for k, v in self.secrets.items(): at.secrets[k] = v
+        return at
+
+    def import_app(self):
+        """app.py come modulo (senza main), con la replica sincronizzata solo su richiesta dello scenario."""
+        sys.path.insert(0, REPO)
+        import app
+        app._replica_loop = lambda rep: None
+        return app
+
+    def foreground_calls(self):
+        return sum(self.client.calls.values())
+
+    def wait_replica(self, timeout=600):
+        """Attende che il thread di sync dell'app abbia copiato tutte le tabelle nella replica SQLite."""
+        deadline, path = time.time() + timeout, os.path.join(self.cache_dir, "replica.sqlite")
+        while time.time() < deadline:
+            try:
+                with sqlite3.connect(path) as conn:
+                    ready = conn.execute("SELECT COUNT(*) FROM replica_meta WHERE header IS NOT NULL AND header != '[]'").fetchone()[0]
+                if ready >= 4: return True
+            except sqlite3.Error: pass
+            time.sleep(0.2)
+        return False
+
+
+def check(at, step):
+    if at.exception: raise RuntimeError(f"{step}: {at.exception[0].message}")
+    errors = [e.value for e in at.error]
+    if errors: raise RuntimeError(f"{step}: {errors[0]}")
+
+
+def athlete_login(env, email):
+    at = env.app_test()
+    at.run()
+    at.sidebar.radio[0].set_value("Atleta").run()
+    at.sidebar.text_input[0].input(email)
+    env.client.reset_counts()
+    elapsed = timed(lambda: at.sidebar.button[0].click().run())
+    check(at, f"login {email}")
+    return at, elapsed
+
+
+# ==============================================================================
+# SCENARI
+# ==============================================================================
+def scenario_login(env):
+    """Login atleta a freddo (fogli, replica vuota), rerun della stessa sessione, login a replica pronta."""
+    out = {}
+    at, out['login_cold_s'] = athlete_login(env, athlete_email(1))
+    out['login_cold_sheets_calls'] = env.foreground_calls()
+    out['login_rerun_s'] = timed(at.run)
+    if not env.wait_replica(): raise RuntimeError("replica non pronta")
+    at, out['login_warm_s'] = athlete_login(env, athlete_email(2))
+    out['login_warm_sheets_calls'] = env.foreground_calls()
+    return out
+
+
+def scenario_coach(env):
+    """Dashboard coach: primo caricamento, rerun, selezione atleta, anteprima con AI finta, pagina coorte."""
+    out = {}
+    at = env.app_test()
+    at.run()
+    at.sidebar.text_input[0].input(COACH_PASSWORD)
+    env.client.reset_counts()
+    out['coach_load_cold_s'] = timed(at.run)
+    check(at, "dashboard coach")
+    out['coach_load_cold_sheets_calls'] = env.foreground_calls()
+    out['coach_rerun_s'] = timed(at.run)
+    out['coach_select_athlete_s'] = timed(lambda: at.selectbox[0].set_value(athlete_email(3)).run())
+    check(at, "selezione atleta")
+    at.text_area(key="input_raw_workout").input(WORKOUT_TEXT)
+    at.text_area(key="input_raw_diet").input(DIET_TEXT)
+    generate = next(b for b in at.button if b.label.startswith("🔄 GENERA"))
+    out['coach_generate_s'] = timed(lambda: generate.click().run())
+    check(at, "generazione anteprima")
+    out['coach_generate_ai_calls'] = sum(v for k, v in env.backend.hits.items() if k.startswith("openai."))
+    out['coach_cohort_s'] = timed(lambda: at.sidebar.radio[1].set_value("📊 Coorte").run())
+    check(at, "coorte")
+    return out
+
+
+def scenario_history(env):
+    """get_full_history: dallo snapshot dei fogli, poi dalla replica SQLite (dopo una sync completa)."""
+    app, out = env.import_app(), {}
+    athletes = max(10, env.rows // 10)
+    emails = [athlete_email(i * athletes // 200) for i in range(min(athletes, 200))]
+    out['history_first_call_s'] = timed(lambda: app.get_full_history(emails[0]))
+    t = timed(lambda: [app.get_full_history(e) for e in emails])
+    out['history_sheets_per_s'] = round(len(emails) / t, 1)
+    out['replica_full_sync_s'] = timed(app.sync_replica)
+    if not app.replica_ready('anamnesi'): raise RuntimeError("replica non pronta dopo sync_replica")
+    t = timed(lambda: [app.get_full_history(e) for e in emails])
+    out['history_replica_per_s'] = round(len(emails) / t, 1)
+    return out
+
+
+def scenario_images(env):
+    """find_exercise_images (una query per volta) e match di una scheda intera con attach_exercise_images."""
+    app, out = env.import_app(), {}
+    ex_db = app.load_exercise_db()
+    if len(ex_db) != len(env.exercises): raise RuntimeError("snapshot esercizi non caricato")
+    out['images_index_build_s'] = timed(lambda: app.get_exercise_index(ex_db))
+    rounds = 20
+    t = timed(lambda: [app.find_exercise_images(q, ex_db) for _ in range(rounds) for q in IMAGE_QUERIES])
+    out['images_find_per_s'] = round(rounds * len(IMAGE_QUERIES) / t, 1)
+    plan = {"sessions": [{"name": f"Sessione {s}", "exercises": [{"name": q, "search_name": q, "details": "3x10", "note": ""}
+                                                                   for q in IMAGE_QUERIES[s::4]]} for s in range(4)]}
+    out['images_plan_match_s'] = timed(lambda: app.attach_exercise_images(json.loads(json.dumps(plan)), ex_db))
+    return out
+
+
+SCENARIOS = {'login': scenario_login, 'coach': scenario_coach, 'history': scenario_history, 'images': scenario_images}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--exercises", type=int, default=900)
+    parser.add_argument("--sheets-latency", type=float, default=0.05)
+    parser.add_argument("--ai-latency", type=float, default=0.5)
+    parser.add_argument("--ai-token-delay", type=float, default=0.005)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    env = Env(args)
+    metrics = SCENARIOS[args.scenario](env)
+    metrics[f'{args.scenario}_peak_rss_mb'] = rss_mb()
+    metrics[f'{args.scenario}_rss_growth_mb'] = round(rss_mb() - env.setup_rss, 1)
+    print("BENCH_RESULT " + json.dumps(metrics), flush=True)
+    os._exit(0)  # thread daemon dell'app (replica, coda invii) e server: niente attese in uscita
+
+
+if __name__ == "__main__":
+    main()